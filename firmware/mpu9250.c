@@ -5,8 +5,16 @@
 
 #include "user_interface.h"
 
+#include "user_config.h"
 #include "i2c.h"
 
+#ifndef MPU9250_OUTPUT_BINARY
+#define MPU9250_OUTPUT_BINARY 0
+#endif
+
+/* ROM routine that sends one raw byte on UART0. */
+extern STATUS uart_tx_one_char(uint8 c);
+
 static os_timer_t mpu9250_timer;
 
 const uint8 MPU9250_ADDR_READ = (0x68 << 1) | 1;
@@ -17,6 +25,21 @@ const uint8 AK8963_ADDR_WRITE = (0x0C << 1) | 0;
 
 uint8 mag_adj_x, mag_adj_y, mag_adj_z;
 
+/*
+ * Binary packet layout (little-endian, 28 bytes):
+ *
+ *   0  uint8[2]   sync word 0xA5 0x5A
+ *   2  uint16     sequence number
+ *   4  uint32     sample time in microseconds (system_get_time)
+ *   8  sint16[9]  acc x/y/z, mag x/y/z, rot x/y/z
+ *  26  uint16     CRC-16/CCITT-FALSE of bytes 2..25
+ */
+#define PACKET_SYNC0 0xA5
+#define PACKET_SYNC1 0x5A
+#define PACKET_SIZE 28
+
+static uint16 packet_seq;
+
 struct vec
 {
     sint16 x, y, z;
@@ -130,21 +153,79 @@ void mpu9250_read_sensors(sint16 *temp, struct vec *acc, struct vec *rot, struct
     i2c_stop();
 }
 
+uint16 crc16_ccitt(const uint8 *data, uint8 len)
+{
+    uint16 crc = 0xFFFF;
+    uint8 i, j;
+
+    for (i = 0; i < len; i++) {
+        crc ^= (uint16)data[i] << 8;
+        for (j = 0; j < 8; j++)
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+    }
+
+    return crc;
+}
+
+static void put16(uint8 *p, uint16 v)
+{
+    p[0] = v & 0xFF;
+    p[1] = v >> 8;
+}
+
+static void put32(uint8 *p, uint32 v)
+{
+    put16(p, v & 0xFFFF);
+    put16(p + 2, v >> 16);
+}
+
+void mpu9250_send_packet(uint32 stamp, struct vec *acc, struct vec *mag, struct vec *rot)
+{
+    uint8 packet[PACKET_SIZE];
+    uint8 i;
+
+    packet[0] = PACKET_SYNC0;
+    packet[1] = PACKET_SYNC1;
+    put16(packet + 2, packet_seq++);
+    put32(packet + 4, stamp);
+    put16(packet + 8, acc->x);
+    put16(packet + 10, acc->y);
+    put16(packet + 12, acc->z);
+    put16(packet + 14, mag->x);
+    put16(packet + 16, mag->y);
+    put16(packet + 18, mag->z);
+    put16(packet + 20, rot->x);
+    put16(packet + 22, rot->y);
+    put16(packet + 24, rot->z);
+    put16(packet + 26, crc16_ccitt(packet + 2, 24));
+
+    for (i = 0; i < PACKET_SIZE; i++)
+        uart_tx_one_char(packet[i]);
+}
+
 void mpu9250_timer_func(void *arg)
 {
     sint16 temp;
     struct vec acc, rot, mag;
+    uint32 stamp;
 
+    // Time the sample before the I2C transfers, whose length varies.
+    stamp = system_get_time();
     mpu9250_read_sensors(&temp, &acc, &rot, &mag);
 
     // os_printf("ACC %d %d %d\n", acc.x, acc.y, acc.z);
     // os_printf("MAG %d %d %d\n", mag.x, mag.y, mag.z);
     // os_printf("GYR %d %d %d\n", rot.x, rot.y, rot.z);
 
-    os_printf("%d %d %d %d %d %d %d %d %d\n",
+#if MPU9250_OUTPUT_BINARY
+    mpu9250_send_packet(stamp, &acc, &mag, &rot);
+#else
+    os_printf("%u %d %d %d %d %d %d %d %d %d\n",
+        stamp,
         acc.x, acc.y, acc.z,
         mag.x, mag.y, mag.z,
         rot.x, rot.y, rot.z);
+#endif
 }
 
 void mpu9250_write(uint8 device, uint8 addr, uint8 data)
@@ -204,7 +285,8 @@ void mpu9250_init()
 
     os_delay_us(50000);
 
-    os_printf("MPU9250 init done\n");
+    // The chip ID identifies the board's calibration on the host.
+    os_printf("MPU9250 init done, chip %08x\n", system_get_chip_id());
 }
 
 void user_init()
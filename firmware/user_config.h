@@ -7,4 +7,7 @@
 #ifndef USER_CONFIG_H_
 #define USER_CONFIG_H_
 
+/* Sample output format: 0 = ASCII text lines, 1 = framed binary packets. */
+#define MPU9250_OUTPUT_BINARY 1
+
 #endif /* USER_CONFIG_H_ */
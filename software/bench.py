@@ -0,0 +1,244 @@
+"""Benchmark and regression suite for numpyx and the estimators.
+
+Measures the per-call latency of the numpyx primitives and of each
+estimator step on a fixed synthetic input (or on the raw samples of a
+recording), and checks the estimator trajectories over the synthetic
+input against stored golden results.
+
+    python bench.py                       # run, print a summary
+    python bench.py --json results.json   # also write machine-readable results
+    python bench.py --recording output/data1.rec
+    python bench.py --update-golden       # re-record the golden trajectories
+    python bench.py --startup             # also check import times (startup.py)
+
+The exit status is 1 if any trajectory differs from the golden results
+by more than the tolerance, or with --startup if a module breaks its
+import budget.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+import numpyx as npx
+import quat
+from qeskf import QuaternionESKF, QuaternionESKFBank
+from vekf import VectorEKF, VectorEKFBank
+from qint import QuaternionIntegrator
+from tracker import NAV_G, NAV_M
+from calib import DEFAULT
+from synth import generate, profile
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_golden.npz")
+GOLDEN_SAMPLES = 1000
+TOLERANCE = 1e-9
+
+# -----------------------------------------------------------------------------
+
+def synthetic_samples(n, seed=0, dt=0.02):
+    """Calibrated (n, 9) acc/mag/rot samples and (n,) time steps of a
+    sensor turning randomly (synth.py's random profile), with sensor
+    noise."""
+    data = generate(profile('random', n, dt, seed), dt, seed=seed)
+    return data.calibrated, data.dts
+
+def recorded_samples(path):
+    """Calibrated samples and time steps from the raw fields of a recording,
+    timed by a SensorClock as in the live run."""
+    from recording import Recording
+    from sensorclock import sample_times
+    rec = Recording(path)
+    raw = np.asarray(rec.raw, dtype=np.float64)
+    if np.isnan(raw).any():
+        raise ValueError("%s holds no raw samples" % path)
+    samples = DEFAULT.apply_batch(raw)
+    _, dts = sample_times(np.asarray(rec.stamp, dtype=np.float64), np.asarray(rec.time))
+    return samples[1:], dts[1:]
+
+# -----------------------------------------------------------------------------
+
+def measure(func, number=None, repeat=5):
+    """Median per-call latency of func in microseconds."""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    times = timer.repeat(repeat=repeat, number=number)
+    return 1e6 * sorted(times)[len(times) // 2] / number
+
+def primitive_benchmarks():
+    v = npx.vec3(0.1, -0.2, 0.3)
+    q = npx.qrotv(v)
+    p = npx.qrotv(-2 * v)
+    vs = np.random.default_rng(0).normal(size=(1000, 3))
+    qs = npx.qrotvn(vs)
+    vf, qf, pf = v[:, 0], q[:, 0], p[:, 0]
+    q_out, m_out = np.empty(4), np.empty((3, 3))
+    qs_out = np.empty((1000, 4))
+
+    return {
+        'numpyx.xmat': lambda: npx.xmat(v),
+        'numpyx.qmull': lambda: npx.qmull(p, q),
+        'numpyx.qrotv': lambda: npx.qrotv(v),
+        'numpyx.rmat3q': lambda: npx.rmat3q(q),
+        'numpyx.rmat4q': lambda: npx.rmat4q(q),
+        'numpyx.rexp': lambda: npx.rexp(v),
+        'numpyx.qrotvn[1000]': lambda: npx.qrotvn(vs),
+        'numpyx.qmulln[1000]': lambda: npx.qmulln(qs, qs),
+        'numpyx.rmat3qn[1000]': lambda: npx.rmat3qn(qs),
+        'numpyx.rexpn[1000]': lambda: npx.rexpn(vs),
+        'quat.qmul': lambda: quat.qmul(pf, qf, out=q_out),
+        'quat.qexp': lambda: quat.qexp(vf, out=q_out),
+        'quat.qrmat': lambda: quat.qrmat(qf, out=m_out),
+        'quat.qnormalize': lambda: quat.qnormalize(qf, out=q_out),
+        'quat.qmuln[1000]': lambda: quat.qmuln(qs, qs, out=qs_out),
+    }
+
+def estimator_benchmarks(samples, dts):
+    """Latency of one step of each estimator, cycling through the samples."""
+    n = len(samples)
+    cols = [(s[0:3, np.newaxis], s[3:6, np.newaxis], s[6:9, np.newaxis]) for s in samples]
+
+    def stepper(make, step):
+        obj = make()
+        index = [0]
+        def run():
+            i = index[0] = (index[0] + 1) % n
+            step(obj, dts[i], *cols[i])
+        return run
+
+    k = 100
+    bank_acc = np.repeat(samples[:1, 0:3], k, axis=0)
+    bank_mag = np.repeat(samples[:1, 3:6], k, axis=0)
+    bank_rot = np.repeat(samples[:1, 6:9], k, axis=0)
+    qbank = QuaternionESKFBank(NAV_G, NAV_M, k)
+    vbank = VectorEKFBank(1.0, k)
+
+    return {
+        'QuaternionESKF.step': stepper(lambda: QuaternionESKF(NAV_G, NAV_M),
+            lambda f, dt, acc, mag, rot: f.step(dt, acc, mag, rot)),
+        'QuaternionESKF.step[sequential]': stepper(lambda: QuaternionESKF(NAV_G, NAV_M, sequential=True),
+            lambda f, dt, acc, mag, rot: f.step(dt, acc, mag, rot)),
+        'QuaternionESKF.predict': stepper(lambda: QuaternionESKF(NAV_G, NAV_M),
+            lambda f, dt, acc, mag, rot: f.predict(dt, rot)),
+        'VectorEKF.step': stepper(lambda: VectorEKF(1.0),
+            lambda f, dt, acc, mag, rot: f.step(dt, acc, rot)),
+        'QuaternionIntegrator.step': stepper(QuaternionIntegrator,
+            lambda f, dt, acc, mag, rot: f.step(dt, rot)),
+        'QuaternionESKF.replay[per sample]': (
+            lambda: QuaternionESKF(NAV_G, NAV_M).replay(dts, samples), n),
+        'QuaternionESKFBank.step[100]': lambda: qbank.step(0.02, bank_acc, bank_mag, bank_rot),
+        'VectorEKFBank.step[100]': lambda: vbank.step(0.02, bank_acc, bank_rot),
+    }
+
+def run_benchmarks(benchmarks):
+    results = {}
+    for name, bench in benchmarks.items():
+        func, per_call = bench if isinstance(bench, tuple) else (bench, 1)
+        latency = measure(func) / per_call
+        results[name] = {
+            'latency_us': latency,
+            'throughput_per_s': 1e6 / latency,
+        }
+    return results
+
+# -----------------------------------------------------------------------------
+
+def trajectories(samples, dts):
+    """Output trajectories of each estimator over the samples."""
+    qeskf = QuaternionESKF(NAV_G, NAV_M)
+    acc_vekf = VectorEKF(1.0)
+    mag_vekf = VectorEKF(1.0)
+    qint = QuaternionIntegrator()
+
+    out = {name: [] for name in ('qeskf', 'acc_vekf', 'mag_vekf', 'qint')}
+    for s, dt in zip(samples, dts):
+        acc, mag, rot = s[0:3, np.newaxis], s[3:6, np.newaxis], s[6:9, np.newaxis]
+        qeskf.step(dt, acc, mag, rot)
+        acc_vekf.step(dt, acc, rot)
+        mag_vekf.step(dt, mag, rot)
+        qint.step(dt, rot)
+        out['qeskf'].append(qeskf._q[:, 0].copy())
+        out['acc_vekf'].append(acc_vekf.vector[:, 0].copy())
+        out['mag_vekf'].append(mag_vekf.vector[:, 0].copy())
+        out['qint'].append(qint._q[:, 0].copy())
+    out = {name: np.array(values) for name, values in out.items()}
+    out['qeskf_replay'] = QuaternionESKF(NAV_G, NAV_M).replay(dts, samples)[0]
+    return out
+
+def check_golden(path, tolerance):
+    samples, dts = synthetic_samples(GOLDEN_SAMPLES)
+    golden = np.load(path)
+    current = trajectories(samples, dts)
+    results = {}
+    for name, values in current.items():
+        error = float(np.abs(values - golden[name]).max())
+        results[name] = {'max_error': error, 'ok': error <= tolerance}
+    return results
+
+def update_golden(path):
+    samples, dts = synthetic_samples(GOLDEN_SAMPLES)
+    np.savez_compressed(path, **trajectories(samples, dts))
+
+# -----------------------------------------------------------------------------
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON")
+    parser.add_argument('--recording', metavar='PATH', help="benchmark on the raw samples of a recording")
+    parser.add_argument('--samples', type=int, default=2000, help="length of the synthetic input")
+    parser.add_argument('--golden', default=GOLDEN_PATH, help="golden trajectory file")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--update-golden', action='store_true')
+    parser.add_argument('--startup', action='store_true', help="check the import time of every core module")
+    args = parser.parse_args(argv)
+
+    if args.update_golden:
+        update_golden(args.golden)
+        print("Wrote %s" % args.golden)
+        return 0
+
+    if args.recording:
+        samples, dts = recorded_samples(args.recording)
+    else:
+        samples, dts = synthetic_samples(args.samples)
+
+    benchmarks = primitive_benchmarks()
+    benchmarks.update(estimator_benchmarks(samples, dts))
+    results = run_benchmarks(benchmarks)
+    regression = check_golden(args.golden, args.tolerance)
+
+    for name, r in results.items():
+        print("%-36s %12.2f us %14.0f /s" % (name, r['latency_us'], r['throughput_per_s']))
+    for name, r in regression.items():
+        print("%-36s %12.3g    %s" % ("golden " + name, r['max_error'], "ok" if r['ok'] else "FAIL"))
+
+    imports = {}
+    if args.startup:
+        import startup
+        for module, seconds, loaded, ok in startup.check():
+            imports[module] = {'seconds': seconds, 'forbidden': loaded, 'ok': ok}
+            print("%-36s %12.1f ms %s" % ("import " + module, seconds * 1e3, "ok" if ok else "FAIL"))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'input': args.recording or "synthetic:%d" % args.samples,
+                'benchmarks': results,
+                'regression': regression,
+                'imports': imports,
+            }, f, indent=2)
+
+    return 0 if all(r['ok'] for r in list(regression.values()) + list(imports.values())) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+"""Stand-in for a fleet of boards streaming samples to netingest.py.
+
+Every simulated device sends the packets of wire.py, with its own
+sequence numbers and microsecond stamps, in the network framing of
+netingest.py. The samples are those of a board lying still, with
+sensor noise. All devices are driven from one timer, and their packets
+for a tick are encoded in one go, so thousands of devices can be run
+from a single process:
+
+    python boardsim.py --udp 9750 --devices 2000 --rate 50
+    python boardsim.py --tcp 9751 --devices 500 --batch 5
+"""
+
+import argparse
+import asyncio
+import socket
+import sys
+import time
+import numpy as np
+from numpy.linalg import solve
+
+import wire
+from netingest import DEVICE_ID
+from calib import DEFAULT
+from tracker import NAV_M
+
+# Standard deviation of the raw sensor noise, in counts.
+NOISE = np.array([20.0, 20.0, 20.0, 2.0, 2.0, 2.0, 5.0, 5.0, 5.0])
+
+class Fleet:
+    """Sequence numbers, clocks and raw samples of n simulated devices."""
+    def __init__(self, n, first_id=1, seed=0):
+        self.ids = np.arange(first_id, first_id + n)
+        self._rng = np.random.default_rng(seed)
+        self._seq = np.zeros(n, dtype=np.int64)
+        self._stamp = self._rng.integers(0, 1 << 32, n)
+
+        # Raw values of a board lying flat, pointing north.
+        calibrated = np.concatenate(([0.0, 0.0, 1.0], NAV_M[:, 0], [0.0, 0.0, 0.0]))
+        self._still = solve(DEFAULT.matrix, calibrated - DEFAULT.offset)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def packets(self, count, period):
+        """The next count packets of every device, as one bytes object of
+        per-device runs of count packets each."""
+        n = len(self.ids)
+        k = np.arange(count)
+        seq = (self._seq[:, None] + k) % 65536
+        stamps = (self._stamp[:, None] + np.round(k * period * 1e6).astype(np.int64)) % (1 << 32)
+        raw = self._still + self._rng.normal(0.0, 1.0, (n, count, 9)) * NOISE
+        self._seq += count
+        self._stamp = (self._stamp + int(round(count * period * 1e6))) % (1 << 32)
+        return wire.encode(seq.ravel(), stamps.ravel(), np.round(raw).reshape(-1, 9))
+
+    def frames(self, count, period):
+        """The next count packets of every device, each device's prefixed
+        by its ID."""
+        data = self.packets(count, period)
+        size = count * wire.PACKET_SIZE
+        return [DEVICE_ID.pack(int(i)) + data[j*size:(j+1)*size] for j, i in enumerate(self.ids)]
+
+async def run_udp(fleet, host, port, rate, batch, duration):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    sock = transport.get_extra_info('socket')
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+    try:
+        return await _tick(fleet, rate, batch, duration, lambda frames: [transport.sendto(f) for f in frames])
+    finally:
+        transport.close()
+
+async def run_tcp(fleet, host, port, rate, batch, duration):
+    writers = []
+    for i in fleet.ids:
+        _, writer = await asyncio.open_connection(host, port)
+        writer.write(DEVICE_ID.pack(int(i)))
+        writers.append(writer)
+
+    def send(frames):
+        for writer, frame in zip(writers, frames):
+            writer.write(frame[DEVICE_ID.size:])
+
+    try:
+        return await _tick(fleet, rate, batch, duration, send, writers)
+    finally:
+        for writer in writers:
+            writer.close()
+
+async def _tick(fleet, rate, batch, duration, send, writers=()):
+    """Send batch packets of every device each batch/rate seconds; with
+    TCP writers, wait for their buffers to drain, so that the server's
+    backpressure slows the fleet down."""
+    period = 1.0 / rate
+    interval = batch * period
+    start = next_time = time.monotonic()
+    sent = 0
+    while duration is None or time.monotonic() - start < duration:
+        send(fleet.frames(batch, period))
+        sent += batch * len(fleet)
+        for writer in writers:
+            await writer.drain()
+        next_time += interval
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    return sent, time.monotonic() - start
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--udp', type=int, help="send datagrams to this port")
+    parser.add_argument('--tcp', type=int, help="connect to this port")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--first-id', type=int, default=1, help="device ID of the first device")
+    parser.add_argument('--rate', type=float, default=50.0, help="samples per second per device")
+    parser.add_argument('--batch', type=int, default=1, help="packets per datagram or write")
+    parser.add_argument('--duration', type=float, help="seconds to run; forever if not given")
+    args = parser.parse_args(argv)
+    if (args.udp is None) == (args.tcp is None):
+        parser.error("give one of --udp and --tcp")
+
+    fleet = Fleet(args.devices, args.first_id)
+    if args.udp is not None:
+        job = run_udp(fleet, args.host, args.udp, args.rate, args.batch, args.duration)
+    else:
+        job = run_tcp(fleet, args.host, args.tcp, args.rate, args.batch, args.duration)
+    try:
+        sent, elapsed = asyncio.run(job)
+    except KeyboardInterrupt:
+        return 0
+    print("Sent %d packets in %.1f s (%.0f /s)" % (sent, elapsed, sent / elapsed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
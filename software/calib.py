@@ -0,0 +1,286 @@
+"""Sensor calibration: fitting, online refinement and per-board storage.
+
+A calibration maps the nine raw sensor values (acc, mag, rot) of a sample
+to calibrated ones by one affine transform, a block-diagonal 9x9 matrix
+and an offset. The accelerometer block scales gravity to 1, the
+magnetometer block scales the earth field to 1 and turns the AK8963 axes
+into the accelerometer frame, and the gyroscope block gives rad/s.
+
+The accelerometer and magnetometer blocks are fitted to a recording by
+fitting an ellipsoid to the raw values with linear least squares, and the
+gyroscope bias by averaging the samples where the board was at rest:
+
+    python calib.py output/data3.rec --board 00a1b2c3
+
+The fit accumulates its normal equations in chunks, so recordings of
+millions of samples are fitted without loading them at once. The result
+is stored in calibration.json, keyed by board ID; the chip ID the
+firmware prints at start-up serves as the board ID. OnlineEllipsoidFit
+refines one block further with recursive least squares as samples come
+in.
+"""
+
+import os
+import sys
+from math import radians
+from numpy import array, asarray, zeros, eye, diag, empty, cumsum, concatenate, float64, sqrt, outer
+from numpy.linalg import eigh, solve, LinAlgError
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration.json")
+
+SENSORS = {'acc': slice(0, 3), 'mag': slice(3, 6), 'rot': slice(6, 9)}
+
+# AK8963 axes in the MPU-9250 accelerometer/gyroscope frame.
+MAG_AXES = array([
+        [0,  1,  0],
+        [1,  0,  0],
+        [0,  0, -1]
+    ], dtype=float64)
+
+# Gyroscope scale at +-1000 dps.
+ROT_SCALE = radians(1000) / 32768.0
+
+class Calibration:
+    """Fused affine sensor model: calibrated = matrix @ raw + offset."""
+    def __init__(self, matrix=None, offset=None):
+        self.matrix = eye(9) if matrix is None else array(matrix, dtype=float64)
+        self.offset = zeros(9) if offset is None else array(offset, dtype=float64)
+
+    def copy(self):
+        return Calibration(self.matrix, self.offset)
+
+    def block(self, sensor):
+        """The 3x3 matrix and offset of one sensor."""
+        s = SENSORS[sensor]
+        return self.matrix[s, s].copy(), self.offset[s].copy()
+
+    def set_block(self, sensor, matrix, offset):
+        s = SENSORS[sensor]
+        self.matrix[s, s] = matrix
+        self.offset[s] = offset
+
+    def apply(self, values, dtype=float64):
+        """Calibrate one sample, giving acc, mag and rot column vectors of
+        dtype; the arithmetic is done in float64."""
+        v = (self.matrix @ asarray(values, dtype=float64) + self.offset).astype(dtype, copy=False)[:, None]
+        return v[0:3], v[3:6], v[6:9]
+
+    def apply_batch(self, raw, dtype=float64):
+        """Calibrate an (N, 9) array of samples, giving an array of dtype."""
+        return (asarray(raw, dtype=float64) @ self.matrix.T + self.offset).astype(dtype, copy=False)
+
+    def to_dict(self):
+        return {name: {'matrix': m.tolist(), 'offset': b.tolist()}
+                for name, (m, b) in ((name, self.block(name)) for name in SENSORS)}
+
+    @classmethod
+    def from_dict(cls, d):
+        cal = cls()
+        for name in SENSORS:
+            cal.set_block(name, d[name]['matrix'], d[name]['offset'])
+        return cal
+
+def default_calibration():
+    """The calibration of the original development board."""
+    cal = Calibration()
+
+    accb = array([-547.0262, -96.7392, 92.4361])
+    accg = array([16421, 16454, 16611]) / 2
+    cal.set_block('acc', diag(1 / accg), -accb / accg)
+
+    magb = array([78.1810, 60.9789, -21.9482])
+    magg = array([323.9201, 320.9182, 321.4008])
+    A = diag(1 / magg) @ MAG_AXES
+    cal.set_block('mag', A, -A @ magb)
+
+    rotb = array([-0.6874, -39.7461, -19.8377])
+    cal.set_block('rot', ROT_SCALE * eye(3), -ROT_SCALE * rotb)
+    return cal
+
+DEFAULT = default_calibration()
+
+# -----------------------------------------------------------------------------
+
+def _design(u):
+    """Rows [x^2, y^2, z^2, 2xy, 2xz, 2yz, 2x, 2y, 2z] of the ellipsoid
+    equation for an (N, 3) array of points."""
+    x, y, z = u[:, 0], u[:, 1], u[:, 2]
+    D = empty((len(u), 9))
+    D[:, 0], D[:, 1], D[:, 2] = x*x, y*y, z*z
+    D[:, 3], D[:, 4], D[:, 5] = 2*x*y, 2*x*z, 2*y*z
+    D[:, 6:9] = 2 * u
+    return D
+
+def ellipsoid_transform(theta):
+    """The affine map (A, b) that takes the ellipsoid theta . design = 1
+    onto the unit sphere, with A symmetric positive definite."""
+    M = array([
+            [theta[0], theta[3], theta[4]],
+            [theta[3], theta[1], theta[5]],
+            [theta[4], theta[5], theta[2]]
+        ])
+    c = -solve(M, theta[6:9])
+    k = 1.0 + c @ M @ c
+    w, V = eigh(M / k)
+    if k <= 0.0 or w.min() <= 0.0:
+        raise LinAlgError("fitted quadric is not an ellipsoid")
+    A = (V * sqrt(w)) @ V.T
+    return A, -A @ c
+
+def fit_ellipsoid(points, chunk=1 << 20):
+    """Least-squares ellipsoid through an (N, 3) array of points, as the
+    affine map (A, b) that takes it onto the unit sphere."""
+    N = zeros((9, 9))
+    r = zeros(9)
+    for i in range(0, len(points), chunk):
+        D = _design(asarray(points[i:i+chunk], dtype=float64))
+        N += D.T @ D
+        r += D.sum(axis=0)
+    return ellipsoid_transform(solve(N, r))
+
+def rest_mask(rot, window=25, threshold=4.0):
+    """Samples of an (N, 3) array of raw gyroscope values taken while the
+    board was at rest: the standard deviation over the window around
+    them is below threshold on every axis."""
+    rot = asarray(rot, dtype=float64)
+    n = len(rot)
+    if n < window:
+        return zeros(n, dtype=bool)
+    s1 = cumsum(concatenate((zeros((1, 3)), rot)), axis=0)
+    s2 = cumsum(concatenate((zeros((1, 3)), rot * rot)), axis=0)
+    mean = (s1[window:] - s1[:-window]) / window
+    var = (s2[window:] - s2[:-window]) / window - mean * mean
+    still = (var < threshold**2).all(axis=1)
+    mask = zeros(n, dtype=bool)
+    mask[window//2:window//2 + len(still)] = still
+    return mask
+
+class _AffineView:
+    """Lazily apply u = A x + b to slices of an (N, 3) array, so that
+    fit_ellipsoid() never holds more than one chunk."""
+    def __init__(self, points, A, b):
+        self._points, self._A, self._b = points, A, b
+
+    def __len__(self):
+        return len(self._points)
+
+    def __getitem__(self, s):
+        return asarray(self._points[s], dtype=float64) @ self._A.T + self._b
+
+def fit(raw, base=None, min_rest=100):
+    """Fit a calibration to an (N, 9) array of raw samples.
+
+    The fits are done on samples already calibrated by base (by default
+    the development board's calibration), which keeps the least-squares
+    problem well conditioned, and composed with it. The accelerometer is
+    fitted to the samples at rest if there are at least min_rest of them.
+    """
+    base = base or DEFAULT
+    raw = asarray(raw)
+    cal = base.copy()
+
+    rest = rest_mask(raw[:, 6:9])
+    acc = raw[rest, 0:3] if rest.sum() >= min_rest else raw[:, 0:3]
+
+    for name, points in (('acc', acc), ('mag', raw[:, 3:6])):
+        A0, b0 = base.block(name)
+        A1, b1 = fit_ellipsoid(_AffineView(points, A0, b0))
+        cal.set_block(name, A1 @ A0, A1 @ b0 + b1)
+
+    if rest.any():
+        A, _ = base.block('rot')
+        bias = raw[rest, 6:9].astype(float64).mean(axis=0)
+        cal.set_block('rot', A, -A @ bias)
+
+    return cal
+
+# -----------------------------------------------------------------------------
+
+class OnlineEllipsoidFit:
+    """Recursive least-squares refinement of the acc or mag block.
+
+    Each update() adds one raw sample to an exponentially forgetting
+    ellipsoid fit in the coordinates of the calibration as it was when
+    the fit started, and every refresh samples the refined block is
+    written back into the calibration.
+    """
+    def __init__(self, calibration, sensor='mag', forgetting=0.9995, refresh=50, prior=1e-2):
+        self.calibration = calibration
+        self._sensor = SENSORS[sensor]
+        self._name = sensor
+        self._A0, self._b0 = calibration.block(sensor)
+        self._theta = array([1.0, 1.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        self._P = eye(9) * prior
+        self._lambda = forgetting
+        self._refresh = refresh
+        self.updates = 0
+
+    def update(self, values):
+        """Add the raw values of one sample."""
+        u = self._A0 @ asarray(values[self._sensor], dtype=float64) + self._b0
+        phi = _design(u[None])[0]
+        Pphi = self._P @ phi
+        k = Pphi / (self._lambda + phi @ Pphi)
+        self._theta += k * (1.0 - phi @ self._theta)
+        self._P = (self._P - outer(k, Pphi)) / self._lambda
+        self.updates += 1
+        if self.updates % self._refresh == 0:
+            self.commit()
+
+    def commit(self):
+        """Write the refined block into the calibration; a fit that is not
+        (yet) an ellipsoid leaves it unchanged."""
+        try:
+            A1, b1 = ellipsoid_transform(self._theta)
+        except LinAlgError:
+            return False
+        self.calibration.set_block(self._name, A1 @ self._A0, A1 @ self._b0 + b1)
+        return True
+
+# -----------------------------------------------------------------------------
+
+def load_calibration(board, path=CACHE_PATH):
+    """The stored calibration of a board, or the default one."""
+    if board is not None and os.path.exists(path):
+        import json
+        with open(path) as f:
+            boards = json.load(f)
+        if board in boards:
+            return Calibration.from_dict(boards[board])
+    return DEFAULT.copy()
+
+def store_calibration(board, cal, path=CACHE_PATH):
+    """Store the calibration of a board, keeping those of the others."""
+    import json
+    boards = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            boards = json.load(f)
+    boards[board] = cal.to_dict()
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(boards, f, indent=2)
+    os.replace(tmp, path)
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Fit the sensor calibration of a board to a recording.")
+    parser.add_argument('recording')
+    parser.add_argument('--board', required=True, help="board ID to store the calibration under")
+    parser.add_argument('--cache', default=CACHE_PATH, help="calibration file")
+    args = parser.parse_args(argv)
+
+    from recording import Recording
+    raw = Recording(args.recording).raw
+    cal = fit(raw, load_calibration(args.board, args.cache))
+
+    u = cal.apply_batch(raw)
+    for name in ('acc', 'mag'):
+        norms = sqrt((u[:, SENSORS[name]] ** 2).sum(axis=1))
+        print("%s: |v| = %.4f +- %.4f" % (name, norms.mean(), norms.std()))
+    store_calibration(args.board, cal, args.cache)
+    print("Stored calibration of %s in %s" % (args.board, args.cache))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
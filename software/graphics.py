@@ -4,21 +4,83 @@ import ctypes
 import pygame, pygame.locals
 import numpy as np
 import numpyx as npx
+import meshes
+from history import History
 from math import *
 
 class Graph:
-    def __init__(self):
-        self._values = np.zeros(512, dtype=np.float32)
+    """Ring buffer of the latest samples of a plotted series.
+
+    _head is the slot the next sample goes into (and so also the oldest
+    sample), and _count the number of samples ever added, which lets the
+    renderer upload only what changed since the previous frame.
+
+    Unless history is False, every sample is also kept in a History (see
+    history.py) for drawing long windows. Samples pass into it from the
+    ring in batches, when it is asked for or the ring is about to wrap.
+    """
+    def __init__(self, size=512, history=True):
+        self._values = np.zeros(size, dtype=np.float32)
+        self._head = 0
+        self._count = 0
+        self._history = History() if history else None
+        self._flushed = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def values(self):
+        """Samples in order from oldest to newest."""
+        return np.roll(self._values, -self._head)
+
+    @property
+    def count(self):
+        """Number of samples ever added."""
+        return self._count
+
+    @property
+    def history(self):
+        """Every sample added, or None if not kept."""
+        self._flush()
+        return self._history
+
+    def _flush(self):
+        n = self._count - self._flushed
+        if self._history is not None and n > 0:
+            size = len(self._values)
+            self._history.extend(self._values[(self._head - n + np.arange(n)) % size])
+            self._flushed = self._count
 
     def add(self, value):
-        self._values = np.roll(self._values, -1)
-        self._values[-1] = value
+        if self._count - self._flushed == len(self._values):
+            self._flush()
+        self._values[self._head] = value
+        self._head = (self._head + 1) % len(self._values)
+        self._count += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        if self._history is not None:
+            self._flush()
+            self._history.extend(values)
+            self._flushed = self._count + len(values)
+        size = len(self._values)
+        n = len(values)
+        i = (self._head + np.arange(n - min(n, size), n)) % size
+        self._values[i] = values[-size:]
+        self._head = (self._head + n) % size
+        self._count += n
 
 class Mesh:
-    def __init__(self, context, vao, ntris):
+    """Indexed triangles in GPU buffers; index_type is the GL type of the
+    indices."""
+    def __init__(self, context, vao, ntris, instanced_vao=None, index_type=GL.GL_UNSIGNED_SHORT):
         self.context = context
         self.vao = vao
+        self.instanced_vao = instanced_vao
         self.ntris = ntris
+        self.index_type = index_type
 
 class Texture:
     def __init__(self, texture):
@@ -28,9 +90,8 @@ class Renderer:
     _MESH_VERTEX_SHADER = """
         #version 130
 
-        in vec4 position;
-        in vec4 normal;
-        in vec4 color;
+        in vec3 position;
+        in vec3 normal;
         uniform mat4 WorldFromObject;
         uniform mat4 ViewFromWorld;
         uniform mat4 ScreenFromView;
@@ -38,10 +99,32 @@ class Renderer:
 
         void main()
         {
-            float refl = abs(dot(ViewFromWorld * WorldFromObject * normal, vec4(0.0,0.0,-1.0,0.0))) * 0.8 + 0.2;
+            float refl = abs(dot(ViewFromWorld * WorldFromObject * vec4(normal, 0.0), vec4(0.0,0.0,-1.0,0.0))) * 0.8 + 0.2;
 
-            gl_Position = ScreenFromView * ViewFromWorld * WorldFromObject * position;
-            gl_FrontColor = refl * TintColor * color;
+            gl_Position = ScreenFromView * ViewFromWorld * WorldFromObject * vec4(position, 1.0);
+            gl_FrontColor = vec4(refl * TintColor.rgb, 0.0);
+        }
+        """
+
+    # Same as the mesh shader, but with the object transform, tint and
+    # projection (including the placement of the instance's viewport
+    # within the window) given per instance.
+    _MESH_INSTANCED_VERTEX_SHADER = """
+        #version 130
+
+        in vec3 position;
+        in vec3 normal;
+        in mat4 WorldFromObject;
+        in mat4 ScreenFromView;
+        in vec4 TintColor;
+        uniform mat4 ViewFromWorld;
+
+        void main()
+        {
+            float refl = abs(dot(ViewFromWorld * WorldFromObject * vec4(normal, 0.0), vec4(0.0,0.0,-1.0,0.0))) * 0.8 + 0.2;
+
+            gl_Position = ScreenFromView * ViewFromWorld * WorldFromObject * vec4(position, 1.0);
+            gl_FrontColor = vec4(refl * TintColor.rgb, 0.0);
         }
         """
 
@@ -54,18 +137,46 @@ class Renderer:
         }
         """
 
+    # Graph values of all series live in one buffer. Each series has a
+    # slot of 2*Size values holding its ring buffer twice in a row, so the
+    # latest Size samples are always contiguous starting at the ring head.
     _POLYLINE_VERTEX_SHADER = """
         #version 130
 
-        in float time;
         in float value;
-        uniform vec4 Color;
-        uniform mat4 Transform;
+        uniform int Size;
+        uniform int Start[16];
+        uniform vec4 Color[16];
+        uniform mat4 Transform[16];
 
         void main()
         {
-            gl_Position = Transform * vec4(time, value, 0.0, 1.0);
-            gl_FrontColor = Color;
+            int series = gl_VertexID / (2 * Size);
+            int index = gl_VertexID - series * 2 * Size - Start[series];
+            float time = 2.0 * float(index) / float(Size - 1) - 1.0;
+            gl_Position = Transform[series] * vec4(time, value, 0.0, 1.0);
+            gl_FrontColor = Color[series];
+        }
+        """
+
+    GRAPH_SIZE = 512
+    MAX_GRAPHS = 16
+
+    # Long windows of graph history are drawn as min/max envelopes: two
+    # points per column, in graph coordinates (x from -1 to 1), with the
+    # series index in z.
+    _ENVELOPE_VERTEX_SHADER = """
+        #version 130
+
+        in vec3 point;
+        uniform vec4 Color[16];
+        uniform mat4 Transform[16];
+
+        void main()
+        {
+            int series = int(point.z);
+            gl_Position = Transform[series] * vec4(point.xy, 0.0, 1.0);
+            gl_FrontColor = Color[series];
         }
         """
 
@@ -120,16 +231,43 @@ class Renderer:
             OpenGL.GL.shaders.compileShader(self._MESH_FRAGMENT_SHADER, GL.GL_FRAGMENT_SHADER)
         )
 
+        self._instanced_shader = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(self._MESH_INSTANCED_VERTEX_SHADER, GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(self._MESH_FRAGMENT_SHADER, GL.GL_FRAGMENT_SHADER)
+        )
+
         self._graph_shader = OpenGL.GL.shaders.compileProgram(
             OpenGL.GL.shaders.compileShader(self._POLYLINE_VERTEX_SHADER, GL.GL_VERTEX_SHADER),
             OpenGL.GL.shaders.compileShader(self._POLYLINE_FRAGMENT_SHADER, GL.GL_FRAGMENT_SHADER)
         )
 
+        self._envelope_shader = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(self._ENVELOPE_VERTEX_SHADER, GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(self._POLYLINE_FRAGMENT_SHADER, GL.GL_FRAGMENT_SHADER)
+        )
+
         self._blit_shader = OpenGL.GL.shaders.compileProgram(
             OpenGL.GL.shaders.compileShader(self._BLIT_VERTEX_SHADER, GL.GL_VERTEX_SHADER),
             OpenGL.GL.shaders.compileShader(self._BLIT_FRAGMENT_SHADER, GL.GL_FRAGMENT_SHADER)
         )
 
+        self._object_uniforms = _uniform_locations(self._object_shader,
+            'WorldFromObject', 'ViewFromWorld', 'ScreenFromView', 'TintColor')
+        self._instanced_uniforms = _uniform_locations(self._instanced_shader, 'ViewFromWorld')
+        self._graph_uniforms = _uniform_locations(self._graph_shader,
+            'Size', 'Start', 'Color', 'Transform')
+        self._envelope_uniforms = _uniform_locations(self._envelope_shader, 'Color', 'Transform')
+        self._blit_uniforms = _uniform_locations(self._blit_shader, 'sampler')
+
+        # The view and projection uniforms are only uploaded to a program
+        # when they have changed since it last used them.
+        self._object_stale = set()
+        self._instanced_stale = set()
+
+        self._width = width
+        self._height = height
+        self._instance_vbo = GL.glGenBuffers(1)
+
         self._blit_vbo = GL.glGenBuffers(1)
         self._blit_vao = GL.glGenVertexArrays(1)
 
@@ -144,23 +282,30 @@ class Renderer:
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
         GL.glBindVertexArray(0)
 
-        self._graph_time_vbo = GL.glGenBuffers(1)
         self._graph_value_vbo = GL.glGenBuffers(1)
         self._graph_vao = GL.glGenVertexArrays(1)
+        self._graph_slots = {}
+        self._graph_uploaded = []
 
         GL.glBindVertexArray(self._graph_vao)
-        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._graph_time_vbo)
-        GL.glBufferData(GL.GL_ARRAY_BUFFER, 4*512, np.linspace(-1,1,512,dtype=np.float32), GL.GL_STATIC_DRAW)
-        index = GL.glGetAttribLocation(self._graph_shader, 'time')
-        GL.glEnableVertexAttribArray(index)
-        GL.glVertexAttribPointer(index, 1, GL.GL_FLOAT, False, 0, ctypes.c_void_p(0))
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._graph_value_vbo)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, 4*2*self.GRAPH_SIZE*self.MAX_GRAPHS, None, GL.GL_DYNAMIC_DRAW)
         index = GL.glGetAttribLocation(self._graph_shader, 'value')
         GL.glEnableVertexAttribArray(index)
         GL.glVertexAttribPointer(index, 1, GL.GL_FLOAT, False, 0, ctypes.c_void_p(0))
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
         GL.glBindVertexArray(0)
 
+        self._envelope_vbo = GL.glGenBuffers(1)
+        self._envelope_vao = GL.glGenVertexArrays(1)
+        GL.glBindVertexArray(self._envelope_vao)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._envelope_vbo)
+        index = GL.glGetAttribLocation(self._envelope_shader, 'point')
+        GL.glEnableVertexAttribArray(index)
+        GL.glVertexAttribPointer(index, 3, GL.GL_FLOAT, False, 12, ctypes.c_void_p(0))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        GL.glBindVertexArray(0)
+
         self.set_viewport(0,0,512,512)
 
     def set_viewport(self, x, y, w, h):
@@ -177,9 +322,36 @@ class Renderer:
             ], dtype=np.float32)
 
         GL.glViewport(x, y, w, h)
+        self._viewport = (x, y, w, h)
+        self._object_stale.add('ScreenFromView')
 
     def set_view_matrix(self, matrix):
         self._view_matrix = matrix
+        self._object_stale.add('ViewFromWorld')
+        self._instanced_stale.add('ViewFromWorld')
+
+    def screen_matrices(self, viewports):
+        """Projection matrices for drawing into the given (n, 4) array of
+        x, y, w, h viewports while the whole window is the GL viewport."""
+        zn = 100.0
+        zf = 1000.0
+        x, y, w, h = np.asarray(viewports, dtype=np.float32).T
+        pw = np.minimum(w / h, 1.0)
+        ph = np.minimum(h / w, 1.0)
+
+        # Projection as in set_viewport(), then scaled and shifted from
+        # the full window onto the viewport.
+        sx, sy = w / self._width, h / self._height
+        ox, oy = (2*x + w) / self._width - 1, (2*y + h) / self._height - 1
+        m = np.zeros((len(x), 4, 4), dtype=np.float32)
+        m[:, 0, 0] = sx * 2*zn/pw
+        m[:, 0, 2] = ox * zn*zf/(zn-zf)
+        m[:, 1, 1] = sy * 2*zn/ph
+        m[:, 1, 2] = oy * zn*zf/(zn-zf)
+        m[:, 2, 2] = zf/(zn-zf)
+        m[:, 2, 3] = -1
+        m[:, 3, 2] = zn*zf/(zn-zf)
+        return m
 
     def create_texture(self, width, height, data):
         texture = GL.glGenTextures(1)
@@ -193,39 +365,75 @@ class Renderer:
 
         return Texture(texture)
 
-    def create_mesh(self, vertices):
+    def update_texture(self, texture, width, height, data):
+        """Replace the RGB contents of a texture of the same size."""
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture.texture)
+        GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, data)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def create_mesh(self, vertices, indices):
+        """Upload an indexed mesh (see meshes.py): an (n, 6) array of
+        positions and normals and an (m, 3) array of triangle indices."""
+        vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+        indices = np.ascontiguousarray(indices)
+        index_type = GL.GL_UNSIGNED_SHORT if indices.dtype == np.uint16 else GL.GL_UNSIGNED_INT
+        indices = indices.astype(np.uint16 if index_type == GL.GL_UNSIGNED_SHORT else np.uint32, copy=False)
+
+        vbo = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, vbo)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+        ebo = GL.glGenBuffers(1)
+
+        # The element buffer binding is part of the vertex array state, so
+        # it is bound into both vertex arrays.
         vao = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(vao)
 
-        data = np.array(vertices, dtype=np.float32)
+        GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, ebo)
+        GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL.GL_STATIC_DRAW)
 
-        vbo = GL.glGenBuffers(1)
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, vbo)
-        GL.glBufferData(GL.GL_ARRAY_BUFFER, len(data) * 4, data, GL.GL_STATIC_DRAW)
+        for name, offset in (('position', 0), ('normal', 12)):
+            loc = GL.glGetAttribLocation(self._object_shader, name)
+            GL.glEnableVertexAttribArray(loc)
+            GL.glVertexAttribPointer(loc, 3, GL.GL_FLOAT, False, 24, ctypes.c_void_p(offset))
 
-        loc = GL.glGetAttribLocation(self._object_shader, 'position')
-        GL.glEnableVertexAttribArray(loc)
-        GL.glVertexAttribPointer(loc, 4, GL.GL_FLOAT, False, 48, ctypes.c_void_p(0))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
-        loc = GL.glGetAttribLocation(self._object_shader, 'normal')
-        GL.glEnableVertexAttribArray(loc)
-        GL.glVertexAttribPointer(loc, 4, GL.GL_FLOAT, False, 48, ctypes.c_void_p(16))
+        GL.glBindVertexArray(0)
+
+        # A second vertex array for instanced drawing, with the per-instance
+        # attributes sourced from the shared instance buffer.
+        instanced_vao = GL.glGenVertexArrays(1)
+        GL.glBindVertexArray(instanced_vao)
 
-        loc = GL.glGetAttribLocation(self._object_shader, 'color')
-        GL.glEnableVertexAttribArray(loc)
-        GL.glVertexAttribPointer(loc, 4, GL.GL_FLOAT, False, 48, ctypes.c_void_p(32))
+        GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, ebo)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, vbo)
+        for name, offset in (('position', 0), ('normal', 12)):
+            loc = GL.glGetAttribLocation(self._instanced_shader, name)
+            GL.glEnableVertexAttribArray(loc)
+            GL.glVertexAttribPointer(loc, 3, GL.GL_FLOAT, False, 24, ctypes.c_void_p(offset))
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._instance_vbo)
+        for name, offset, columns in (('WorldFromObject', 0, 4), ('ScreenFromView', 64, 4), ('TintColor', 128, 1)):
+            loc = GL.glGetAttribLocation(self._instanced_shader, name)
+            for i in range(columns):
+                GL.glEnableVertexAttribArray(loc + i)
+                GL.glVertexAttribPointer(loc + i, 4, GL.GL_FLOAT, False, 144, ctypes.c_void_p(offset + 16*i))
+                GL.glVertexAttribDivisor(loc + i, 1)
 
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
         GL.glBindVertexArray(0)
 
-        return vao
+        return Mesh(self, vao, len(indices), instanced_vao, index_type)
 
     def draw_texture(self, texture, x0, y0, x1, y1):
         GL.glUseProgram(self._blit_shader)
 
-        index = GL.glGetUniformLocation(self._blit_shader, "sampler");
-        GL.glProgramUniform1i(self._blit_shader, index, 0);
+        GL.glUniform1i(self._blit_uniforms['sampler'], 0)
         GL.glActiveTexture(GL.GL_TEXTURE0)
         GL.glBindTexture(GL.GL_TEXTURE_2D, texture.texture)
 
@@ -255,135 +463,202 @@ class Renderer:
     def draw_mesh(self, obj, xform, tint=npx.vec4(1.0,1.0,1.0,1.0)):
         GL.glUseProgram(self._object_shader)
 
-        index = GL.glGetUniformLocation(self._object_shader, 'WorldFromObject')
-        GL.glUniformMatrix4fv(index, 1, True, xform)
-
-        index = GL.glGetUniformLocation(self._object_shader, 'ViewFromWorld')
-        GL.glUniformMatrix4fv(index, 1, True, self._view_matrix)
-
-        index = GL.glGetUniformLocation(self._object_shader, 'ScreenFromView')
-        GL.glUniformMatrix4fv(index, 1, True, self._projection_matrix)
-
-        index = GL.glGetUniformLocation(self._object_shader, 'TintColor')
-        GL.glUniform4fv(index, 1, tint)
+        uniforms = self._object_uniforms
+        GL.glUniformMatrix4fv(uniforms['WorldFromObject'], 1, True, xform)
+        if 'ViewFromWorld' in self._object_stale:
+            GL.glUniformMatrix4fv(uniforms['ViewFromWorld'], 1, True, self._view_matrix)
+        if 'ScreenFromView' in self._object_stale:
+            GL.glUniformMatrix4fv(uniforms['ScreenFromView'], 1, True, self._projection_matrix)
+        self._object_stale.clear()
+        GL.glUniform4fv(uniforms['TintColor'], 1, tint)
 
         GL.glBindVertexArray(obj.vao)
-        GL.glDrawArrays(GL.GL_TRIANGLES, 0, obj.ntris*3)
+        GL.glDrawElements(GL.GL_TRIANGLES, obj.ntris*3, obj.index_type, ctypes.c_void_p(0))
         GL.glBindVertexArray(0)
 
         GL.glUseProgram(0)
 
-    def draw_graph(self, graph, color, transform=np.eye(4)):
-        GL.glUseProgram(self._graph_shader)
+    def draw_mesh_instanced(self, obj, xforms, tints, viewports):
+        """Draw n copies of a mesh in one call.
 
-        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._graph_value_vbo)
-        GL.glBufferData(GL.GL_ARRAY_BUFFER, 4*512, graph._values, GL.GL_STREAM_DRAW);
+        xforms is an (n, 4, 4) array of object transforms, tints an (n, 4)
+        array of tint colors and viewports an (n, 4) array of x, y, w, h
+        window rectangles to draw each copy into.
+        """
+        n = len(xforms)
+        instances = np.empty((n, 36), dtype=np.float32)
+        instances[:, 0:16] = np.asarray(xforms, dtype=np.float32).transpose(0, 2, 1).reshape(n, 16)
+        instances[:, 16:32] = self.screen_matrices(viewports).transpose(0, 2, 1).reshape(n, 16)
+        instances[:, 32:36] = np.asarray(tints, dtype=np.float32).reshape(n, 4)
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._instance_vbo)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, instances.nbytes, instances, GL.GL_STREAM_DRAW)
         GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
-        index = GL.glGetUniformLocation(self._graph_shader, 'Color')
-        GL.glUniform4fv(index, 1, color)
+        GL.glUseProgram(self._instanced_shader)
 
-        index = GL.glGetUniformLocation(self._graph_shader, 'Transform')
-        GL.glUniformMatrix4fv(index, 1, True, transform)
+        if 'ViewFromWorld' in self._instanced_stale:
+            GL.glUniformMatrix4fv(self._instanced_uniforms['ViewFromWorld'], 1, True, self._view_matrix)
+        self._instanced_stale.clear()
 
-        GL.glBindVertexArray(self._graph_vao)
-        GL.glDrawArrays(GL.GL_LINE_STRIP, 0, 512)
+        GL.glViewport(0, 0, self._width, self._height)
+        GL.glBindVertexArray(obj.instanced_vao)
+        GL.glDrawElementsInstanced(GL.GL_TRIANGLES, obj.ntris*3, obj.index_type, ctypes.c_void_p(0), n)
         GL.glBindVertexArray(0)
 
         GL.glUseProgram(0)
 
-    def clear(self):
-        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
-
-def lerp(t, a, b):
-    return (1 - t) * a + t * b
-
-def _make_frustum(segments, z1, r1, z2, r2):
-    vertices = []
-
-    angle = 360.0 / segments
-
-    for k in range(segments):
-        phi0 = radians(k*angle)
-        phi1 = radians((k+1)*angle)
-        theta = atan2(r1 - r2, z2 - z1)
-
-        if r2 > 0:
-            vertices.extend([
-                r2*cos(phi0), r2*sin(phi0), z2, 1.0,
-                cos(phi0)*cos(theta), sin(phi0)*cos(theta), sin(theta), 0.0,
-                1.0, 1.0, 1.0, 0.0,
-
-                r1*cos(phi0), r1*sin(phi0), z1, 1.0,
-                cos(phi0)*cos(theta), sin(phi0)*cos(theta), sin(theta), 0.0,
-                1.0, 1.0, 1.0, 0.0,
-
-                r2*cos(phi1), r2*sin(phi1), z2, 1.0,
-                cos(phi1)*cos(theta), sin(phi1)*cos(theta), sin(theta), 0.0,
-                1.0, 1.0, 1.0, 0.0
-            ])
-
-        if r1 > 0:
-            vertices.extend([
-                r2*cos(phi1), r2*sin(phi1), z2, 1.0,
-                cos(phi1)*cos(theta), sin(phi1)*cos(theta), sin(theta), 0.0,
-                1.0, 1.0, 1.0, 0.0,
-
-                r1*cos(phi0), r1*sin(phi0), z1, 1.0,
-                cos(phi0)*cos(theta), sin(phi0)*cos(theta), sin(theta), 0.0,
-                1.0, 1.0, 1.0, 0.0,
-
-                r1*cos(phi1), r1*sin(phi1), z1, 1.0,
-                cos(phi1)*cos(theta), sin(phi1)*cos(theta), sin(theta), 0.0,
-                1.0, 1.0, 1.0, 0.0
-            ])
-
-    return vertices
+    def _upload_graph(self, graph):
+        """Copy the samples added since the last upload into the graph's slot."""
+        size = self.GRAPH_SIZE
+        slot = self._graph_slots.get(graph)
+        if slot is None:
+            assert len(graph) == size and len(self._graph_slots) < self.MAX_GRAPHS
+            slot = self._graph_slots[graph] = len(self._graph_slots)
+            self._graph_uploaded.append(0)
+
+        n = min(graph._count - self._graph_uploaded[slot], size)
+        self._graph_uploaded[slot] = graph._count
+        if n <= 0:
+            return slot
+
+        end = graph._head
+        start = (end - n) % size
+        if start < end:
+            segments = [(start, end)]
+        else:
+            segments = [(start, size), (0, end)]
+
+        for a, b in segments:
+            if a == b:
+                continue
+            data = graph._values[a:b]
+            for base in (2*size*slot + a, 2*size*slot + size + a):
+                GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 4*base, 4*(b-a), data)
+
+        return slot
+
+    def draw_graphs(self, graphs, window=None):
+        """Draw a list of (graph, color, transform) series in one call.
+
+        Without a window the latest GRAPH_SIZE samples of each graph are
+        drawn; a window (start, stop) of sample indices is drawn from the
+        graphs' histories instead.
+        """
+        if window is not None:
+            self._draw_envelopes(graphs, window)
+            return
+        size = self.GRAPH_SIZE
+        n = len(graphs)
+
+        # The shader finds the series of a vertex from its slot in the
+        # buffer, so the per-series uniforms are indexed by slot.
+        starts = np.zeros(self.MAX_GRAPHS, dtype=np.int32)
+        colors = np.zeros((self.MAX_GRAPHS, 4), dtype=np.float32)
+        transforms = np.zeros((self.MAX_GRAPHS, 4, 4), dtype=np.float32)
+        firsts = np.empty(n, dtype=np.int32)
+        counts = np.full(n, size, dtype=np.int32)
 
-def create_sphere_mesh(context, radius):
-    segments = 24
-    angle = 180.0 / segments
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._graph_value_vbo)
+        for i, (graph, color, transform) in enumerate(graphs):
+            slot = self._upload_graph(graph)
+            starts[slot] = graph._head
+            colors[slot] = np.ravel(color)
+            transforms[slot] = transform
+            firsts[i] = 2*size*slot + graph._head
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
-    vertices = []
+        GL.glUseProgram(self._graph_shader)
 
-    for k in range(segments):
-        theta1 = radians(k*angle)
-        theta2 = radians((k+1)*angle)
+        uniforms = self._graph_uniforms
+        GL.glUniform1i(uniforms['Size'], size)
+        GL.glUniform1iv(uniforms['Start'], self.MAX_GRAPHS, starts)
+        GL.glUniform4fv(uniforms['Color'], self.MAX_GRAPHS, colors)
+        GL.glUniformMatrix4fv(uniforms['Transform'], self.MAX_GRAPHS, True, transforms)
 
-        r1 = radius * sin(theta1)
-        r2 = radius * sin(theta2)
-        z1 = radius * -cos(theta1)
-        z2 = radius * -cos(theta2)
+        GL.glBindVertexArray(self._graph_vao)
+        GL.glMultiDrawArrays(GL.GL_LINE_STRIP, firsts, counts, n)
+        GL.glBindVertexArray(0)
 
-        vertices.extend(_make_frustum(segments, z1, r1, z2, r2))
+        GL.glUseProgram(0)
 
-    vao = context.create_mesh(vertices)
-    ntris = len(vertices) // 36
+    def _draw_envelopes(self, graphs, window):
+        """Draw the window of each graph's history at the resolution of the
+        viewport, as the minimum and maximum of each pixel column."""
+        start, stop = window
+        width = self._viewport[2]
+        colors = np.zeros((self.MAX_GRAPHS, 4), dtype=np.float32)
+        transforms = np.zeros((self.MAX_GRAPHS, 4, 4), dtype=np.float32)
+        parts = []
+        counts = np.empty(len(graphs), dtype=np.int32)
+        for i, (graph, color, transform) in enumerate(graphs):
+            columns = max(int(ceil(abs(transform[0][0]) * width)), 1)
+            x, lo, hi = graph.history.envelope(start, stop, columns)
+            points = np.empty((len(x), 2, 3), dtype=np.float32)
+            points[:, :, 0] = (2 * (x - start) / (stop - start) - 1)[:, np.newaxis]
+            points[:, 0, 1] = lo
+            points[:, 1, 1] = hi
+            points[:, :, 2] = i
+            parts.append(points.reshape(-1, 3))
+            counts[i] = 2 * len(x)
+            colors[i] = np.ravel(color)
+            transforms[i] = transform
+        firsts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int32)
+        data = np.concatenate(parts)
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._envelope_vbo)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, data.nbytes, data, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
-    return Mesh(context, vao, ntris)
+        GL.glUseProgram(self._envelope_shader)
+        uniforms = self._envelope_uniforms
+        GL.glUniform4fv(uniforms['Color'], self.MAX_GRAPHS, colors)
+        GL.glUniformMatrix4fv(uniforms['Transform'], self.MAX_GRAPHS, True, transforms)
 
-def create_arrow_mesh(context, bottom=0.0, top=2.0):
-    sides = 24
+        GL.glBindVertexArray(self._envelope_vao)
+        GL.glMultiDrawArrays(GL.GL_LINE_STRIP, firsts, counts, len(graphs))
+        GL.glBindVertexArray(0)
 
-    vertices = []
+        GL.glUseProgram(0)
 
-    middle = lerp(0.8, bottom, top)
+    def draw_graph(self, graph, color, transform=np.eye(4), window=None):
+        """Draw one graph, as draw_graphs()."""
+        self.draw_graphs([(graph, color, transform)], window)
 
-    parts = [
-        (bottom, 0.00, bottom, 0.05),
-        (bottom, 0.05, middle, 0.05),
-        (middle, 0.05, middle, 0.20),
-        (middle, 0.20, top,    0.00)
-    ]
+    def clear(self):
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
 
-    for z1, r1, z2, r2 in parts:
-        vertices.extend(_make_frustum(sides, z1, r1, z2, r2))
+def _uniform_locations(program, *names):
+    return {name: GL.glGetUniformLocation(program, name) for name in names}
 
-    vao = context.create_mesh(vertices)
-    ntris = len(vertices) // 36
+def create_sphere_mesh(context, radius, segments=24):
+    vertices, indices = meshes.load('sphere', radius, segments)
+    return context.create_mesh(vertices, indices)
 
-    return Mesh(context, vao, ntris)
+def create_arrow_mesh(context, bottom=0.0, top=2.0, sides=24):
+    vertices, indices = meshes.load('arrow', bottom, top, sides)
+    return context.create_mesh(vertices, indices)
 
 def load_image_texture(context, path):
     return context.create_texture(1280, 640,
         pygame.image.tostring(pygame.image.load(path), 'RGB'))
+
+class TextPanel:
+    """Lines of monospaced text drawn into a texture, for overlays."""
+    def __init__(self, context, width, height, size=13, color=(220, 220, 220), background=(32, 32, 32)):
+        self._font = pygame.font.SysFont('monospace', size)
+        self._surface = pygame.Surface((width, height))
+        self._color = color
+        self._background = background
+        self.texture = context.create_texture(width, height, None)
+        self.set_lines(context, [])
+
+    def set_lines(self, context, lines):
+        """Render the lines and upload them to the texture."""
+        self._surface.fill(self._background)
+        y = 2
+        for line in lines:
+            self._surface.blit(self._font.render(line, True, self._color, self._background), (4, y))
+            y += self._font.get_linesize()
+        width, height = self._surface.get_size()
+        context.update_texture(self.texture, width, height, pygame.image.tostring(self._surface, 'RGB'))
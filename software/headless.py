@@ -0,0 +1,126 @@
+"""Run the orientation estimators without a window.
+
+Every sample from the board goes through the calibration models and all
+four estimators at the full sensor rate. The QuaternionESKF orientation
+is printed to stdout and, with --record, everything is written to a
+binary recording; with --publish the outputs of all four go to shared
+memory for other processes (see shmpub.py). With --render-fps the usual
+window is also drawn, at most that many times per second; without it
+pygame and OpenGL are never imported. The samples come from the board or
+any other source of sources.py; a recording given with --replay is run as
+fast as possible unless --speed says otherwise, with the same timing as
+the live run.
+"""
+
+import argparse
+import sys
+import time
+from numpy import float32, float64
+
+from tracker import Tracker, UpdateScheduler
+from recording import RecordingWriter, next_recording_path
+from sensorclock import SensorClock
+from calib import load_calibration
+import sources
+import timing
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sources.add_arguments(parser)
+    parser.set_defaults(speed=0.0)
+    parser.add_argument('--record', metavar='PATH', help="write a recording; 'auto' picks output/dataN.rec")
+    parser.add_argument('--quiet', action='store_true', help="do not print orientations to stdout")
+    parser.add_argument('--render-fps', type=float, default=0.0, help="also draw the window at this rate")
+    parser.add_argument('--board', help="board ID whose stored calibration to use")
+    parser.add_argument('--online-calibration', action='store_true', help="refine the magnetometer calibration while running")
+    parser.add_argument('--acc-period', type=float, default=0.0, help="minimum time between accelerometer updates")
+    parser.add_argument('--mag-period', type=float, default=0.0, help="minimum time between magnetometer updates")
+    parser.add_argument('--float32', action='store_true', help="run the estimators in single precision")
+    parser.add_argument('--publish', nargs='?', const='imu-orientation', metavar='NAME',
+        help="publish the estimator outputs to shared memory (see shmpub.py)")
+    parser.add_argument('--timing', metavar='PATH', help="write the timing histograms of the run (see timing.py) on exit")
+    return parser.parse_args(argv)
+
+def source_batches(source):
+    """Batches of samples from a source until it runs out."""
+    while True:
+        batch = source.read()
+        if len(batch[0]) == 0:
+            if source.done:
+                return
+            time.sleep(0.001)
+        yield batch
+
+def run(args, source):
+    tracker = Tracker(float32 if args.float32 else float64)
+    scheduler = UpdateScheduler(tracker, args.acc_period, args.mag_period,
+        calibration=load_calibration(args.board), online=args.online_calibration)
+
+    outfile = None
+    if args.record:
+        path = next_recording_path("output") if args.record == 'auto' else args.record
+        outfile = RecordingWriter(path)
+        print("Recording to %s" % path, file=sys.stderr)
+
+    publisher = None
+    if args.publish:
+        from shmpub import Publisher
+        publisher = Publisher(args.publish)
+        print("Publishing to shared memory %s" % args.publish, file=sys.stderr)
+
+    gui = None
+    if args.render_fps > 0:
+        import pygame
+        import main as gui
+        from graphics import Renderer
+        pygame.init()
+        gui.tracker = tracker
+        g = Renderer(1280, 640, "Orientation tracking")
+        gui.setup(g)
+        render_period = 1.0 / args.render_fps
+        render_time = 0.0
+
+    out = sys.stdout
+    clock = SensorClock()
+
+    try:
+        for times, stamps, samples in source_batches(source):
+            for host_time, stamp, values in zip(times, stamps, samples):
+                t, dt = clock.update(stamp, host_time)
+                acc, mag, rot = scheduler.run(t, dt, values)
+
+                if publisher:
+                    publisher.publish(tracker, t, host_time)
+                if outfile:
+                    outfile.write(host_time, values, stamp, **tracker.matrices())
+                if gui:
+                    gui.update_graphs(acc, mag, rot)
+                if not args.quiet:
+                    q = tracker.qeskf._q[:, 0]
+                    out.write("%.6f %.6f %.6f %.6f %.6f\n" % (t, q[0], q[1], q[2], q[3]))
+
+            if gui:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        return
+                now = time.time()
+                if now - render_time >= render_period:
+                    render_time = now
+                    gui.draw_frame(g)
+    finally:
+        if outfile:
+            outfile.close()
+        if publisher:
+            publisher.close()
+        if gui:
+            pygame.quit()
+        if args.timing:
+            timing.dump(args.timing)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    try:
+        with sources.from_arguments(args) as source:
+            run(args, source)
+    except KeyboardInterrupt:
+        pass
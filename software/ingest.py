@@ -0,0 +1,148 @@
+import threading
+import time
+from numpy import empty, arange, nan, float64
+from wire import PacketDecoder
+
+class SampleRing:
+    """Single-producer, single-consumer ring buffer of timestamped samples.
+
+    Each sample carries the host time at which it was read and the stamp
+    the board gave it (NaN if the board sends none).
+
+    The producer only ever advances the head and the consumer only ever
+    advances the tail, so neither side needs a lock: a sample is written
+    into its slot before the head is moved past it. When the ring is full
+    the newest sample is dropped and counted as an overrun.
+    """
+    def __init__(self, capacity, width=9):
+        self._time = empty(capacity, dtype=float64)
+        self._stamp = empty(capacity, dtype=float64)
+        self._data = empty((capacity, width), dtype=float64)
+        self._head = 0
+        self._tail = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return self._head - self._tail
+
+    @property
+    def capacity(self):
+        return len(self._time)
+
+    def push(self, t, stamp, values):
+        """Append one sample (producer side)."""
+        head = self._head
+        if head - self._tail >= len(self._time):
+            self.overruns += 1
+            return False
+        i = head % len(self._time)
+        self._time[i] = t
+        self._stamp[i] = stamp
+        self._data[i] = values
+        self._head = head + 1
+        return True
+
+    def push_many(self, t, stamps, values):
+        """Append a batch of samples read at host time t (producer side).
+
+        Samples that do not fit are dropped and counted as overruns.
+        Returns the number of samples stored.
+        """
+        n = len(self._time)
+        head = self._head
+        k = min(len(values), n - (head - self._tail))
+        self.overruns += len(values) - k
+        if k == 0:
+            return 0
+        i = (head + arange(k)) % n
+        self._time[i] = t
+        self._stamp[i] = stamps[:k]
+        self._data[i] = values[:k]
+        self._head = head + k
+        return k
+
+    def drain(self):
+        """Remove and return all pending samples (consumer side).
+
+        Returns (n,) arrays of host times and board stamps and an
+        (n, width) array of sample values.
+        """
+        tail, head = self._tail, self._head
+        n = len(self._time)
+        i0, i1 = tail % n, head % n
+        if head == tail or i0 < i1:
+            times = self._time[i0:i1].copy()
+            stamps = self._stamp[i0:i1].copy()
+            data = self._data[i0:i1].copy()
+        else:
+            times = self._time.take(range(i0, i1 + n), mode='wrap')
+            stamps = self._stamp.take(range(i0, i1 + n), mode='wrap')
+            data = self._data.take(range(i0, i1 + n), axis=0, mode='wrap')
+        self._tail = head
+        return times, stamps, data
+
+class SerialReader(threading.Thread):
+    """Background thread that parses samples from a serial port.
+
+    The board either prints a line per sample, of its microsecond time
+    and nine integers, or, with binary=True, sends the framed packets of
+    wire.py. Each sample is stored in the ring together with the host
+    time at which it was read. Lines of nine integers from older
+    firmware are accepted and get a NaN stamp. Text lines that do not
+    parse are counted in dropped, and packets missing from the binary
+    sequence in lost.
+    """
+    def __init__(self, port, ring, binary=False):
+        super().__init__(daemon=True)
+        self._port = port
+        self._ring = ring
+        self._decoder = PacketDecoder() if binary else None
+        self._quit = threading.Event()
+        self.received = 0
+        self.dropped = 0
+
+    @property
+    def overruns(self):
+        return self._ring.overruns
+
+    @property
+    def lost(self):
+        return self._decoder.lost if self._decoder else 0
+
+    def stop(self):
+        self._quit.set()
+
+    def run(self):
+        if self._decoder:
+            self._run_binary()
+        else:
+            self._run_text()
+
+    def _run_binary(self):
+        while not self._quit.is_set():
+            data = self._port.read(self._port.in_waiting or 1)
+            if not data:
+                continue
+            t = time.time()
+            seq, stamps, samples = self._decoder.feed(data)
+            self.received += len(samples)
+            self._ring.push_many(t, stamps, samples)
+
+    def _run_text(self):
+        while not self._quit.is_set():
+            line = self._port.readline()
+            if not line:
+                continue
+            t = time.time()
+            fields = line.strip().split(b' ')
+            if len(fields) not in (9, 10):
+                self.dropped += 1
+                continue
+            try:
+                values = list(map(float, fields))
+            except ValueError:
+                self.dropped += 1
+                continue
+            stamp = values.pop(0) if len(values) == 10 else nan
+            self.received += 1
+            self._ring.push(t, stamp, values)
@@ -1,34 +1,45 @@
+import argparse
 import time
 import sys
 import os
 import pygame
-import serial
 
 from math import pi, sin, cos, acos, degrees, radians, sqrt
-from numpy import array, block, zeros, float32, concatenate
+from numpy import array, block, zeros, eye, tile, repeat, newaxis, float32
 from numpy.linalg import det, norm
 from numpyx import vec3, vec4, tmatxyz, rmatxyz, xmat, mat3to4, mat2wnd
 
-from graphics import Renderer, Graph
+from graphics import Renderer, Graph, TextPanel
 from graphics import create_arrow_mesh, create_sphere_mesh, load_image_texture
-from qeskf import QuaternionESKF
-from vekf import VectorEKF
-from qint import QuaternionIntegrator
+from history import View
+from tracker import Tracker, UpdateScheduler
+from recording import RecordingWriter, next_recording_path
+from sensorclock import SensorClock
+from calib import load_calibration
+import sources
+import timing
 
 # -----------------------------------------------------------------------------
 
-NAV_G = vec3(0.0, 0.0, -1.0)
-NAV_M = vec3(0.0, sin(radians(17)), -cos(radians(17)))
+# Set to False for boards built with MPU9250_OUTPUT_BINARY 0.
+BINARY_PROTOCOL = True
+
+# Chip ID the board prints at start-up, to look up its calibration in
+# calibration.json (see calib.py); None uses the default calibration.
+BOARD_ID = None
 
 arrow_mesh = None
 sphere_mesh = None
 background = None
+timing_panel = None
+show_timing = False
 
-qeskf = QuaternionESKF(gn = NAV_G, mn = NAV_M)
-qint = QuaternionIntegrator()
+# Window onto the graphs' histories (see history.py), or None to draw the
+# latest samples.
+graph_view = None
 
-mag_vekf = VectorEKF(1.0)
-acc_vekf = VectorEKF(1.0)
+tracker = Tracker()
+scheduler = UpdateScheduler(tracker, calibration=load_calibration(BOARD_ID))
 
 outfile = None
 
@@ -39,76 +50,74 @@ rotx_graph, roty_graph, rotz_graph = Graph(), Graph(), Graph()
 
 # -----------------------------------------------------------------------------
 
-def draw_triad(g, rotation):
-    """Draw an XYZ-triad using red, green and blue arrows."""
-    # X-axis arrow
-    transform = rotation @ rmatxyz(0,pi/2,0)
-    tint = vec4(1.0, 0.0, 0.0, 0.0)
-    g.draw_mesh(arrow_mesh, transform, tint)
-
-    # Y-axis arrow
-    transform = rotation @ rmatxyz(-pi/2,0,0)
-    tint = vec4(0.0, 1.0, 0.0, 0.0)
-    g.draw_mesh(arrow_mesh, transform, tint)
-
-    # Z-axis arrow
-    transform = rotation
-    tint = vec4(0.0, 0.0, 1.0, 0.0)
-    g.draw_mesh(arrow_mesh, transform, tint)
-
-    # Origin widget
-    transform = rotation
-    tint = vec4(1.0, 1.0, 1.0, 0.0)
-    g.draw_mesh(sphere_mesh, transform, tint)
-
-def orthonormalize(g, m):
-    """Create right-handed orthonormal frame out of g and m."""
-    ez = -g / (g.T @ g)**0.5
-    ex = xmat(m) @ ez
-    ex /= (ex.T @ ex)**0.5
-    ey = xmat(ez) @ ex
-    return mat3to4(block([[ ex, ey, ez ]]).T)
-
-def loop(g, dt, acc, mag, rot):
-    global outfile
+# Arrow transforms and tints of the X, Y and Z axes of a triad.
+TRIAD_AXES = array([rmatxyz(0,pi/2,0), rmatxyz(-pi/2,0,0), eye(4)])
+TRIAD_TINTS = array([[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0]])
+SPHERE_TINT = array([1.0, 1.0, 1.0, 0.0])
+
+# Viewport of the triad of each estimator.
+TRIAD_VIEWPORTS = {
+    'qeskf': (0, 0, 320, 320),
+    'vkf': (320, 0, 320, 320),
+    'accmag': (0, 300, 320, 320),
+    'gyro': (320, 300, 320, 320),
+}
+
+VIEW_MATRIX = tmatxyz(0, 0, -5) @ rmatxyz(-pi/2,0,0)
+
+# Timing overlay over the top of the graph panel, redrawn at most this
+# often.
+TIMING_PANEL_SIZE = (600, 260)
+TIMING_PANEL_RECT = (660.0 / 640 - 1, 1 - 270.0 / 320, 1260.0 / 640 - 1, 1 - 10.0 / 320)
+TIMING_REFRESH = 0.5
+
+# Timing spans of the stages of the main loop (see timing.py).
+FRAME_SPAN = timing.span('frame')
+EVENTS_SPAN = timing.span('events')
+INPUT_SPAN = timing.span('input')
+CLOCK_SPAN = timing.span('clock')
+RECORD_SPAN = timing.span('record')
+GRAPHS_SPAN = timing.span('graphs')
+DRAW_SPAN = timing.span('draw')
+FLIP_SPAN = timing.span('flip')
+
+def _graph_window(i, j=0):
+    x0 = (11 + 210*j - 320) / 320.0
+    x1 = (199 + 210*j - 320) / 320.0
+    y0 = (20 + 160*i - 320) / 320.0
+    y1 = (140 + 160*i - 320) / 320.0
+    return mat2wnd(x0, y0, x1, y1, sy=0.5)
+
+COV_WINDOW = mat2wnd(-0.96875, 0.1875, 0.9375, 0.9375, sy=50)
+GRAPH_WINDOWS = [[_graph_window(i, j) for j in range(3)] for i in range(3)]
+
+def draw_triads(g, rotations, viewports):
+    """Draw XYZ-triads using red, green and blue arrows, one per rotation
+    and viewport, with one draw call per mesh."""
+    n = len(rotations)
+
+    # Arrows
+    transforms = (rotations[:, newaxis] @ TRIAD_AXES).reshape(-1, 4, 4)
+    tints = tile(TRIAD_TINTS, (n, 1))
+    g.draw_mesh_instanced(arrow_mesh, transforms, tints, repeat(viewports, 3, axis=0))
+
+    # Origin widgets
+    g.draw_mesh_instanced(sphere_mesh, rotations, tile(SPHERE_TINT, (n, 1)), viewports)
+
+def update(host_time, stamp, t, dt, raw):
+    """Run the filters on one sample, record the results and update graphs."""
+    acc, mag, rot = scheduler.run(t, dt, raw)
 
-    # Set world-to-view matrix for mesh rendering.
-    g.set_view_matrix(tmatxyz(0, 0, -5) @ rmatxyz(-pi/2,0,0))
-
-    # Quaternion ESKF.
-    qeskf.step(dt, acc, mag, rot)
-    g.set_viewport(0, 0, 320, 320)
-    qeskf_mat = qeskf.matrix
-    draw_triad(g, qeskf_mat)
-
-    # Vector EKFs.
-    acc_vekf.step(dt, acc, rot)
-    mag_vekf.step(dt, mag, rot)
-    g.set_viewport(320, 0, 320, 320)
-    vkf_mat = orthonormalize(-acc_vekf.vector, mag_vekf.vector)
-    draw_triad(g, vkf_mat)
-
-    # Acc./Mag. only.
-    g.set_viewport(0, 300, 320, 320)
-    accmag_mat = orthonormalize(-acc, mag)
-    draw_triad(g, accmag_mat)
-
-    # Gyroscope only.
-    qint.step(dt, rot)
-    g.set_viewport(320, 300, 320, 320)
-    gyro_mat = qint.matrix
-    draw_triad(g, gyro_mat)
-
-    qeskf_elems = qeskf_mat[0:3,0:3].flatten()
-    vkf_elems = vkf_mat[0:3,0:3].flatten()
-    accmag_elems = accmag_mat[0:3,0:3].flatten()
-    gyro_elems = gyro_mat[0:3,0:3].flatten()
-    elems = concatenate((accmag_elems, gyro_elems, qeskf_elems, vkf_elems))
     if outfile:
-        outfile.write(" ".join(map(str, elems)) + "\n")
+        with RECORD_SPAN:
+            outfile.write(host_time, raw, stamp, **tracker.matrices())
+
+    with GRAPHS_SPAN:
+        update_graphs(acc, mag, rot)
 
-    # Update graphs.
-    cov_graph.add(det(qeskf.covariance) ** 0.5)
+def update_graphs(acc, mag, rot):
+    """Add one sample to the graphs."""
+    cov_graph.add(det(tracker.qeskf.covariance) ** 0.5)
 #    cov_graph.add(norm(qeskf.covariance, 'fro'))
 #    print(norm(qeskf.covariance, 'fro'))
     accx_graph.add(acc[0][0])
@@ -121,53 +130,37 @@ def loop(g, dt, acc, mag, rot):
     roty_graph.add(rot[1][0] / (4 * pi))
     rotz_graph.add(rot[2][0] / (4 * pi))
 
-    # Draw graphs.
-    def window(i, j=0):
-        x0 = (11 + 210*j - 320) / 320.0
-        x1 = (199 + 210*j - 320) / 320.0
-        y0 = (20 + 160*i - 320) / 320.0
-        y1 = (140 + 160*i - 320) / 320.0
-        return mat2wnd(x0, y0, x1, y1, sy=0.5)
+def draw(g):
+    """Draw the current state of the estimators and the graphs."""
+    # Set world-to-view matrix for mesh rendering.
+    g.set_view_matrix(VIEW_MATRIX)
 
-    g.set_viewport(640,0,640,640)
-    g.draw_graph(cov_graph, vec4(1,1,1,1), mat2wnd(-0.96875, 0.1875, 0.9375, 0.9375, sy=50))
-    g.draw_graph(accx_graph, vec4(1,0,0,1), window(2,0))
-    g.draw_graph(accy_graph, vec4(0,1,0,1), window(1,0))
-    g.draw_graph(accz_graph, vec4(0,0,1,1), window(0,0))
-    g.draw_graph(magx_graph, vec4(1,0,0,1), window(2,1))
-    g.draw_graph(magy_graph, vec4(0,1,0,1), window(1,1))
-    g.draw_graph(magz_graph, vec4(0,0,1,1), window(0,1))
-    g.draw_graph(rotx_graph, vec4(1,0,0,1), window(2,2))
-    g.draw_graph(roty_graph, vec4(0,1,0,1), window(1,2))
-    g.draw_graph(rotz_graph, vec4(0,0,1,1), window(0,2))
-
-def acc_model(acc):
-    """Accelerometer calibration model."""
-    accb = vec3(-547.0262, -96.7392, 92.4361)
-    accg = vec3(16421, 16454, 16611) / 2
-    return (acc - accb) / accg
-
-def mag_model(mag):
-    """Magnetometer calibration model."""
-    magr = array([
-            [0,  1,  0],
-            [1,  0,  0],
-            [0,  0, -1]
-        ])
-    magb = vec3(78.1810, 60.9789, -21.9482)
-    magg = vec3(323.9201, 320.9182, 321.4008)
-    return magr @ (mag - magb) / magg
-
-def rot_model(rot):
-    """Gyroscope calibration model."""
-    rotb = vec3(-0.6874, -39.7461, -19.8377)
-
-    return (rot - rotb) * (radians(1000) / 32768.0)
-
-def main():
-    global arrow_mesh, sphere_mesh, background, outfile
+    # Triads of all four estimators.
+    matrices = tracker.matrices()
+    names = list(TRIAD_VIEWPORTS)
+    draw_triads(g,
+        array([matrices[name] for name in names]),
+        array([TRIAD_VIEWPORTS[name] for name in names]))
 
-    g = Renderer(1280, 640, "Orientation tracking")
+    # Draw graphs.
+    g.set_viewport(640,0,640,640)
+    window = graph_view.window(cov_graph.count) if graph_view else None
+    g.draw_graphs([
+        (cov_graph, vec4(1,1,1,1, float32), COV_WINDOW),
+        (accx_graph, vec4(1,0,0,1, float32), GRAPH_WINDOWS[2][0]),
+        (accy_graph, vec4(0,1,0,1, float32), GRAPH_WINDOWS[1][0]),
+        (accz_graph, vec4(0,0,1,1, float32), GRAPH_WINDOWS[0][0]),
+        (magx_graph, vec4(1,0,0,1, float32), GRAPH_WINDOWS[2][1]),
+        (magy_graph, vec4(0,1,0,1, float32), GRAPH_WINDOWS[1][1]),
+        (magz_graph, vec4(0,0,1,1, float32), GRAPH_WINDOWS[0][1]),
+        (rotx_graph, vec4(1,0,0,1, float32), GRAPH_WINDOWS[2][2]),
+        (roty_graph, vec4(0,1,0,1, float32), GRAPH_WINDOWS[1][2]),
+        (rotz_graph, vec4(0,0,1,1, float32), GRAPH_WINDOWS[0][2]),
+    ], window)
+
+def setup(g):
+    """Create the meshes and textures used by draw()."""
+    global arrow_mesh, sphere_mesh, background, timing_panel
 
     # Create meshes.
     arrow_mesh = create_arrow_mesh(g)
@@ -176,73 +169,142 @@ def main():
     # Load background
     background = load_image_texture(g, "layout.png")
 
-    t0 = time.time(); t1 = t0
+    timing_panel = TextPanel(g, *TIMING_PANEL_SIZE)
 
-    usb0 = serial.Serial('COM5', baudrate=115200, bytesize=8, timeout=2, stopbits=serial.STOPBITS_ONE)
+def draw_frame(g):
+    """Draw the background and UI and show the result."""
+    # Draw background.
+    g.clear()
+    g.set_viewport(0, 0, 1280, 640)
+    g.draw_texture(background, -1, -1, 1, 1)
+
+    # Draw UI.
+    with DRAW_SPAN:
+        draw(g)
+        if show_timing:
+            g.set_viewport(0, 0, 1280, 640)
+            g.draw_texture(timing_panel.texture, *TIMING_PANEL_RECT)
+
+    # Show the results.
+    with FLIP_SPAN:
+        pygame.display.flip()
+
+def dump_timing():
+    """Write the timing histograms to the next free output file."""
+    path = next_recording_path("output", "timing.txt")
+    timing.dump(path)
+    print("Wrote timing to %s" % path)
+
+def print_graph_view():
+    """Report the window of the history view."""
+    if graph_view is None:
+        print("Graphs: latest samples")
+        return
+    start, stop = graph_view.window(cov_graph.count)
+    print("Graphs: samples %d to %d%s" % (start, stop, " (following)" if graph_view.end is None else ""))
+
+def main(source):
+    """Run the window on the samples of a source (see sources.py)."""
+    global outfile, show_timing, graph_view
+
+    g = Renderer(1280, 640, "Orientation tracking")
+    setup(g)
+
+    clock = SensorClock()
+    losses = 0
+    timing_time = 0.0
 
     while True:
         # Handle window events.
-        for event in pygame.event.get():
+        with EVENTS_SPAN:
+            events = pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
                 return
             if event.type == pygame.KEYUP:
                 if event.key == pygame.K_ESCAPE:
                     return
                 if event.key == pygame.K_g:
-                    qint._q = qeskf._q
+                    tracker.sync_gyro()
                 if event.key == pygame.K_r:
-                    qeskf._q = vec4(1.0, 0.0, 0.0, 0.0)
-                    mag_vekf._x = NAV_M
-                    acc_vekf._x = -NAV_G
+                    tracker.reset()
                 if event.key == pygame.K_q:
-                    for i in range(1,10000):
-                        fname = "output/data%d.txt" % i
-                        if os.path.exists(fname):
-                            continue
-                        if outfile:
-                            print("Stopped recording")
-                            outfile.close()
-                        outfile = open(fname, 'w')
-                        print("Started recording to %s..." % fname)
-                        break
+                    fname = next_recording_path("output")
+                    if outfile:
+                        print("Stopped recording")
+                        outfile.close()
+                    outfile = RecordingWriter(fname)
+                    print("Started recording to %s..." % fname)
                 if event.key == pygame.K_w:
                     print("Stopped recording")
                     if outfile:
                         outfile.close()
                     outfile = None
-
-        # Read raw measurement data from the board.
-        while True:
-            line = usb0.readline()
-            if line:
-                fields = line.strip().split(b' ')
-                if len(fields) != 9:
+                if event.key == pygame.K_t:
+                    show_timing = not show_timing
+                if event.key == pygame.K_p:
+                    dump_timing()
+                if event.key == pygame.K_h:
+                    graph_view = None if graph_view else View(max(cov_graph.count, len(cov_graph)))
+                    print_graph_view()
+            if event.type == pygame.KEYDOWN and graph_view:
+                # Zoom and pan the history view.
+                n = cov_graph.count
+                if event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                    graph_view.zoom(0.5, n)
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                    graph_view.zoom(2.0, n)
+                elif event.key == pygame.K_LEFT:
+                    graph_view.pan(-0.25, n)
+                elif event.key == pygame.K_RIGHT:
+                    graph_view.pan(0.25, n)
+                elif event.key == pygame.K_END:
+                    graph_view.follow()
+                else:
                     continue
-                values = list(map(float, fields))
-                break
+                print_graph_view()
 
-        # Apply sensor bias/scaling models to obtain normalized sensor data.
-        acc = acc_model(vec3(*values[0:3]))
-        mag = mag_model(vec3(*values[3:6]))
-        rot = rot_model(vec3(*values[6:9]))
+        # Take every sample that arrived since the previous frame. A
+        # source that has run out still draws, so the window stays live.
+        with INPUT_SPAN:
+            times, stamps, samples = source.read()
+            if len(times) == 0:
+                time.sleep(0.001)
+        if len(times) == 0 and not source.done:
+            continue
 
-        # Compute previous frame start and end times.
-        t0, t1 = t1, time.time()
+        if source.dropped + source.lost + source.overruns + clock.missed != losses:
+            losses = source.dropped + source.lost + source.overruns + clock.missed
+            print("Input: %d malformed lines, %d lost packets, %d ring overruns, %d missed samples" % (
+                source.dropped, source.lost, source.overruns, clock.missed))
 
-        # Draw background.
-        g.clear()
-        g.set_viewport(0, 0, 1280, 640)
-        g.draw_texture(background, -1, -1, 1, 1)
+        with FRAME_SPAN:
+            for host_time, stamp, values in zip(times, stamps, samples):
+                # Time since the previous sample, from the board's clock.
+                with CLOCK_SPAN:
+                    t, dt = clock.update(stamp, host_time)
 
-        # Run the filters, draw UI.
-        loop(g, t1 - t0, acc, mag, rot)
+                # Run the filters; the scheduler decides which sensors are new.
+                update(host_time, stamp, t, dt, values)
 
-        # Show the results.
-        pygame.display.flip()
+            if show_timing and time.time() - timing_time >= TIMING_REFRESH:
+                timing_time = time.time()
+                timing_panel.set_lines(g, timing.report())
+
+            draw_frame(g)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Orientation tracking")
+    sources.add_arguments(parser)
+    parser.add_argument('--float32', action='store_true', help="run the estimators in single precision")
+    parser.set_defaults(text=not BINARY_PROTOCOL)
+    args = parser.parse_args()
+    if args.float32:
+        tracker = Tracker(float32)
+        scheduler = UpdateScheduler(tracker, calibration=load_calibration(BOARD_ID))
     try:
-        pygame.init()
-        main()
+        with sources.from_arguments(args) as source:
+            pygame.init()
+            main(source)
     finally:
         pygame.quit()
@@ -0,0 +1,118 @@
+"""Indexed triangle meshes of the shapes drawn by the renderer.
+
+A mesh is an (n, 6) float32 array of vertices, each a position and a
+normal, and an array of 3 indices per triangle into it, uint16 when the
+vertices fit. Shapes are built out of frustums (cone sides) as whole
+arrays of triangles, and weld() then merges the vertices the triangles
+share. Vertices carry no color: the renderer takes it from the tint.
+
+Welding takes most of the time of building a mesh, so load() keeps the
+result in a cache directory, as a pair of .npy files named after the mesh
+and a hash of its parameters. Bump VERSION whenever the shapes change, so
+that stale files are no longer picked up.
+"""
+
+import hashlib
+import os
+from numpy import (asarray, arange, empty, stack, concatenate, broadcast_arrays, radians, cos, sin, arctan2, rint,
+    lexsort, argsort, cumsum, minimum, flatnonzero, newaxis, float32, int64, uint16, uint32)
+import numpy as np
+
+VERSION = 1
+CACHE = os.path.join('output', 'meshes')
+
+def frustum(segments, z1, r1, z2, r2):
+    """Triangles of the sides of frustums from radius r1 at height z1 to r2
+    at z2, around the z axis, as an (n, 3, 6) array of vertices. The radii
+    and heights may be arrays, one frustum per element; a zero radius makes
+    a cone tip, and equal heights a flat ring or disc."""
+    z1, r1, z2, r2 = (a[:, newaxis] for a in broadcast_arrays(*(asarray(x, dtype=float) for x in (z1, r1, z2, r2))))
+    phi = radians(arange(segments + 1) * (360.0 / segments))
+    theta = arctan2(r1 - r2, z2 - z1)
+
+    # Rings of vertices at both ends, (frustums, segments + 1, 6); the
+    # normal is the same along a side.
+    top = empty((len(z1), segments + 1, 6))
+    top[..., 0] = r2 * cos(phi)
+    top[..., 1] = r2 * sin(phi)
+    top[..., 2] = z2
+    top[..., 3] = cos(phi) * cos(theta)
+    top[..., 4] = sin(phi) * cos(theta)
+    top[..., 5] = sin(theta)
+    bottom = top.copy()
+    bottom[..., 0] = r1 * cos(phi)
+    bottom[..., 1] = r1 * sin(phi)
+    bottom[..., 2] = z1
+
+    # Two triangles per segment, the first missing where the top is a
+    # tip and the second where the bottom is.
+    t0, t1, b0, b1 = top[:, :-1], top[:, 1:], bottom[:, :-1], bottom[:, 1:]
+    tris = stack((stack((t0, b0, t1), axis=2), stack((t1, b0, b1), axis=2)), axis=2)
+    keep = stack((r2 > 0, r1 > 0), axis=2).repeat(segments, axis=1)
+    return tris[keep]
+
+def weld(triangles, tolerance=1e-6):
+    """Merge the vertices of an (n, 3, 6) array of triangles that agree to
+    within tolerance. Returns the vertices, in order of first use, and the
+    (n, 3) indices of the triangles."""
+    data = triangles.reshape(-1, 6).astype(float32)
+    keys = rint(data / tolerance).astype(int64)
+
+    # Sort the vertices so that equal ones are adjacent (a lexsort by
+    # columns is several times faster than unique(axis=0)), and number the
+    # runs of equal vertices in order of their first use.
+    order = lexsort(keys.T[::-1])
+    k = keys[order]
+    new = concatenate(([True], (k[1:] != k[:-1]).any(axis=1)))
+    first = minimum.reduceat(order, flatnonzero(new))
+    by_use = argsort(first)
+    rank = empty(len(first), dtype=int64)
+    rank[by_use] = arange(len(first))
+    run = empty(len(order), dtype=int64)
+    run[order] = cumsum(new) - 1
+    indices = rank[run].reshape(-1, 3)
+    return data[first[by_use]], indices.astype(uint16 if len(first) <= 1 << 16 else uint32)
+
+def sphere(radius, segments=24):
+    """A sphere of segments bands of segments sides, flat along each band."""
+    theta = radians(arange(segments + 1) * (180.0 / segments))
+    r = radius * sin(theta)
+    z = radius * -cos(theta)
+    return weld(frustum(segments, z[:-1], r[:-1], z[1:], r[1:]))
+
+def arrow(bottom=0.0, top=2.0, sides=24):
+    """An arrow along the z axis: a shaft of radius 0.05, closed at the
+    bottom, and a head of radius 0.2 over the top fifth."""
+    middle = 0.2 * bottom + 0.8 * top
+    z1 = (bottom, bottom, middle, middle)
+    r1 = (0.00, 0.05, 0.05, 0.20)
+    z2 = (bottom, middle, middle, top)
+    r2 = (0.05, 0.05, 0.20, 0.00)
+    return weld(frustum(sides, z1, r1, z2, r2))
+
+SHAPES = {'sphere': sphere, 'arrow': arrow}
+
+def load(name, *params, directory=CACHE):
+    """Vertices and indices of the shape name built with params, read from
+    the cache if it holds them and written to it otherwise."""
+    key = hashlib.sha1(repr((VERSION, name, params)).encode()).hexdigest()[:16]
+    base = os.path.join(directory, "%s-%s" % (name, key))
+    try:
+        return np.load(base + ".vertices.npy"), np.load(base + ".indices.npy")
+    except (OSError, ValueError):
+        pass
+
+    arrays = SHAPES[name](*params)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for part, array in zip(("vertices", "indices"), arrays):
+            # Written under another name and renamed, so that a reader
+            # never sees a partly written file.
+            path = "%s.%s.npy" % (base, part)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp, path)
+    except OSError:
+        pass
+    return arrays
@@ -0,0 +1,404 @@
+"""Receive sample streams from many boards over UDP and TCP.
+
+Boards on Wi-Fi send the packets of wire.py prefixed by their 32-bit
+little-endian device ID (the chip ID):
+
+* over UDP, every datagram is the device ID followed by one or more
+  packets,
+* over TCP, the device ID is sent once after connecting and is followed
+  by a stream of packets.
+
+The event loop only sorts the received bytes into a bounded queue per
+device. A full queue is backpressure: a TCP connection stops being read
+until the consumer has drained the queue, and datagrams that do not fit
+are dropped and counted as overruns. The consumer calls drain(), from
+the event loop or any one other thread (each device's queue is guarded
+by a lock), which decodes the datagrams of all devices in one vectorized
+pass.
+
+Run as a program, the server feeds every device's samples through the
+QuaternionESKF of a QuaternionESKFBank and prints the traffic each
+second:
+
+    python netingest.py --udp 9750 --tcp 9751 --bank 4096
+
+boardsim.py stands in for a fleet of boards to load-test it.
+"""
+
+import argparse
+import asyncio
+import struct
+import sys
+import threading
+import time
+from numpy import array, zeros, full, repeat, bincount, concatenate, maximum, flatnonzero, diff, arange, isnan, nan, int64, float32, float64
+
+from wire import PACKET_SIZE, PacketDecoder, decode
+from qeskf import QuaternionESKFBank
+from tracker import NAV_G, NAV_M
+from calib import DEFAULT
+from sensorclock import SensorClock, sample_times
+
+DEVICE_ID = struct.Struct('<I')
+
+class Device:
+    """Queue and counters of one board.
+
+    The event loop only appends the received bytes to the queue; they are
+    decoded by the consumer in drain(). The queue holds at most capacity
+    packets. Datagrams that do not fit are dropped and counted in
+    overruns, and a TCP connection stops being read once the queue is
+    high_water full. The queue and its counts are guarded by a lock, as
+    the consumer may run in another thread.
+    """
+    def __init__(self, device_id, server):
+        self.id = device_id
+        self.received = 0
+        self.lost = 0
+        self.overruns = 0
+        self.skipped = 0
+        self._server = server
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._queued = 0
+        self._taken = 0
+        self._seq = None
+        self._decoder = None
+        self._transport = None
+        self._paused = False
+
+    def __len__(self):
+        """Bytes waiting in the queue."""
+        return self._queued - self._taken
+
+    def _put(self, t, data):
+        """Queue bytes received at host time t (event loop side)."""
+        server = self._server
+        with self._lock:
+            if self._transport is None and len(self) + len(data) > server.capacity:
+                self.overruns += len(data) // PACKET_SIZE
+                return
+            self._chunks.append((t, data))
+            self._queued += len(data)
+            if self._transport and len(self) >= server.high_water:
+                self._transport.pause_reading()
+                self._paused = True
+
+    def _take(self):
+        """Take the queued chunks (consumer side)."""
+        with self._lock:
+            chunks, self._chunks = self._chunks, []
+            self._taken += sum(len(data) for _, data in chunks)
+            paused, self._paused = self._paused, False
+        if paused:
+            self._server._call(self._resume)
+        return chunks
+
+    def _resume(self):
+        if self._transport and not self._transport.is_closing():
+            self._transport.resume_reading()
+
+    def _decode_stream(self, chunks):
+        """Decode the chunks of a TCP stream, which need not hold whole
+        packets."""
+        decoder = self._decoder
+        lost, skipped = decoder.lost, decoder.skipped
+        seq, stamps, samples = decoder.feed(b''.join(data for _, data in chunks))
+        self.lost += decoder.lost - lost
+        self.skipped += decoder.skipped - skipped
+        self.received += len(samples)
+        return full(len(samples), chunks[-1][0]), stamps, samples
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self._server = server
+
+    def datagram_received(self, data, addr):
+        server = self._server
+        if len(data) < DEVICE_ID.size:
+            server.malformed += 1
+            return
+        device = server.device(DEVICE_ID.unpack_from(data)[0])
+        if device is not None:
+            device._put(time.time(), data[DEVICE_ID.size:])
+
+class _TCPProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self._server = server
+        self._transport = None
+        self._device = None
+        self._head = b''
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        t = time.time()
+        if self._device is None:
+            self._head += data
+            if len(self._head) < DEVICE_ID.size:
+                return
+            device = self._server.device(DEVICE_ID.unpack_from(self._head)[0])
+            if device is None:
+                self._transport.close()
+                return
+            device._transport = self._transport
+            device._decoder = PacketDecoder()
+            self._device = device
+            data = self._head[DEVICE_ID.size:]
+            self._head = b''
+        if data:
+            self._device._put(t, data)
+
+    def connection_lost(self, exc):
+        if self._device is not None and self._device._transport is self._transport:
+            self._device._transport = None
+
+class IngestServer:
+    """Asyncio server demultiplexing board streams into per-device queues.
+
+    capacity is the queue size of each device in packets; TCP reading
+    pauses once a queue is high_water full. At most max_devices devices
+    are accepted, and datagrams and connections from others are counted
+    in rejected.
+    """
+    def __init__(self, capacity=1024, high_water=0.75, max_devices=None):
+        self.devices = {}
+        self.capacity = capacity * PACKET_SIZE
+        self.high_water = int(self.capacity * high_water)
+        self.max_devices = max_devices
+        self.malformed = 0
+        self.rejected = 0
+        self._loop = None
+        self._servers = []
+        self._transports = []
+
+    def device(self, device_id):
+        """The device with the given ID, created on first contact; None if
+        no more devices are accepted."""
+        device = self.devices.get(device_id)
+        if device is None:
+            if self.max_devices is not None and len(self.devices) >= self.max_devices:
+                self.rejected += 1
+                return None
+            device = self.devices[device_id] = Device(device_id, self)
+        return device
+
+    async def start(self, host='0.0.0.0', udp_port=None, tcp_port=None):
+        self._loop = asyncio.get_running_loop()
+        if udp_port is not None:
+            transport, _ = await self._loop.create_datagram_endpoint(
+                lambda: _UDPProtocol(self), local_addr=(host, udp_port))
+            self._transports.append(transport)
+        if tcp_port is not None:
+            server = await self._loop.create_server(lambda: _TCPProtocol(self), host, tcp_port)
+            self._servers.append(server)
+
+    def close(self):
+        for transport in self._transports:
+            transport.close()
+        for server in self._servers:
+            server.close()
+
+    def _call(self, func):
+        self._loop.call_soon_threadsafe(func)
+
+    def drain(self):
+        """Decode the queued bytes of every device.
+
+        Returns flat (n,) arrays of device IDs, host times and stamps and
+        an (n, 9) array of sensor values, with the samples of each device
+        consecutive and in the order they were sent. The datagrams of all
+        devices are decoded together in one vectorized pass.
+        """
+        streams = []
+        devices, times, payloads = [], [], []
+        for device in list(self.devices.values()):
+            # A paused device is drained even if its queue is empty, so
+            # that its reading resumes.
+            if not device._chunks and not device._paused:
+                continue
+            chunks = device._take()
+            if not chunks:
+                continue
+            if device._decoder:
+                t, stamps, samples = device._decode_stream(chunks)
+                streams.append((full(len(t), device.id), t, stamps, samples))
+                continue
+            for t, data in chunks:
+                devices.append(device)
+                times.append(t)
+                payloads.append(data)
+
+        if payloads:
+            streams.append(self._decode_datagrams(devices, times, payloads))
+        if not streams:
+            return zeros(0, dtype=int64), zeros(0), zeros(0), zeros((0, 9))
+        return tuple(concatenate(arrays) for arrays in zip(*streams))
+
+    def _decode_datagrams(self, devices, times, payloads):
+        # Number the devices in order of appearance; the datagrams of each
+        # device are consecutive.
+        index = {}
+        owner = array([index.setdefault(device, len(index)) for device in devices])
+        devices = list(index)
+
+        sizes = array([len(data) for data in payloads])
+        counts = sizes // PACKET_SIZE
+        valid, seq, stamps, samples = decode(b''.join(
+            data[:count * PACKET_SIZE] for data, count in zip(payloads, counts.tolist())))
+
+        # Bytes of partial and corrupt packets.
+        skipped = bincount(owner, weights=sizes - counts * PACKET_SIZE, minlength=len(devices))
+        owner = repeat(owner, counts)
+        times = repeat(array(times), counts)
+        skipped += bincount(owner[~valid], minlength=len(devices)) * PACKET_SIZE
+
+        owner, seq, times, stamps, samples = owner[valid], seq[valid], times[valid], stamps[valid], samples[valid]
+
+        # Packets lost in each device's sequence, continuing from the last
+        # sequence number seen of it.
+        last = array([-1 if d._seq is None else d._seq for d in devices])
+        first = concatenate(([True], owner[1:] != owner[:-1]))
+        prev = concatenate(([0], seq[:-1])).astype(int64)
+        prev[first] = last[owner[first]]
+        unknown = prev < 0
+        prev[unknown] = seq[unknown].astype(int64) - 1
+        steps = (seq.astype(int64) - prev) % 65536
+        lost = bincount(owner, weights=maximum(steps - 1, 0), minlength=len(devices))
+        received = bincount(owner, minlength=len(devices))
+        ends = flatnonzero(concatenate((owner[1:] != owner[:-1], [True]))) if len(owner) else owner
+
+        for i, device in enumerate(devices):
+            device.skipped += int(skipped[i])
+            device.lost += int(lost[i])
+            device.received += int(received[i])
+        for i in ends.tolist():
+            devices[owner[i]]._seq = int(seq[i])
+
+        ids = array([d.id for d in devices], dtype=int64)
+        return ids[owner], times, stamps, samples
+
+    def totals(self):
+        devices = list(self.devices.values())
+        return {
+            'devices': len(devices),
+            'received': sum(d.received for d in devices),
+            'lost': sum(d.lost for d in devices),
+            'overruns': sum(d.overruns for d in devices),
+            'skipped': sum(d.skipped for d in devices),
+            'malformed': self.malformed,
+            'rejected': self.rejected,
+        }
+
+# -----------------------------------------------------------------------------
+
+class BankFeeder:
+    """Runs the samples of every device through one slot of a
+    QuaternionESKFBank, timed by a SensorClock per device.
+
+    The first k devices get a slot; samples of the others are counted in
+    unassigned. The bank runs in dtype (see QuaternionESKF).
+    """
+    def __init__(self, k, calibration=None, dtype=float64):
+        self.bank = QuaternionESKFBank(NAV_G, NAV_M, k, dtype=dtype)
+        self.calibration = calibration or DEFAULT
+        self.slots = {}
+        self._clocks = []
+        self.unassigned = 0
+        self.steps = 0
+
+    def slot(self, device_id):
+        """The bank slot of a device, or -1 if the bank is full."""
+        slot = self.slots.get(device_id)
+        if slot is None:
+            if len(self.slots) == len(self.bank):
+                return -1
+            slot = self.slots[device_id] = len(self._clocks)
+            self._clocks.append(SensorClock())
+        return slot
+
+    def feed(self, ids, times, stamps, samples):
+        """Step the bank through samples drained from an IngestServer, one
+        sample of every device per step."""
+        if len(ids) == 0:
+            return
+
+        # Runs of samples of one device.
+        starts = flatnonzero(concatenate(([True], ids[1:] != ids[:-1])))
+        runs = diff(concatenate((starts, [len(ids)])))
+        slots = array([self.slot(i) for i in ids[starts].tolist()])
+
+        dts = full(len(ids), nan)
+        for start, run, slot in zip(starts.tolist(), runs.tolist(), slots.tolist()):
+            if slot >= 0:
+                i = slice(start, start + run)
+                _, dts[i] = sample_times(stamps[i], times[i], self._clocks[slot])
+        slot = repeat(slots, runs)
+        pos = arange(len(ids)) - repeat(starts, runs)
+        keep = slot >= 0
+        self.unassigned += int((~keep).sum())
+
+        k = len(self.bank)
+        m = int(runs.max())
+        dt = full((k, m), nan)
+        values = zeros((k, m, 9), self.bank.dtype)
+        dt[slot[keep], pos[keep]] = dts[keep]
+        values[slot[keep], pos[keep]] = self.calibration.apply_batch(samples[keep], self.bank.dtype)
+
+        # Samples without a time step (a device's first) are skipped.
+        valid = ~isnan(dt)
+        for j in range(m):
+            v = values[:, j]
+            self.bank.step(dt[:, j], v[:, 0:3], v[:, 3:6], v[:, 6:9], mask=valid[:, j])
+            self.steps += 1
+
+async def serve(args):
+    server = IngestServer(args.capacity, max_devices=args.max_devices)
+    await server.start(args.host, args.udp, args.tcp)
+    feeder = BankFeeder(args.bank, dtype=float32 if args.float32 else float64) if args.bank else None
+    loop = asyncio.get_running_loop()
+
+    print("Listening on %s (udp %s, tcp %s)" % (args.host, args.udp, args.tcp), file=sys.stderr)
+    last, received = time.time(), 0
+    try:
+        while True:
+            await asyncio.sleep(args.interval)
+            if feeder:
+                # Filter on a worker thread so that the sockets keep being read.
+                await loop.run_in_executor(None, feeder.feed, *server.drain())
+            else:
+                server.drain()
+
+            now = time.time()
+            if now - last >= 1.0:
+                totals = server.totals()
+                rate = (totals['received'] - received) / (now - last)
+                last, received = now, totals['received']
+                print("%(devices)d devices, %(received)d samples, %(lost)d lost, %(overruns)d overruns, "
+                      "%(skipped)d bytes skipped, %(malformed)d malformed, %(rejected)d rejected" % totals
+                      + ", %.0f samples/s" % rate)
+    finally:
+        server.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--udp', type=int, help="UDP port to listen on")
+    parser.add_argument('--tcp', type=int, help="TCP port to listen on")
+    parser.add_argument('--capacity', type=int, default=1024, help="samples buffered per device")
+    parser.add_argument('--max-devices', type=int)
+    parser.add_argument('--bank', type=int, default=0, help="run a QuaternionESKF bank of this many slots")
+    parser.add_argument('--float32', action='store_true', help="run the bank in single precision")
+    parser.add_argument('--interval', type=float, default=0.02, help="seconds between drains")
+    args = parser.parse_args(argv)
+    if args.udp is None and args.tcp is None:
+        parser.error("give --udp and/or --tcp")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
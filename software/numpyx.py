@@ -1,19 +1,36 @@
-from numpy import array, ndarray, zeros, eye, diag, dot, block, newaxis, float32, allclose, isclose
+from numpy import (array, ndarray, zeros, eye, diag, dot, block, newaxis, float32, float64, allclose, isclose,
+    einsum, where, dtype as _dtype)
+from numpy import sin as sin_, sqrt as sqrt_
 from numpy.random import normal
 from numpy.linalg import inv
 from math import sin, cos, sqrt
 
-def vec1(x):
+# Batched kernels, kept under the numpyx naming scheme.
+from quat import skewn as xmatn, qmuln as qmulln, qexpn as qrotvn, qrmatn as rmat3qn
+
+# Floating-point types the estimators can run in. The functions below
+# return arrays of the dtype of their argument, so a pipeline started in
+# float32 stays in float32.
+DTYPES = (float64, float32)
+
+def check_dtype(dtype):
+    """The scalar type of dtype, which must be one of DTYPES."""
+    t = _dtype(dtype).type
+    if t not in DTYPES:
+        raise ValueError("unsupported dtype %s" % _dtype(dtype))
+    return t
+
+def vec1(x, dtype=float64):
     """Make a (degenerate) 1-element column vector [x]."""
-    return array(x).reshape(1, -1)
+    return array(x, dtype).reshape(1, -1)
 
-def vec3(x, y, z):
+def vec3(x, y, z, dtype=float64):
     """Make a 3-element column vector [x,y,z]^T."""
-    return array([[x], [y], [z]])
+    return array([[x], [y], [z]], dtype)
 
-def vec4(x, y, z, w):
+def vec4(x, y, z, w, dtype=float64):
     """Make a 4-element column vector [x,y,z,w]^T."""
-    return array([[x], [y], [z], [w]])
+    return array([[x], [y], [z], [w]], dtype)
 
 def xmat(v):
     """Compute the left cross-product matrix of v."""
@@ -21,14 +38,14 @@ def xmat(v):
         [0, -v[2][0], v[1][0]],
         [v[2][0], 0, -v[0][0]],
         [-v[1][0], v[0][0], 0]
-    ])
+    ], v.dtype)
 
 def qmatl(q):
     """Compute the left (Hamiltonian) quaternion product matrix of q."""
     q0, qv = q[0:1], q[1:4]
     return block([
         [q0, -qv.T],
-        [qv, q0*eye(3) + xmat(qv)]
+        [qv, q0*eye(3, dtype=q.dtype) + xmat(qv)]
     ])
 
 def qmatr(q):
@@ -36,9 +53,38 @@ def qmatr(q):
     q0, qv = q[0:1], q[1:4]
     return block([
         [q0, -qv.T],
-        [qv, q0*eye(3) - xmat(qv)]
+        [qv, q0*eye(3, dtype=q.dtype) - xmat(qv)]
     ])
 
+def rexp(v):
+    """Compute the rotation matrix exp(xmat(v)) using the Rodrigues formula."""
+    t2 = (v.T @ v).item()
+    W = xmat(v)
+    if t2 < 1e-8:
+        # Small-angle series of sin(t)/t and (1 - cos(t))/t^2.
+        a = 1.0 - t2/6.0
+        b = 0.5 - t2/24.0
+    else:
+        t = sqrt(t2)
+        a = sin(t) / t
+        b = 2.0 * sin(t/2)**2 / t2
+    return eye(3, dtype=v.dtype) + a * W + b * (W @ W)
+
+def rexpn(v):
+    """Batched rexp() over the rows of an (N, 3) array, giving (N, 3, 3)."""
+    t2 = einsum('ij,ij->i', v, v)
+    small = t2 < 1e-8
+    t = sqrt_(where(small, 1.0, t2))
+    a = where(small, 1.0 - t2/6.0, sin_(t) / t)
+    b = where(small, 0.5 - t2/24.0, 2.0 * sin_(t/2)**2 / (t*t))
+    W = xmatn(v)
+    return eye(3, dtype=v.dtype) + a[:, newaxis, newaxis] * W + b[:, newaxis, newaxis] * (W @ W)
+
+def rexp_expm(v):
+    """Reference rexp() using the general matrix exponential from scipy."""
+    from scipy.linalg import expm
+    return expm(xmat(v))
+
 def qconj(q):
     """Compute the conjugate of quaternion q."""
     return array([
@@ -59,27 +105,27 @@ def qmulr(p, q):
 def qrotv(v):
     d = sqrt(v.T @ v)
     if d < 10e-9:
-        return vec4(1.0, 0.0, 0.0, 0.0)
+        return vec4(1.0, 0.0, 0.0, 0.0, v.dtype)
     return array([
         [cos(d/2)],
         sin(d/2) * v[0] / d,
         sin(d/2) * v[1] / d,
         sin(d/2) * v[2] / d
-    ])
+    ], v.dtype)
 
 def mat3to4(m):
-    nv = vec3(0,0,0)
-    return block([[m, nv], [nv.T, 1]])
+    nv = vec3(0, 0, 0, m.dtype)
+    return block([[m, nv], [nv.T, vec1(1, m.dtype)]])
 
 def rmat3q(q):
     q0, qv = q[0:1], q[1:4]
     xv = xmat(qv)
-    return qv @ qv.T + eye(3)*q[0]**2 + 2*q[0]*xv + xv @ xv
+    return qv @ qv.T + eye(3, dtype=q.dtype)*q[0]**2 + 2*q[0]*xv + xv @ xv
 
 def rmat4q(q):
     q0, qv = q[0:1], q[1:4]
     xv = xmat(qv)
-    return mat3to4(qv @ qv.T + eye(3)*q[0]**2 + 2*q[0]*xv + xv @ xv)
+    return mat3to4(qv @ qv.T + eye(3, dtype=q.dtype)*q[0]**2 + 2*q[0]*xv + xv @ xv)
 
 def rmatuv(u, v):
     u = u / sqrt(u.T @ u)
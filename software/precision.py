@@ -0,0 +1,149 @@
+"""Accuracy and throughput of the estimators in float32 against float64.
+
+Replays a long synthetic trajectory (see synth.py), or recordings, through
+QuaternionESKF in both precisions and reports the error against the true
+orientation, the largest difference between the two runs and the time
+per sample, then times a step of the filter banks:
+
+    python precision.py --duration 3600 --repeat 3
+    python precision.py output/data1.rec output/data2.rec
+
+On an hour of random turning at 50 Hz (180000 samples) both precisions
+are 0.175 degrees RMS from the truth and float32 stays within 1e-4
+degrees of float64. Without renormalization the float32 quaternion norm
+drifts by 5e-4 over the hour; renormalizing every STABILIZE_PERIOD (16)
+steps of qeskf.py keeps it within 4e-7 of 1.
+
+float32 is not faster. With --repeat 3, the replay took 51 us per sample
+in float32 against 47 us in float64; over several shorter runs it was 3
+to 8% slower. Most of the difference is the 6x6 solve, which LAPACK does
+in 9.5 us in float32 against 6.9 us in float64; the other per-sample
+operations are on arrays too small for the precision to matter.
+Renormalizing and symmetrizing take about 5 us of kernel time. Done on
+every step they added up to 2 us per sample to the replay; done every 16
+steps they cost under 0.5 us. Bank steps over 1000 filters
+(3.6 ms for a QuaternionESKFBank, 1.7 ms for a VectorEKFBank) came out
+between 10% faster and 15% slower in float32 from run to run; NumPy's
+stacked 3x3 and 6x6 kernels gain nothing from the narrower type. What
+float32 buys is memory: bank state, batch samples and replay outputs
+take half the space, and the tracker's matrices go to the renderer
+without conversion.
+
+Timings on a loaded machine vary by 10% or more between runs; --repeat
+takes the best of several replays, run in turn for each precision.
+"""
+
+import argparse
+import sys
+import time
+from math import pi
+from numpy import asarray, sqrt, einsum, abs as npabs, float32, float64, tile
+
+from tracker import NAV_G, NAV_M
+from qeskf import QuaternionESKF, QuaternionESKFBank
+from vekf import VectorEKFBank
+from synth import generate, random_motion, angle_error
+
+DTYPES = (float64, float32)
+
+def replay(dts, samples, dtype, stabilize=True):
+    """Quaternions of a QuaternionESKF replay, and seconds per sample."""
+    f = QuaternionESKF(NAV_G, NAV_M, dtype=dtype, stabilize=stabilize)
+    t = time.perf_counter()
+    qs, _ = f.replay(dts, samples)
+    return qs, (time.perf_counter() - t) / len(samples)
+
+CASES = (('float64', float64, True), ('float32', float32, True), ('float32 unstabilized', float32, False))
+
+def compare(dts, samples, truth=None, settle=500, repeat=1):
+    """One (name, seconds per sample, RMS and maximum error in degrees
+    against the truth, maximum difference from float64 in degrees, largest
+    deviation of the quaternion norm from 1) row per precision. The time
+    is the best of repeat replays, taken in turn for every precision so
+    that they see the same load."""
+    runs = {}
+    for _ in range(repeat):
+        for name, dtype, stabilize in CASES:
+            qs, seconds = replay(dts, samples, dtype, stabilize)
+            runs[name] = qs, min(seconds, runs.get(name, (None, seconds))[1])
+    rows = []
+    reference = None
+    for name, dtype, stabilize in CASES:
+        qs, seconds = runs[name]
+        qs = asarray(qs, dtype=float64)
+        if reference is None:
+            reference = qs
+        rms = worst = float('nan')
+        if truth is not None:
+            err = angle_error(qs, truth)[settle:] * 180 / pi
+            rms, worst = sqrt((err * err).mean()), err.max()
+        diff = (angle_error(qs, reference)[settle:] * 180 / pi).max()
+        drift = npabs(sqrt(einsum('ij,ij->i', qs, qs)) - 1.0).max()
+        rows.append((name, seconds, rms, worst, diff, drift))
+    return rows
+
+def bank_timing(k=1000, repeat=50):
+    """(name, dtype, seconds per step, bytes of state) of the filter banks."""
+    sample = asarray([0.0, 0.05, 0.98, 0.0, 0.29, -0.95, 0.3, 0.2, 0.5])
+    rows = []
+    for dtype in DTYPES:
+        v = tile(sample, (k, 1)).astype(dtype)
+        qbank = QuaternionESKFBank(NAV_G, NAV_M, k, dtype=dtype)
+        vbank = VectorEKFBank(1.0, k, dtype=dtype)
+        for name, step, state in (
+                ('QuaternionESKFBank', lambda: qbank.step(0.02, v[:, 0:3], v[:, 3:6], v[:, 6:9]),
+                 lambda: qbank.quaternions.nbytes + qbank.covariances.nbytes),
+                ('VectorEKFBank', lambda: vbank.step(0.02, v[:, 0:3], v[:, 6:9]),
+                 lambda: vbank.vectors.nbytes + vbank.covariances.nbytes)):
+            step()
+            t = time.perf_counter()
+            for _ in range(repeat):
+                step()
+            rows.append((name, dtype.__name__, (time.perf_counter() - t) / repeat, state()))
+    return rows
+
+def load(path, calibration):
+    """Time steps and calibrated samples of a recording."""
+    from recording import Recording
+    from sensorclock import sample_times
+    rec = Recording(path)
+    _, dts = sample_times(asarray(rec.stamp, dtype=float64), asarray(rec.time))
+    return dts[1:], calibration.apply_batch(rec.raw[1:])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recordings', nargs='*', help="recordings to replay instead of a synthetic trajectory")
+    parser.add_argument('--duration', type=float, default=3600.0, help="seconds of synthetic samples")
+    parser.add_argument('--rate', type=float, default=50.0, help="synthetic samples per second")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--board', help="board ID whose stored calibration to use")
+    parser.add_argument('--bank', type=int, default=1000, help="filters in the timed banks")
+    parser.add_argument('--repeat', type=int, default=1, help="replays per precision, timing the best")
+    args = parser.parse_args(argv)
+
+    runs = []
+    if args.recordings:
+        from calib import load_calibration
+        calibration = load_calibration(args.board)
+        for path in args.recordings:
+            runs.append((path, load(path, calibration) + (None,)))
+    else:
+        dt = 1.0 / args.rate
+        n = int(args.duration * args.rate)
+        data = generate(random_motion(n, dt, seed=args.seed), dt, seed=args.seed)
+        runs.append(("synthetic, %d samples" % n, (data.dts, data.calibrated, data.quaternions)))
+
+    for title, (dts, samples, truth) in runs:
+        print(title)
+        print("  %-22s %10s %10s %10s %12s %10s" % ("QuaternionESKF", "us/sample", "rms deg", "max deg",
+                                                   "vs f64 deg", "|q|-1"))
+        for name, seconds, rms, worst, diff, drift in compare(dts, samples, truth, repeat=args.repeat):
+            print("  %-22s %10.1f %10.3f %10.3f %12.2e %10.1e" % (name, seconds * 1e6, rms, worst, diff, drift))
+
+    print("banks of %d" % args.bank)
+    for name, dtype, seconds, nbytes in bank_timing(args.bank):
+        print("  %-22s %-8s %10.1f us/step %8.1f kB" % (name, dtype, seconds * 1e6, nbytes / 1e3))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
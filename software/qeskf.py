@@ -1,17 +1,109 @@
-from numpy import array, block, eye, zeros, trace
-from numpy.linalg import inv, norm, det
-from scipy.linalg import expm
-from numpyx import vec3, vec4, qmull, qrotv, xmat, rmat3q, rmat4q
-from math import sin, cos, radians
+import math
+from numpy import array, block, eye, zeros, empty, nan, trace, asarray, broadcast_to, einsum, matmul, newaxis, float64, stack, tile, concatenate, flatnonzero
+from numpy.linalg import inv, norm, det, solve
+from numpyx import vec3, vec4, xmat, rmat4q, rexp, rexpn, rexp_expm, check_dtype
+from quat import qmul, qexp, qrmat, qnormalize, skew, qmuln, qexpn, qrmatn, qnormalizen, skewn
+
+def _cholsolve3(S, B, out=None):
+    """Solve S X = B for a symmetric positive definite 3x3 S and a 3-row B
+    by Cholesky factorization."""
+    (s00, s01, s02), (_, s11, s12), (_, _, s22) = S.tolist()
+    l00 = math.sqrt(s00)
+    l10 = s01 / l00
+    l20 = s02 / l00
+    l11 = math.sqrt(s11 - l10*l10)
+    l21 = (s12 - l20*l10) / l11
+    l22 = math.sqrt(s22 - l20*l20 - l21*l21)
+    b0, b1, b2 = B.tolist()
+    if out is None:
+        out = empty(B.shape, B.dtype)
+    for j in range(len(b0)):
+        z0 = b0[j] / l00
+        z1 = (b1[j] - l10*z0) / l11
+        z2 = (b2[j] - l20*z0 - l21*z1) / l22
+        x2 = z2 / l22
+        x1 = (z1 - l21*x2) / l11
+        out[0, j] = (z0 - l10*x1 - l20*x2) / l00
+        out[1, j] = x1
+        out[2, j] = x2
+    return out
+
+# Steps (predictions and updates) between renormalizations in float32.
+STABILIZE_PERIOD = 16
+
+def _symmetrize(P):
+    """Replace P, in place, by its symmetric part."""
+    P += P.T.copy()
+    P *= 0.5
 
 class QuaternionESKF:
-    def __init__(self, gn, mn):
-        self._gn = gn
-        self._mn = mn
+    """Multiplicative error-state Kalman filter of the sensor orientation.
+
+    By default acc and mag are applied as one 6-row measurement. With
+    sequential=True they are applied one block after the other, which
+    gives the same result since their noise is uncorrelated, and lets
+    either block be skipped: step() takes None for a missing measurement,
+    and a block whose normalized innovation squared exceeds acc_gate or
+    mag_gate is rejected and counted in acc_rejected or mag_rejected.
+
+    The noise model is set by:
+
+    * gyro_noise: process noise added to the covariance per second,
+    * acc_noise, acc_excess: the accelerometer variance is acc_noise plus
+      acc_excess times the squared deviation of |acc|^2 from 1, which
+      trusts it less while the board accelerates,
+    * acc_smoothing: weight of the newest sample in the running average
+      of the accelerometer variance,
+    * mag_noise: the magnetometer variance.
+
+    The state is held in dtype, float64 or float32. In float32 the
+    quaternion is renormalized and the covariance made symmetric every
+    STABILIZE_PERIOD steps, since rounding would otherwise let them drift
+    over long runs. The single-sample quat kernels (qmul, qexp, qrmat)
+    compute on Python floats, in double precision, and round the result
+    to float32; the matrix products, the solves and the batched kernels
+    that replay() runs over the whole recording up front (qexpn, rexpn)
+    compute in float32. stabilize=False turns the renormalization off, to
+    measure the drift it prevents.
+    """
+    def __init__(self, gn, mn, use_expm=False, sequential=False, acc_gate=None, mag_gate=None,
+                 gyro_noise=0.01, acc_noise=0.1, acc_excess=4.0, acc_smoothing=0.1, mag_noise=1.0,
+                 dtype=float64, stabilize=True):
+        if not sequential and (acc_gate is not None or mag_gate is not None):
+            raise ValueError("gating needs the sequential update")
+
+        self._dtype = dtype = check_dtype(dtype)
+        # Inputs are cast to a dtype other than float64, as it is not the
+        # type of the calibrated samples.
+        self._cast = dtype is not float64
+        self._stabilize = stabilize and self._cast
+        self._steps = 0
+        self._gn = asarray(gn, dtype)
+        self._mn = asarray(mn, dtype)
 
-        self._q = vec4(1.0, 0.0, 0.0, 0.0)
-        self._P = eye(3) #zeros((3, 3))
+        self._q = vec4(1.0, 0.0, 0.0, 0.0, dtype)
+        self._P = eye(3, dtype=dtype) #zeros((3, 3))
         self._acc_var = 0.0
+        self._var = mag_noise
+
+        self._gyro_noise = gyro_noise
+        self._acc_noise = acc_noise
+        self._acc_excess = acc_excess
+        self._acc_smoothing = acc_smoothing
+
+        # The general matrix exponential is kept for comparison only.
+        self._use_expm = use_expm
+        self._rexp = rexp_expm if use_expm else rexp
+
+        self._sequential = sequential
+        self._acc_gate = acc_gate
+        self._mag_gate = mag_gate
+        self.acc_rejected = 0
+        self.mag_rejected = 0
+
+    @property
+    def dtype(self):
+        return self._dtype
 
     @property
     def matrix(self):
@@ -21,40 +113,359 @@ class QuaternionESKF:
     def covariance(self):
         return self._P
 
-    def step(self, dt, acc, mag, rot):
-        # Form process noise covariance matrix.
-        Q = eye(3) * 0.01 * dt
+    def _restabilize(self):
+        """Count a step, and renormalize the state every STABILIZE_PERIOD."""
+        self._steps += 1
+        if self._steps >= STABILIZE_PERIOD:
+            self._steps = 0
+            qnormalize(self._q[:, 0], out=self._q[:, 0])
+            _symmetrize(self._P)
 
-        # Form measurement covariance matrix.
-        self._acc_var = 0.9 * self._acc_var + 0.1 * (0.1 + 4.0 * abs(1.0 - acc.T @ acc) ** 2)
-        self._var = 1.0
-        R = block([
-                [self._acc_var*1*eye(3), zeros((3,3))],
-                [zeros((3,3)), self._var*eye(3)]
-            ])
+    def _acc_variance(self, acc_var, acc2):
+        """Running accelerometer variance after a reading with |acc|^2 = acc2."""
+        s = self._acc_smoothing
+        return (1.0 - s) * acc_var + s * (self._acc_noise + self._acc_excess * abs(1.0 - acc2) ** 2)
+
+    def _correct(self, x, P, r, H, var, gate):
+        """Apply one 3-row measurement block with innovation r to the error
+        state x and its covariance P, in place. Returns the normalized
+        innovation squared, or None if the block is gated out."""
+        r = r - H @ x
+        HP = H @ P
+        S = HP @ H.T
+        S[0, 0] += var
+        S[1, 1] += var
+        S[2, 2] += var
+
+        # One factorization gives both the gain and the innovation test.
+        B = empty((3, 4), self._dtype)
+        B[:, 0:3] = HP
+        B[:, 3] = r
+        _cholsolve3(S, B, out=B)
+        nis = r @ B[:, 3]
+        if gate is not None and nis > gate:
+            return None
+
+        x += HP.T @ B[:, 3]
+        P -= HP.T @ B[:, 0:3]
+        return nis
+
+    def predict(self, dt, rot):
+        """Propagate the orientation and its covariance by dt with the
+        gyroscope measurement rot."""
+        if self._cast:
+            rot = asarray(rot, self._dtype)
+
+        # Form process noise covariance matrix.
+        Q = eye(3, dtype=self._dtype) * self._gyro_noise * dt
 
         # Prediction step
-        qp = qmull(self._q, qrotv(dt * rot))
+        qmul(self._q[:, 0], qexp(dt * rot[:, 0]), out=self._q[:, 0])
 
         # Markley & Crassidis
-        Fx = expm(-dt * xmat(rot))
-        Pp = Fx @ self._P @ Fx.T + Q
+        Fx = self._rexp(-dt * rot)
+        self._P = Fx @ self._P @ Fx.T + Q
+        if self._stabilize:
+            self._restabilize()
 
         # Kok
         # Fx = (dt / 2)**2 * rot @ rot.T + (eye(3) - (dt / 2) * xmat(rot)) @ (eye(3) - (dt / 2) * xmat(rot))
         # Fw = -dt * eye(3) + (dt / 2)**2 * xmat(rot)
         # Pp = Fx @ self._P @ Fx.T + Fw @ (5 * eye(3) * dt) @ Fw.T
 
+    def update(self, acc, mag):
+        """Correct the prediction with an accelerometer and a magnetometer
+        measurement; either may be None if it is missing."""
+        if self._cast:
+            acc = None if acc is None else asarray(acc, self._dtype)
+            mag = None if mag is None else asarray(mag, self._dtype)
+
+        # Form measurement covariance.
+        if acc is not None:
+            self._acc_var = self._acc_variance(self._acc_var, float(acc[:, 0] @ acc[:, 0]))
+
         # Update step
-        y = block([[acc], [mag]])
-        Rp = rmat3q(qp).T
-        yp = block([[-Rp @ self._gn], [Rp @ self._mn]])
-        Hx = block([[-xmat(Rp @ self._gn)], [xmat(Rp @ self._mn)]])
-        x = Pp @ Hx.T @ inv(Hx @ Pp @ Hx.T + R) @ (y - yp)
-        Pt = Pp - Pp @ Hx.T @ inv(Hx @ Pp @ Hx.T + R) @ Hx @ Pp
+        qp = self._q[:, 0]
+        Pp = self._P
+        Rp = qrmat(qp).T
+        g = Rp @ self._gn[:, 0]
+        m = Rp @ self._mn[:, 0]
+        if self._sequential or acc is None or mag is None:
+            x = zeros(3, self._dtype)
+            Pt = Pp.copy()
+            if acc is not None and self._correct(x, Pt, acc[:, 0] + g, skew(-g), self._acc_var, self._acc_gate) is None:
+                self.acc_rejected += 1
+            if mag is not None and self._correct(x, Pt, mag[:, 0] - m, skew(m), self._var, self._mag_gate) is None:
+                self.mag_rejected += 1
+        else:
+            y = concatenate((acc[:, 0], mag[:, 0]))
+            yp = concatenate((-g, m))
+            Hx = concatenate((skew(-g), skew(m)))
+            HP = Hx @ Pp
+            S = HP @ Hx.T
+            S[[0, 1, 2], [0, 1, 2]] += self._acc_var
+            S[[3, 4, 5], [3, 4, 5]] += self._var
+            # A single factorization of S serves both the state correction
+            # and the covariance update.
+            Kt = solve(S, HP)
+            x = (y - yp) @ Kt
+            Pt = Pp - Kt.T @ HP
 
         # Reset step
-        self._q = qmull(qp, qrotv(x))
+        qmul(qp, qexp(x), out=self._q[:, 0])
 #        self._P = Pt
-        J = eye(3) - (1/2) * xmat(x)
+        J = eye(3, dtype=self._dtype) - (1/2) * skew(x)
         self._P = J @ Pt @ J.T
+        if self._stabilize:
+            self._restabilize()
+
+    def update_acc(self, acc):
+        """Correct the prediction with an accelerometer measurement alone."""
+        self.update(acc, None)
+
+    def update_mag(self, mag):
+        """Correct the prediction with a magnetometer measurement alone."""
+        self.update(None, mag)
+
+    def step(self, dt, acc, mag, rot):
+        """Advance the filter by dt and correct it with one sample; acc or
+        mag may be None if that measurement is missing."""
+        self.predict(dt, rot)
+        self.update(acc, mag)
+
+    def replay(self, dt, samples, out=None, nis=None):
+        """Run the filter over a whole recording of calibrated samples.
+
+        samples is an (N, 9) array of acc/mag/rot rows and dt a scalar or
+        an (N,) array of time steps. Returns an (N, 4) array of quaternions
+        and an (N, 3, 3) array of covariances, written into out=(qs, Ps)
+        if given. The filter is left in the same state as if step() had
+        been called for every row in turn; the outputs agree with step()
+        to within 1e-12. If an (N,) array nis is given, the normalized
+        innovation squared of every sample is written into it (NaN where a
+        gated block was rejected); for a consistent noise model it
+        averages 6.
+        """
+        dtype = self._dtype
+        samples = asarray(samples, dtype=dtype)
+        n = samples.shape[0]
+        dt = broadcast_to(asarray(dt, dtype=dtype), (n,))
+        qs, Ps = out if out is not None else (empty((n, 4), dtype), empty((n, 3, 3), dtype))
+
+        # Everything that does not depend on the filter state is computed
+        # for the whole recording up front.
+        acc, rot = samples[:, 0:3], samples[:, 6:9]
+        ys = samples[:, 0:6]
+        ws = dt[:, newaxis] * rot
+        dqs = qexpn(ws)
+        if self._use_expm:
+            Fs = stack([rexp_expm(-w[:, newaxis]) for w in ws])
+        else:
+            Fs = rexpn(-ws)
+        Qs = self._gyro_noise * dt
+        accn = self._acc_noise + self._acc_excess * abs(1.0 - einsum('ij,ij->i', acc, acc)) ** 2
+        # Scalars of the filter's dtype: mixing float32 with Python floats
+        # goes through a slow conversion on every operation.
+        s = dtype(self._acc_smoothing)
+        s1 = dtype(1.0 - self._acc_smoothing)
+
+        gn = self._gn[:, 0]
+        mn = self._mn[:, 0]
+        q = self._q[:, 0].copy()
+        P = self._P.copy()
+        acc_var = dtype(self._acc_var)
+        mag_var = dtype(self._var)
+
+        # Per-sample work buffers.
+        qp = empty(4, dtype)
+        dq = empty(4, dtype)
+        Rp = empty((3, 3), dtype)
+        FP = empty((3, 3), dtype)
+        Pp = empty((3, 3), dtype)
+        H = zeros((6, 3), dtype)
+        HP = empty((6, 3), dtype)
+        S = empty((6, 6), dtype)
+        yp = empty(6, dtype)
+        J = eye(3, dtype=dtype)
+        JP = empty((3, 3), dtype)
+        x = empty(3, dtype)
+        stabilize = self._stabilize
+        steps = self._steps
+
+        for i in range(n):
+            acc_var = s1 * acc_var + s * accn[i]
+
+            # Prediction step
+            qmul(q, dqs[i], out=qp)
+            F = Fs[i]
+            matmul(F, P, out=FP)
+            matmul(FP, F.T, out=Pp)
+            Pp[0, 0] += Qs[i]
+            Pp[1, 1] += Qs[i]
+            Pp[2, 2] += Qs[i]
+
+            # Update step
+            qrmat(qp, out=Rp)
+            g = Rp.T @ gn
+            m = Rp.T @ mn
+            yp[0:3] = -g
+            yp[3:6] = m
+            skew(-g, out=H[0:3])
+            skew(m, out=H[3:6])
+            if self._sequential:
+                x[:] = 0.0
+                Pt = Pp
+                # The block NIS of sequential updates add up to the joint one.
+                acc_nis = self._correct(x, Pt, ys[i, 0:3] - yp[0:3], H[0:3], acc_var, self._acc_gate)
+                if acc_nis is None:
+                    self.acc_rejected += 1
+                mag_nis = self._correct(x, Pt, ys[i, 3:6] - yp[3:6], H[3:6], mag_var, self._mag_gate)
+                if mag_nis is None:
+                    self.mag_rejected += 1
+                if nis is not None:
+                    nis[i] = nan if acc_nis is None or mag_nis is None else acc_nis + mag_nis
+            else:
+                matmul(H, Pp, out=HP)
+                matmul(HP, H.T, out=S)
+                S[0, 0] += acc_var
+                S[1, 1] += acc_var
+                S[2, 2] += acc_var
+                S[3, 3] += mag_var
+                S[4, 4] += mag_var
+                S[5, 5] += mag_var
+                r = ys[i] - yp
+                if nis is not None:
+                    B = solve(S, concatenate((HP, r[:, newaxis]), axis=1))
+                    Kt = B[:, 0:3]
+                    nis[i] = r @ B[:, 3]
+                else:
+                    Kt = solve(S, HP)
+                matmul(r, Kt, out=x)
+                Pt = Pp - Kt.T @ HP
+
+            # Reset step
+            qmul(qp, qexp(x, out=dq), out=q)
+            skew(-0.5 * x, out=J)
+            J[0, 0] = J[1, 1] = J[2, 2] = 1.0
+            matmul(J, Pt, out=JP)
+            matmul(JP, J.T, out=P)
+            if stabilize:
+                # As step(): a prediction and an update.
+                steps += 2
+                if steps >= STABILIZE_PERIOD:
+                    steps = 0
+                    qnormalize(q, out=q)
+                    _symmetrize(P)
+
+            qs[i] = q
+            Ps[i] = P
+
+        self._q = q.reshape(4, 1).copy()
+        self._P = P.copy()
+        self._acc_var = float(acc_var)
+        self._steps = steps
+
+        return qs, Ps
+
+class QuaternionESKFBank:
+    """A bank of k independent QuaternionESKF filters stepped together.
+
+    The filter states are held in stacked (k, 4) and (k, 3, 3) arrays and
+    every step() advances all of them with batched array operations. The
+    noise parameters and dtype are those of QuaternionESKF; in float32 the
+    bank takes half the memory, and is renormalized on every step, since
+    masked steps advance its filters unevenly. All of its arithmetic is
+    batched and done in dtype.
+    """
+    def __init__(self, gn, mn, k, gyro_noise=0.01, acc_noise=0.1, acc_excess=4.0, acc_smoothing=0.1, mag_noise=1.0,
+                 dtype=float64):
+        self._dtype = dtype = check_dtype(dtype)
+        self._stabilize = dtype is not float64
+        self._gn = asarray(gn[:, 0], dtype)
+        self._mn = asarray(mn[:, 0], dtype)
+        self._gyro_noise = gyro_noise
+        self._acc_noise = acc_noise
+        self._acc_excess = acc_excess
+        self._acc_smoothing = acc_smoothing
+        self._mag_noise = mag_noise
+
+        self._q = zeros((k, 4), dtype)
+        self._q[:, 0] = 1.0
+        self._P = tile(eye(3, dtype=dtype), (k, 1, 1))
+        self._acc_var = zeros(k, dtype)
+
+    def __len__(self):
+        return len(self._q)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def quaternions(self):
+        return self._q
+
+    @property
+    def matrices(self):
+        return qrmatn(self._q)
+
+    @property
+    def covariances(self):
+        return self._P
+
+    def step(self, dt, acc, mag, rot, mask=None):
+        """Step every filter; acc, mag and rot are (k, 3) arrays and dt a
+        scalar or a (k,) array. Filters whose entry in the optional boolean
+        mask is false have no new sample and are left untouched.
+        """
+        k = len(self._q)
+        dtype = self._dtype
+        dt = broadcast_to(asarray(dt, dtype=dtype), (k,))
+        if self._stabilize:
+            acc, mag, rot = asarray(acc, dtype), asarray(mag, dtype), asarray(rot, dtype)
+        if mask is not None:
+            idx = flatnonzero(mask)
+            if len(idx) == 0:
+                return
+            dt, acc, mag, rot = dt[idx], acc[idx], mag[idx], rot[idx]
+            q, P, acc_var = self._q[idx], self._P[idx], self._acc_var[idx]
+        else:
+            q, P, acc_var = self._q, self._P, self._acc_var
+        # Form measurement covariance.
+        s = self._acc_smoothing
+        acc_var = (1.0 - s) * acc_var + s * (self._acc_noise + self._acc_excess * abs(1.0 - einsum('ij,ij->i', acc, acc)) ** 2)
+
+        # Prediction step
+        w = dt[:, newaxis] * rot
+        qp = qmuln(q, qexpn(w))
+        F = rexpn(-w)
+        Pp = F @ P @ F.transpose(0, 2, 1)
+        Pp += (self._gyro_noise * dt)[:, newaxis, newaxis] * eye(3, dtype=dtype)
+
+        # Update step
+        Rp = qrmatn(qp)
+        g = Rp.transpose(0, 2, 1) @ self._gn
+        m = Rp.transpose(0, 2, 1) @ self._mn
+        y = concatenate((acc, mag), axis=1)
+        yp = concatenate((-g, m), axis=1)
+        H = concatenate((-skewn(g), skewn(m)), axis=1)
+        HP = H @ Pp
+        S = HP @ H.transpose(0, 2, 1)
+        S[:, [0, 1, 2], [0, 1, 2]] += acc_var[:, newaxis]
+        S[:, [3, 4, 5], [3, 4, 5]] += self._mag_noise
+        Kt = solve(S, HP)
+        x = einsum('ni,nij->nj', y - yp, Kt)
+        Pt = Pp - Kt.transpose(0, 2, 1) @ HP
+
+        # Reset step
+        q = qmuln(qp, qexpn(x))
+        J = eye(3, dtype=dtype) - 0.5 * skewn(x)
+        P = J @ Pt @ J.transpose(0, 2, 1)
+        if self._stabilize:
+            q = qnormalizen(q, out=q)
+            P = 0.5 * (P + P.transpose(0, 2, 1))
+
+        if mask is not None:
+            self._q[idx], self._P[idx], self._acc_var[idx] = q, P, acc_var
+        else:
+            self._q, self._P, self._acc_var = q, P, acc_var
@@ -1,16 +1,26 @@
-from numpy import array, block, eye, zeros, trace
+from numpy import array, block, eye, zeros, empty, trace, float64
 from numpy.linalg import inv, norm, det
-from scipy.linalg import expm
-from numpyx import vec3, vec4, qmull, qrotv, xmat, rmat3q, rmat4q
+from numpyx import vec3, vec4, xmat, rmat4q, check_dtype
+from quat import qmul, qexp, qnormalize
 from math import sin, cos, radians
 
 class QuaternionIntegrator:
-    def __init__(self):
-        self._q = vec4(1.0, 0.0, 0.0, 0.0)
+    def __init__(self, dtype=float64):
+        self._dtype = dtype = check_dtype(dtype)
+        self._stabilize = dtype is not float64
+        self._q = vec4(1.0, 0.0, 0.0, 0.0, dtype)
+        self._dq = empty(4, dtype)
+
+    @property
+    def dtype(self):
+        return self._dtype
 
     @property
     def matrix(self):
         return rmat4q(self._q)
 
     def step(self, dt, rot):
-        self._q = qmull(self._q, qrotv(dt * rot))
+        q = self._q[:, 0]
+        qmul(q, qexp(dt * rot[:, 0], out=self._dq), out=q)
+        if self._stabilize:
+            qnormalize(q, out=q)
@@ -0,0 +1,182 @@
+"""Low-level quaternion and rotation kernels.
+
+Quaternions are flat float64 or float32 arrays [w, x, y, z] and vectors
+flat 3-element arrays; the batched variants (suffix n) work on the rows
+of (N, 4) and (N, 3) arrays. Every function takes an optional out array
+that the result is written into and returned; out may alias an input.
+Results that are allocated take the dtype of the (first) input. The
+single-element variants do their arithmetic on Python floats, in double
+precision whatever the dtype, so with out given they allocate no arrays
+at all.
+"""
+
+import math
+from numpy import empty, einsum, sqrt, sin, cos, where, newaxis
+
+def qmul(p, q, out=None):
+    """Hamiltonian quaternion product of p and q."""
+    p0, p1, p2, p3 = p.tolist()
+    q0, q1, q2, q3 = q.tolist()
+    if out is None:
+        out = empty(4, p.dtype)
+    out[0] = p0*q0 - p1*q1 - p2*q2 - p3*q3
+    out[1] = p0*q1 + p1*q0 + p2*q3 - p3*q2
+    out[2] = p0*q2 - p1*q3 + p2*q0 + p3*q1
+    out[3] = p0*q3 + p1*q2 - p2*q1 + p3*q0
+    return out
+
+def qexp(v, out=None):
+    """Unit quaternion of the rotation by rotation vector v."""
+    v0, v1, v2 = v.tolist()
+    d2 = v0*v0 + v1*v1 + v2*v2
+    if d2 < 1e-12:
+        # Series of cos(d/2) and sin(d/2)/d.
+        c = 1.0 - d2/8.0
+        s = 0.5 - d2/48.0
+    else:
+        d = math.sqrt(d2)
+        c = math.cos(d/2)
+        s = math.sin(d/2) / d
+    if out is None:
+        out = empty(4, v.dtype)
+    out[0] = c
+    out[1] = s*v0
+    out[2] = s*v1
+    out[3] = s*v2
+    return out
+
+def qrmat(q, out=None):
+    """Rotation matrix of quaternion q (as numpyx.rmat3q)."""
+    q0, q1, q2, q3 = q.tolist()
+    d = q0*q0 - q1*q1 - q2*q2 - q3*q3
+    if out is None:
+        out = empty((3, 3), q.dtype)
+    out[0, 0] = d + 2*q1*q1
+    out[0, 1] = 2*(q1*q2 - q0*q3)
+    out[0, 2] = 2*(q1*q3 + q0*q2)
+    out[1, 0] = 2*(q1*q2 + q0*q3)
+    out[1, 1] = d + 2*q2*q2
+    out[1, 2] = 2*(q2*q3 - q0*q1)
+    out[2, 0] = 2*(q1*q3 - q0*q2)
+    out[2, 1] = 2*(q2*q3 + q0*q1)
+    out[2, 2] = d + 2*q3*q3
+    return out
+
+def rmatq(m, out=None):
+    """Unit quaternion, with w >= 0, of a 3x3 rotation matrix m (the
+    inverse of qrmat). The largest component is found from the diagonal
+    and the others from the off-diagonal terms, which keeps it accurate
+    for every rotation."""
+    (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = m[0:3, 0:3].tolist()
+    t = m00 + m11 + m22
+    if t > 0.0:
+        s = 0.5 / math.sqrt(1.0 + t)
+        q0, q1, q2, q3 = 0.25 / s, (m21 - m12) * s, (m02 - m20) * s, (m10 - m01) * s
+    elif m00 >= m11 and m00 >= m22:
+        s = 0.5 / math.sqrt(1.0 + m00 - m11 - m22)
+        q0, q1, q2, q3 = (m21 - m12) * s, 0.25 / s, (m01 + m10) * s, (m02 + m20) * s
+    elif m11 >= m22:
+        s = 0.5 / math.sqrt(1.0 - m00 + m11 - m22)
+        q0, q1, q2, q3 = (m02 - m20) * s, (m01 + m10) * s, 0.25 / s, (m12 + m21) * s
+    else:
+        s = 0.5 / math.sqrt(1.0 - m00 - m11 + m22)
+        q0, q1, q2, q3 = (m10 - m01) * s, (m02 + m20) * s, (m12 + m21) * s, 0.25 / s
+    if q0 < 0.0:
+        q0, q1, q2, q3 = -q0, -q1, -q2, -q3
+    if out is None:
+        out = empty(4, m.dtype)
+    out[0] = q0
+    out[1] = q1
+    out[2] = q2
+    out[3] = q3
+    return out
+
+def qnormalize(q, out=None):
+    """Scale q to unit length."""
+    q0, q1, q2, q3 = q.tolist()
+    r = 1.0 / math.sqrt(q0*q0 + q1*q1 + q2*q2 + q3*q3)
+    if out is None:
+        out = empty(4, q.dtype)
+    out[0] = q0*r
+    out[1] = q1*r
+    out[2] = q2*r
+    out[3] = q3*r
+    return out
+
+def skew(v, out=None):
+    """Left cross-product matrix of v (as numpyx.xmat)."""
+    v0, v1, v2 = v.tolist()
+    if out is None:
+        out = empty((3, 3), v.dtype)
+    out[0, 0] = 0.0
+    out[0, 1] = -v2
+    out[0, 2] = v1
+    out[1, 0] = v2
+    out[1, 1] = 0.0
+    out[1, 2] = -v0
+    out[2, 0] = -v1
+    out[2, 1] = v0
+    out[2, 2] = 0.0
+    return out
+
+# -----------------------------------------------------------------------------
+
+def qmuln(p, q, out=None):
+    """Batched qmul() over the rows of two (N, 4) arrays."""
+    p0, p1, p2, p3 = p[:, 0], p[:, 1], p[:, 2], p[:, 3]
+    q0, q1, q2, q3 = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    r0 = p0*q0 - p1*q1 - p2*q2 - p3*q3
+    r1 = p0*q1 + p1*q0 + p2*q3 - p3*q2
+    r2 = p0*q2 - p1*q3 + p2*q0 + p3*q1
+    r3 = p0*q3 + p1*q2 - p2*q1 + p3*q0
+    if out is None:
+        out = empty(p.shape, p.dtype)
+    out[:, 0], out[:, 1], out[:, 2], out[:, 3] = r0, r1, r2, r3
+    return out
+
+def qexpn(v, out=None):
+    """Batched qexp() over the rows of an (N, 3) array, giving (N, 4)."""
+    d2 = einsum('ij,ij->i', v, v)
+    small = d2 < 1e-12
+    d = sqrt(where(small, 1.0, d2))
+    c = where(small, 1.0 - d2/8.0, cos(d/2))
+    s = where(small, 0.5 - d2/48.0, sin(d/2) / d)
+    if out is None:
+        out = empty((len(v), 4), v.dtype)
+    out[:, 0] = c
+    out[:, 1:4] = s[:, newaxis] * v
+    return out
+
+def qrmatn(q, out=None):
+    """Batched qrmat() over the rows of an (N, 4) array, giving (N, 3, 3)."""
+    q0, q1, q2, q3 = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    d = q0*q0 - q1*q1 - q2*q2 - q3*q3
+    if out is None:
+        out = empty((len(q), 3, 3), q.dtype)
+    out[:, 0, 0] = d + 2*q1*q1
+    out[:, 0, 1] = 2*(q1*q2 - q0*q3)
+    out[:, 0, 2] = 2*(q1*q3 + q0*q2)
+    out[:, 1, 0] = 2*(q1*q2 + q0*q3)
+    out[:, 1, 1] = d + 2*q2*q2
+    out[:, 1, 2] = 2*(q2*q3 - q0*q1)
+    out[:, 2, 0] = 2*(q1*q3 - q0*q2)
+    out[:, 2, 1] = 2*(q2*q3 + q0*q1)
+    out[:, 2, 2] = d + 2*q3*q3
+    return out
+
+def qnormalizen(q, out=None):
+    """Batched qnormalize() over the rows of an (N, 4) array."""
+    r = 1.0 / sqrt(einsum('ij,ij->i', q, q))
+    if out is None:
+        out = empty(q.shape, q.dtype)
+    out[...] = q * r[:, newaxis]
+    return out
+
+def skewn(v, out=None):
+    """Batched skew() over the rows of an (N, 3) array, giving (N, 3, 3)."""
+    if out is None:
+        out = empty((len(v), 3, 3), v.dtype)
+    out[:, 0, 0], out[:, 0, 1], out[:, 0, 2] = 0.0, -v[:, 2], v[:, 1]
+    out[:, 1, 0], out[:, 1, 1], out[:, 1, 2] = v[:, 2], 0.0, -v[:, 0]
+    out[:, 2, 0], out[:, 2, 1], out[:, 2, 2] = -v[:, 1], v[:, 0], 0.0
+    return out
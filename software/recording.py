@@ -0,0 +1,172 @@
+"""Binary recording format.
+
+A recording is a fixed 64-byte header followed by an array of fixed-size
+little-endian records. The header holds a magic string, the record layout
+version, the header size and the record size; the number of records is
+implied by the file size, so a recording that was cut short by a crash
+is still readable up to its last complete record.
+
+Version 1 records hold the host time of the sample, the nine raw sensor
+values (acc, mag, rot) and the 3x3 rotation matrices of the four
+estimators in the same order as the old text recordings. Version 2 adds
+the microsecond stamp the board gave the sample (NaN if it sent none),
+so that sensorclock.SensorClock replays the timing of the live run.
+"""
+
+import os
+import sys
+from numpy import dtype, zeros, full, nan, memmap, frombuffer, loadtxt, float32, arange
+
+MAGIC = b'IMUREC\0\0'
+VERSION = 2
+
+HEADER_DTYPE = dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('header_size', '<u4'),
+    ('record_size', '<u4'),
+    ('reserved', 'V44'),
+])
+
+RECORD_DTYPES = {
+    1: dtype([
+        ('time', '<f8'),
+        ('raw', '<f4', (9,)),
+        ('accmag', '<f4', (3, 3)),
+        ('gyro', '<f4', (3, 3)),
+        ('qeskf', '<f4', (3, 3)),
+        ('vkf', '<f4', (3, 3)),
+    ]),
+    2: dtype([
+        ('time', '<f8'),
+        ('stamp', '<f8'),
+        ('raw', '<f4', (9,)),
+        ('accmag', '<f4', (3, 3)),
+        ('gyro', '<f4', (3, 3)),
+        ('qeskf', '<f4', (3, 3)),
+        ('vkf', '<f4', (3, 3)),
+    ]),
+}
+
+ESTIMATORS = ('accmag', 'gyro', 'qeskf', 'vkf')
+
+class RecordingWriter:
+    """Appends records to a new binary recording."""
+    def __init__(self, path, version=VERSION):
+        self._dtype = RECORD_DTYPES[version]
+        self._record = zeros(1, self._dtype)
+        self._file = open(path, 'wb')
+
+        header = zeros(1, HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = version
+        header['header_size'] = HEADER_DTYPE.itemsize
+        header['record_size'] = self._dtype.itemsize
+        self._file.write(header.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, time, raw, stamp=nan, **matrices):
+        """Write one record; matrices are given by estimator name and may
+        be 3x3 or 4x4 homogeneous rotation matrices."""
+        record = self._record
+        record['time'] = time
+        if 'stamp' in record.dtype.names:
+            record['stamp'] = stamp
+        record['raw'] = raw
+        for name in ESTIMATORS:
+            m = matrices.get(name)
+            record[name] = nan if m is None else m[0:3, 0:3]
+        self._file.write(record.tobytes())
+
+    def write_records(self, records):
+        """Write a structured array of records in one go."""
+        self._file.write(records.astype(self._dtype, copy=False).tobytes())
+
+    def close(self):
+        self._file.close()
+
+class Recording:
+    """Read-only, memory-mapped view of a binary recording."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = frombuffer(f.read(HEADER_DTYPE.itemsize), HEADER_DTYPE)[0]
+        if header['magic'] != MAGIC.rstrip(b'\0'):
+            raise ValueError("%s is not a recording" % path)
+        version = int(header['version'])
+        if version not in RECORD_DTYPES:
+            raise ValueError("%s has unsupported record version %d" % (path, version))
+        record_dtype = RECORD_DTYPES[version]
+        if header['record_size'] != record_dtype.itemsize:
+            raise ValueError("%s has a corrupt header" % path)
+
+        offset = int(header['header_size'])
+        count = (os.path.getsize(path) - offset) // record_dtype.itemsize
+
+        self.version = version
+        self.path = path
+        if count > 0:
+            self.records = memmap(path, record_dtype, 'r', offset, (count,))
+        else:
+            self.records = zeros(0, record_dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    @property
+    def time(self):
+        return self.records['time']
+
+    @property
+    def stamp(self):
+        """Board stamps of the samples; NaN for recordings without them."""
+        if 'stamp' in self.records.dtype.names:
+            return self.records['stamp']
+        return full(len(self.records), nan)
+
+    @property
+    def raw(self):
+        return self.records['raw']
+
+    def between(self, t0, t1):
+        """Return the records with t0 <= time < t1 without reading the rest."""
+        i0, i1 = self.time.searchsorted([t0, t1])
+        return self.records[i0:i1]
+
+def next_recording_path(directory, extension='rec'):
+    """Return the first unused output/dataN path in directory."""
+    for i in range(1, 10000):
+        path = os.path.join(directory, "data%d.%s" % (i, extension))
+        if not os.path.exists(path):
+            return path
+    raise RuntimeError("no free recording name in %s" % directory)
+
+def convert_text(src, dst, period=0.02):
+    """Convert an old text recording into the binary format.
+
+    Text recordings hold only the 36 matrix elements per line, so the
+    time is reconstructed from the nominal sample period and the raw
+    sensor fields are filled with NaN.
+    """
+    elems = loadtxt(src, dtype=float32, ndmin=2)
+    records = zeros(len(elems), RECORD_DTYPES[VERSION])
+    records['time'] = arange(len(elems)) * period
+    records['stamp'] = nan
+    records['raw'] = nan
+    for i, name in enumerate(ESTIMATORS):
+        records[name] = elems[:, 9*i:9*i+9].reshape(-1, 3, 3)
+    with RecordingWriter(dst) as writer:
+        writer.write_records(records)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: %s data.txt data.rec" % sys.argv[0])
+        sys.exit(1)
+    convert_text(sys.argv[1], sys.argv[2])
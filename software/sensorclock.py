@@ -0,0 +1,141 @@
+"""Sample timing from the board's microsecond counter.
+
+The board stamps every sample with its 32-bit microsecond counter, which
+wraps about every 71.6 minutes. SensorClock turns the stamps into time
+steps that carry none of the host's scheduling or serial jitter:
+
+* the counter is unwrapped into a continuous sensor time,
+* the rate of the board's crystal against the host clock is estimated by
+  a least-squares line through the (sensor time, host time) pairs with
+  exponential forgetting, and the time steps are corrected by it,
+* gaps of more than half a period beyond the nominal one are counted as
+  missed samples,
+* a jump backwards or longer than max_gap (the board restarted) restarts
+  the clock and is counted in restarts.
+
+The clock depends only on the stamps and host times it is given, so a
+recording that holds both replays to exactly the same time steps as the
+live run.
+"""
+
+from math import exp, isnan
+from numpy import empty, float64
+
+class SensorClock:
+    """Time steps of successive samples from their board stamps."""
+    def __init__(self, period=0.02, tick=1e-6, bits=32, max_gap=1.0, memory=600.0, min_span=10.0, max_skew=1e-3):
+        self.period = period
+        self._tick = tick
+        self._modulus = 1 << bits
+        self._max_gap = max_gap
+        self._memory = memory
+        self._min_span = min_span
+        self._max_skew = max_skew
+
+        self.missed = 0
+        self.wraps = 0
+        self.restarts = 0
+        self._reset()
+
+    def _reset(self):
+        self._stamp = None
+        self._host = None
+        self._sensor = 0.0
+        self._time = 0.0
+        self._rate = 1.0
+
+        # Weighted sums of the regression of host time on sensor time,
+        # relative to the first sample after a (re)start.
+        self._origin = None
+        self._span = 0.0
+        self._w = self._s = self._h = self._ss = self._sh = 0.0
+
+    @property
+    def time(self):
+        """Seconds since the first sample, in host clock units."""
+        return self._time
+
+    @property
+    def rate(self):
+        """Host seconds per sensor second."""
+        return self._rate
+
+    def _fit(self, s, h, dt):
+        """Add one (sensor time, host time) pair to the rate estimate."""
+        if self._origin is None:
+            self._origin = (s, h)
+        s -= self._origin[0]
+        h -= self._origin[1]
+        f = exp(-dt / self._memory)
+        self._w = f * self._w + 1.0
+        self._s = f * self._s + s
+        self._h = f * self._h + h
+        self._ss = f * self._ss + s * s
+        self._sh = f * self._sh + s * h
+        self._span = s
+
+        if self._span >= self._min_span:
+            d = self._w * self._ss - self._s * self._s
+            if d > 0.0:
+                rate = (self._w * self._sh - self._s * self._h) / d
+                self._rate = min(max(rate, 1.0 - self._max_skew), 1.0 + self._max_skew)
+
+    def update(self, stamp, host_time):
+        """Take the stamp and host time of the next sample.
+
+        Returns the time of the sample and the step since the previous
+        one, in seconds; the step is None for the first sample. A NaN
+        stamp falls back to the host time difference.
+        """
+        if isnan(stamp):
+            dt = None if self._host is None else host_time - self._host
+            self._host = host_time
+            if dt is not None:
+                self._time += dt
+            return self._time, dt
+
+        stamp = int(stamp)
+        if self._stamp is None:
+            self._stamp, self._host = stamp, host_time
+            self._fit(0.0, host_time, 0.0)
+            return self._time, None
+
+        ds = ((stamp - self._stamp) % self._modulus) * self._tick
+        if ds > self._max_gap:
+            # The board restarted; carry on from the nominal period.
+            self.restarts += 1
+            t = self._time + self.period
+            self._reset()
+            self._time = t
+            self._stamp, self._host = stamp, host_time
+            self._fit(0.0, host_time, 0.0)
+            return self._time, self.period
+
+        if stamp < self._stamp:
+            self.wraps += 1
+        if ds > 1.5 * self.period:
+            self.missed += int(round(ds / self.period)) - 1
+
+        self._stamp, self._host = stamp, host_time
+        self._sensor += ds
+        self._fit(self._sensor, host_time, ds)
+
+        dt = ds * self._rate
+        self._time += dt
+        return self._time, dt
+
+def sample_times(stamps, host_times, clock=None):
+    """Run a SensorClock over arrays of stamps and host times.
+
+    Returns (n,) arrays of sample times and time steps; the first step is
+    NaN. Used to replay recordings with the timing of the live run.
+    """
+    clock = clock or SensorClock()
+    n = len(stamps)
+    times = empty(n, dtype=float64)
+    dts = empty(n, dtype=float64)
+    for i, (stamp, host) in enumerate(zip(stamps.tolist(), host_times.tolist())):
+        t, dt = clock.update(stamp, host)
+        times[i] = t
+        dts[i] = float('nan') if dt is None else dt
+    return times, dts
@@ -0,0 +1,376 @@
+"""Latest estimator outputs in shared memory, for other processes.
+
+A Publisher owns a block of multiprocessing.shared_memory holding one
+frame: a header with a sequence number and the times of the sample, and
+for each estimator (in the order of recording.ESTIMATORS) its unit
+quaternion [w, x, y, z], 3x3 rotation matrix and 3x3 orientation
+covariance. Only the QuaternionESKF has an orientation covariance; the
+others are NaN. Everything is little-endian float64, laid out as
+FRAME_DTYPE, so a reader in another language can map it too.
+
+The frame is guarded by a seqlock. The writer makes the sequence number
+odd, copies the new frame into the block and makes it even again; it
+never waits for readers. A reader copies the frame out between two reads
+of the sequence number and retries if they differ or are odd, so it never
+sees a torn frame and never takes a lock. Between retries it yields the
+CPU, so that a writer it interrupted can finish, and it gives up after
+READ_TIMEOUT seconds, should the writer have died mid-frame. The frame is filled in private
+memory first, so the odd window is one copy of under a kilobyte. This
+relies on stores and loads to the block being seen in program order, as
+they are on x86; weakly ordered CPUs would need barriers that Python
+cannot issue.
+
+The header's 'output' field is time.perf_counter_ns() when the filters
+produced the frame; on Linux and Windows that clock is shared by all
+processes, so a reader's own perf_counter_ns() minus it is the latency.
+
+    python headless.py --publish --quiet        # writer
+    python shmpub.py                            # print the latest orientation
+    python shmpub.py --measure --rate 1000      # latency of a test writer
+
+Publishing a frame of all four estimators takes about 21 us and reading
+one 2.3 us, so that is the latency when the reader runs on a core of its
+own and spins on the sequence number. When the processes share a CPU the
+scheduler decides: on a single-core machine, with the reader polling every
+100 us, the latency at 200 and 1000 frames per second was 120-130 us
+median, 530-590 us at the 99th percentile and up to a few milliseconds at
+worst, and a spinning reader there only starves the writer. --measure
+reports these figures for the machine at hand.
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+from time import perf_counter_ns
+from multiprocessing import shared_memory
+from numpy import dtype, zeros, frombuffer, copyto, nan, uint8, uint64, percentile, asarray
+
+from quat import qrmat, rmatq
+from recording import ESTIMATORS
+
+NAME = 'imu-orientation'
+MAGIC = 0x4f524931  # 'ORI1'
+VERSION = 1
+
+ESTIMATOR_DTYPE = dtype([
+    ('quaternion', '<f8', (4,)),
+    ('matrix', '<f8', (3, 3)),
+    ('covariance', '<f8', (3, 3)),
+])
+
+FRAME_DTYPE = dtype([
+    ('magic', '<u4'),
+    ('version', '<u4'),
+    ('seq', '<u8'),
+    ('time', '<f8'),       # sensor clock time of the sample, seconds
+    ('host_time', '<f8'),  # host time the sample arrived, seconds
+    ('output', '<i8'),     # perf_counter_ns() when the frame was produced
+    ('estimators', ESTIMATOR_DTYPE, (len(ESTIMATORS),)),
+])
+
+# Seconds a read() retries for before giving up on the writer.
+READ_TIMEOUT = 0.1
+
+# Gives the CPU to another thread or process; a reader that finds the
+# writer mid-frame lets it finish rather than spinning.
+_yield = getattr(os, 'sched_yield', None) or (lambda: time.sleep(0))
+
+_MAGIC_BYTES = MAGIC.to_bytes(4, 'little')
+
+# Bytes of the frame before and after the sequence number.
+_SEQ = FRAME_DTYPE.fields['seq'][1]
+_BODY = _SEQ + 8
+
+def _orthonormalize(up, m, out):
+    """tracker.orthonormalize(-up, m) of column vectors up and m, as a 3x3
+    matrix written into out, in Python floats as it runs on every frame.
+    Like it, gives NaN where up is zero or parallel to m."""
+    g0, g1, g2 = up[:, 0].tolist()
+    m0, m1, m2 = m[:, 0].tolist()
+    d = g0*g0 + g1*g1 + g2*g2
+    r = 1.0 / math.sqrt(d) if d > 0.0 else nan
+    z0, z1, z2 = g0*r, g1*r, g2*r
+    x0, x1, x2 = m1*z2 - m2*z1, m2*z0 - m0*z2, m0*z1 - m1*z0
+    d = x0*x0 + x1*x1 + x2*x2
+    r = 1.0 / math.sqrt(d) if d > 0.0 else nan
+    x0, x1, x2 = x0*r, x1*r, x2*r
+    out[0] = x0, x1, x2
+    out[1] = z1*x2 - z2*x1, z2*x0 - z0*x2, z0*x1 - z1*x0
+    out[2] = z0, z1, z2
+    return out
+
+# Blocks created by Publishers of this process.
+_created = set()
+
+def _open(name):
+    """Attach to an existing block without handing it to the resource
+    tracker, which would unlink it when this process exits."""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        if os.name == 'posix' and shm.name not in _created:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class Publisher:
+    """Writes the outputs of a Tracker to a shared memory block name."""
+    def __init__(self, name=NAME):
+        self._shm = shared_memory.SharedMemory(name, create=True, size=FRAME_DTYPE.itemsize)
+        _created.add(self._shm.name)
+        self._bytes = frombuffer(self._shm.buf, uint8, FRAME_DTYPE.itemsize)
+        self._seq_view = self._bytes[_SEQ:_BODY].view(uint64)
+        self._seq = 0
+
+        self._frame = zeros(1, FRAME_DTYPE)
+        self._frame_bytes = self._frame.view(uint8)
+        self._frame['magic'] = MAGIC
+        self._frame['version'] = VERSION
+        estimators = self._frame['estimators'][0]
+        estimators['covariance'] = nan
+        # (quaternion, matrix, covariance) views of each estimator, as
+        # indexing the record makes new ones every time.
+        self._qeskf, self._gyro, self._accmag, self._vkf = (
+            tuple(estimators[ESTIMATORS.index(name)][field] for field in ESTIMATOR_DTYPE.names)
+            for name in ('qeskf', 'gyro', 'accmag', 'vkf'))
+        self._bytes[:] = self._frame_bytes
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def seq(self):
+        """Frames published so far."""
+        return self._seq // 2
+
+    def publish(self, tracker, t, host_time, output=None):
+        """Publish the current state of tracker for the sample at sensor
+        time t and host time host_time; output is the perf_counter_ns()
+        time the filters finished, by default now."""
+        if output is None:
+            output = perf_counter_ns()
+        frame = self._frame
+        frame['time'] = t
+        frame['host_time'] = host_time
+        frame['output'] = output
+
+        # The estimators give either a quaternion or a matrix; the other
+        # is derived from it.
+        q, m, P = self._qeskf
+        q[:] = tracker.qeskf._q[:, 0]
+        qrmat(q, out=m)
+        P[:] = tracker.qeskf._P
+        q, m, _ = self._gyro
+        q[:] = tracker.qint._q[:, 0]
+        qrmat(q, out=m)
+        q, m, _ = self._accmag
+        m[:] = tracker.accmag_matrix[0:3, 0:3]
+        rmatq(m, out=q)
+        q, m, _ = self._vkf
+        _orthonormalize(tracker.acc_vekf.vector, tracker.mag_vekf.vector, m)
+        rmatq(m, out=q)
+
+        # The seqlock: odd while the block is being written.
+        self._seq_view[0] = self._seq + 1
+        self._bytes[_BODY:] = self._frame_bytes[_BODY:]
+        self._seq += 2
+        self._seq_view[0] = self._seq
+
+    def close(self):
+        """Mark the block closed for readers and remove it."""
+        self._bytes[0:4] = 0
+        del self._seq_view, self._bytes
+        self._shm.close()
+        self._shm.unlink()
+        _created.discard(self._shm.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Subscriber:
+    """Reads consistent snapshots of the frames of a Publisher."""
+    def __init__(self, name=NAME):
+        self._shm = _open(name)
+        self._bytes = frombuffer(self._shm.buf, uint8, FRAME_DTYPE.itemsize)
+        self._seq_view = self._bytes[_SEQ:_BODY].view(uint64)
+        magic, version = self._bytes[0:8].view('<u4').tolist()
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("%s is not an orientation block of version %d" % (name, VERSION))
+        self.retries = 0
+
+    @property
+    def seq(self):
+        """Sequence number of the latest frame, odd while it is written."""
+        return int(self._seq_view[0])
+
+    @property
+    def alive(self):
+        """Whether the publisher still has the block open."""
+        return int(self._bytes[0:4].view('<u4')[0]) == MAGIC
+
+    def snapshot(self):
+        """A frame to read() into: a 0-d array of FRAME_DTYPE, indexed as
+        frame['estimators'][ESTIMATORS.index('qeskf')]['quaternion']."""
+        return zeros((), FRAME_DTYPE)
+
+    def read(self, out=None, timeout=READ_TIMEOUT):
+        """Copy the latest complete frame into out (or a new snapshot()),
+        retrying while the writer is in the middle of one, and return it
+        with its sequence number in out['seq'].
+
+        Between retries the CPU is yielded to the writer. Raises
+        RuntimeError if the publisher has closed the block, or if no
+        complete frame could be read for timeout seconds, as when the
+        writer died in the middle of one.
+        """
+        if out is None:
+            out = self.snapshot()
+        dst = out.reshape(1).view(uint8)
+        deadline = None
+        while True:
+            seq = int(self._seq_view[0])
+            if not seq & 1:
+                copyto(dst, self._bytes)
+                if int(self._seq_view[0]) == seq:
+                    if dst[0:4].tobytes() != _MAGIC_BYTES:
+                        raise RuntimeError("the publisher has closed the block")
+                    return out
+            self.retries += 1
+            if not self.alive:
+                raise RuntimeError("the publisher has closed the block")
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + timeout
+            elif now > deadline:
+                raise RuntimeError("no complete frame in %g s; the publisher may have died" % timeout)
+            _yield()
+
+    def wait(self, seq, timeout=None, sleep=0.0):
+        """Wait for a frame after sequence number seq, polling every sleep
+        seconds (spinning if 0). Returns the new sequence number, or None on
+        timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            s = int(self._seq_view[0])
+            if s != seq and not s & 1:
+                return s
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            if sleep:
+                time.sleep(sleep)
+
+    def close(self):
+        del self._seq_view, self._bytes
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# -----------------------------------------------------------------------------
+
+def _test_writer(name, rate, duration, results):
+    """Publish a synthetic trajectory through a Tracker at rate frames per
+    second, and send the time spent publishing to results."""
+    from synth import generate, random_motion
+    from tracker import Tracker
+    dt = 1.0 / rate
+    n = int(duration * rate)
+    data = generate(random_motion(n, dt), dt)
+    tracker = Tracker()
+    samples = data.calibrated.reshape(n, 3, 3, 1)
+    spent = 0
+    with Publisher(name) as publisher:
+        results.send(None)
+        start = time.perf_counter()
+        for k in range(n):
+            # Paced by spinning, as sleeps are too coarse at high rates.
+            while time.perf_counter() < start + k * dt:
+                pass
+            acc, mag, rot = samples[k]
+            tracker.update(dt, acc, mag, rot)
+            t = perf_counter_ns()
+            publisher.publish(tracker, k * dt, time.time(), t)
+            spent += perf_counter_ns() - t
+    results.send(spent / n)
+
+def measure(rate=1000.0, duration=5.0, sleep=0.0, name=NAME + '-test'):
+    """Latencies in microseconds of frames from a test writer process to
+    this reader, polling every sleep seconds, and the writer's
+    microseconds per publish. Also returns the frames read, missed and
+    retried."""
+    from multiprocessing import Process, Pipe
+    parent, child = Pipe()
+    writer = Process(target=_test_writer, args=(name, rate, duration, child))
+    writer.start()
+    try:
+        parent.recv()
+        latencies = []
+        missed = 0
+        with Subscriber(name) as reader:
+            frame = reader.snapshot()
+            seq = reader.seq
+            while not parent.poll() and reader.alive:
+                if reader.wait(seq, 0.1, sleep) is None:
+                    continue
+                try:
+                    reader.read(frame)
+                except RuntimeError:
+                    # The writer finished between the checks and the read.
+                    break
+                latencies.append(perf_counter_ns() - int(frame['output']))
+                missed += (int(frame['seq']) - seq) // 2 - 1 if seq else 0
+                seq = int(frame['seq'])
+            retries = reader.retries
+        publish = parent.recv() / 1e3
+    finally:
+        writer.join()
+    return asarray(latencies) / 1e3, publish, len(latencies), missed, retries
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--name', default=NAME, help="shared memory block")
+    parser.add_argument('--measure', action='store_true', help="measure latency against a test writer")
+    parser.add_argument('--rate', type=float, default=1000.0, help="test writer frames per second")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds to measure")
+    parser.add_argument('--sleep', type=float, default=0.0, help="reader seconds between polls; 0 spins")
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        us, publish, frames, missed, retries = measure(args.rate, args.duration, args.sleep)
+        print("%d frames read, %d missed, %d retries; publish %.1f us" % (frames, missed, retries, publish))
+        print("latency us: median %.1f, 99%% %.1f, 99.9%% %.1f, max %.1f" % (
+            tuple(percentile(us, [50, 99, 99.9])) + (us.max(),)))
+        return 0
+
+    with Subscriber(args.name) as reader:
+        frame = reader.snapshot()
+        seq = reader.seq
+        while reader.alive:
+            seq = reader.wait(seq, 1.0, 0.001) or seq
+            try:
+                reader.read(frame)
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                return 1
+            age = (perf_counter_ns() - int(frame['output'])) / 1e3
+            q = frame['estimators'][ESTIMATORS.index('qeskf')]['quaternion']
+            print("%.6f %.6f %.6f %.6f %.6f  %.0f us old" % ((frame['time'],) + tuple(q) + (age,)))
+            time.sleep(0.1)
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,276 @@
+"""Sources of sensor samples for the filter and render loops.
+
+A source delivers raw samples in batches: read() returns (n,) arrays of
+host times and board stamps and an (n, 9) array of raw values, with
+n = 0 if nothing new has arrived. Its dropped, lost and overruns counters
+follow those of ingest.SerialReader, and done is set once it will never
+deliver another sample.
+
+* SerialSource: a board on a serial port,
+* FileSource: a recording, replayed in real time, N times as fast, or as
+  fast as the loop takes the samples,
+* SyntheticSource: a board following a synth.py motion profile, with
+  sensor noise,
+* SocketSource: a board or boardsim.py sending UDP datagrams in the
+  framing of netingest.py.
+
+The samples of a FileSource carry the recorded host times and stamps, so
+that sensorclock.SensorClock times them as in the live run and a replay
+gives the same filter output at any speed.
+"""
+
+import socket
+import threading
+import time
+from numpy import asarray, empty, isnan, float64
+
+from ingest import SampleRing, SerialReader
+from wire import PacketDecoder
+from calib import DEFAULT
+from synth import PROFILES, generate, profile as synth_profile
+
+def _empty():
+    return empty(0), empty(0), empty((0, 9))
+
+class Source:
+    """Base class of the sample sources, and a source without samples.
+
+    A source has start() and stop(), also called on entering and leaving
+    a with block, and read(), which returns the (times, stamps, values)
+    arrays of the samples that arrived since the previous call. Subclasses
+    override read() and whichever of start(), stop() and the dropped,
+    lost, overruns and done counters apply; this class delivers nothing
+    and is done from its first read().
+    """
+    dropped = 0
+    lost = 0
+    overruns = 0
+    done = False
+
+    def start(self):
+        pass
+
+    def read(self):
+        """Samples that arrived since the previous read()."""
+        self.done = True
+        return _empty()
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+class SerialSource(Source):
+    """A board on a serial port, read on a background thread."""
+    def __init__(self, port, binary=True, baudrate=115200, capacity=4096):
+        self._port = port
+        self._binary = binary
+        self._baudrate = baudrate
+        self._ring = SampleRing(capacity)
+        self._reader = None
+
+    @property
+    def dropped(self):
+        return self._reader.dropped if self._reader else 0
+
+    @property
+    def lost(self):
+        return self._reader.lost if self._reader else 0
+
+    @property
+    def overruns(self):
+        return self._ring.overruns
+
+    def start(self):
+        import serial
+        port = serial.Serial(self._port, baudrate=self._baudrate, bytesize=8, timeout=2, stopbits=serial.STOPBITS_ONE)
+        self._reader = SerialReader(port, self._ring, binary=self._binary)
+        self._reader.start()
+
+    def read(self):
+        return self._ring.drain()
+
+    def stop(self):
+        if self._reader:
+            self._reader.stop()
+
+class _Pacer:
+    """Time since the first sample was due, running speed times as fast
+    as the host clock."""
+    def __init__(self, speed):
+        self._speed = speed
+        self._start = None
+
+    def elapsed(self):
+        """Elapsed time, or None at speed 0, which has no time base."""
+        if self._speed <= 0:
+            return None
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        return (now - self._start) * self._speed
+
+class FileSource(Source):
+    """The samples of a recording, paced by their recorded host times.
+
+    speed is the replay speed relative to real time, or 0 to deliver
+    batch samples per read() regardless of time. Recordings without raw
+    samples cannot be replayed.
+    """
+    def __init__(self, path, speed=1.0, batch=50):
+        from recording import Recording
+        rec = Recording(path)
+        self._times = asarray(rec.time, dtype=float64)
+        self._stamps = asarray(rec.stamp, dtype=float64)
+        self._raw = rec.raw
+        if len(rec) and isnan(self._raw[0]).any():
+            raise ValueError("%s holds no raw samples" % path)
+        self._offsets = self._times - self._times[0] if len(rec) else self._times
+        self._pacer = _Pacer(speed)
+        self._batch = batch
+        self._next = 0
+
+    def __len__(self):
+        return len(self._times)
+
+    def read(self):
+        i0 = self._next
+        elapsed = self._pacer.elapsed()
+        if elapsed is None:
+            i1 = min(i0 + self._batch, len(self._times))
+        else:
+            i1 = int(self._offsets.searchsorted(elapsed, side='right'))
+        self._next = i1
+        self.done = i1 >= len(self._times)
+        if i1 <= i0:
+            return _empty()
+        return self._times[i0:i1], self._stamps[i0:i1], asarray(self._raw[i0:i1], dtype=float64)
+
+class SyntheticSource(Source):
+    """A board following one of the synth.py motion profiles, as raw
+    samples with sensor noise.
+
+    The duration seconds of samples are generated up front, with
+    synth.generate(), and handed out batch by batch; speed and batch pace
+    them as in FileSource. Host times count from the creation of the
+    source.
+    """
+    def __init__(self, rate=50.0, duration=600.0, profile='spin', speed=1.0, batch=50, calibration=DEFAULT, seed=0):
+        period = 1.0 / rate
+        n = int(duration * rate)
+        self._data = generate(synth_profile(profile, n, period, seed), period, calibration, seed=seed)
+        self._times = time.time() + self._data.times
+        self._raw = asarray(self._data.raw, dtype=float64)
+        self._period = period
+        self._pacer = _Pacer(speed)
+        self._batch = batch
+        self._next = 0
+
+    @property
+    def data(self):
+        """The synth.Synthetic samples, with the true orientation."""
+        return self._data
+
+    def read(self):
+        i0 = self._next
+        elapsed = self._pacer.elapsed()
+        i1 = i0 + self._batch if elapsed is None else int(elapsed / self._period) + 1
+        i1 = min(i1, len(self._raw))
+        self.done = i1 >= len(self._raw)
+        self._next = i1
+        if i1 <= i0:
+            return _empty()
+        return self._times[i0:i1], self._data.stamps[i0:i1], self._raw[i0:i1]
+
+class SocketSource(Source):
+    """Packets sent to a UDP port in the framing of netingest.py: a 32-bit
+    device ID followed by one or more packets. Only the packets of device,
+    or of the first device heard from if None, are taken."""
+    def __init__(self, port, host='0.0.0.0', device=None, capacity=4096):
+        self._address = (host, port)
+        self._device = device
+        self._ring = SampleRing(capacity)
+        self._decoder = PacketDecoder()
+        self._socket = None
+        self._thread = None
+        self._quit = threading.Event()
+        self.received = 0
+
+    @property
+    def lost(self):
+        return self._decoder.lost
+
+    @property
+    def overruns(self):
+        return self._ring.overruns
+
+    def start(self):
+        from netingest import DEVICE_ID
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(self._address)
+        self._socket.settimeout(0.2)
+        self._thread = threading.Thread(target=self._run, args=(DEVICE_ID,), daemon=True)
+        self._thread.start()
+
+    def _run(self, DEVICE_ID):
+        while not self._quit.is_set():
+            try:
+                data = self._socket.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if len(data) < DEVICE_ID.size:
+                self.dropped += 1
+                continue
+            device, = DEVICE_ID.unpack_from(data)
+            if self._device is None:
+                self._device = device
+            if device != self._device:
+                continue
+            t = time.time()
+            _, stamps, samples = self._decoder.feed(data[DEVICE_ID.size:])
+            self.received += len(samples)
+            self._ring.push_many(t, stamps, samples)
+
+    def read(self):
+        return self._ring.drain()
+
+    def stop(self):
+        self._quit.set()
+        if self._thread:
+            self._thread.join()
+        if self._socket:
+            self._socket.close()
+
+# -----------------------------------------------------------------------------
+
+def add_arguments(parser, port='COM5'):
+    """Add the options that select a source to an ArgumentParser."""
+    group = parser.add_argument_group("sample source")
+    group.add_argument('--port', default=port, help="serial port of the board")
+    group.add_argument('--text', action='store_true', help="board sends text lines instead of binary packets")
+    choice = group.add_mutually_exclusive_group()
+    choice.add_argument('--replay', metavar='PATH', help="replay a recording instead of reading the board")
+    choice.add_argument('--synthetic', nargs='?', const='spin', choices=PROFILES, metavar='PROFILE',
+        help="simulate a turning board instead of reading one, following a synth.py profile (default spin)")
+    choice.add_argument('--udp', type=int, metavar='PORT', help="take the packets sent to a UDP port")
+    group.add_argument('--device', type=int, help="with --udp, device ID to take the packets of")
+    group.add_argument('--speed', type=float, default=1.0,
+        help="replay and synthetic speed relative to real time; 0 is as fast as possible")
+    group.add_argument('--batch', type=int, default=50, help="samples per read at --speed 0")
+
+def from_arguments(args):
+    """The source selected by the options of add_arguments()."""
+    if args.replay:
+        return FileSource(args.replay, args.speed, args.batch)
+    if args.synthetic:
+        return SyntheticSource(profile=args.synthetic, speed=args.speed, batch=args.batch)
+    if args.udp is not None:
+        return SocketSource(args.udp, device=args.device)
+    return SerialSource(args.port, binary=not args.text)
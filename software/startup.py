@@ -0,0 +1,76 @@
+"""Import-time budget of the core modules and command-line tools.
+
+The modules fall into two layers. The core (quaternion kernels,
+estimators, calibration, recordings, timing and the packet format)
+imports only NumPy and the standard library, so that batch workers and
+command-line tools start quickly; anything heavier is imported inside the
+function that needs it, like scipy for the matrix exponential kept for
+comparison. The GUI (main.py, graphics.py) and the serial port
+(pyserial, opened by sources.SerialSource) form the layer above and are
+never imported by the core.
+
+This script imports each core module and tool in a fresh interpreter,
+and fails if one takes longer than the budget or loads a module of the
+upper layer:
+
+    python startup.py
+    python startup.py --budget 0.2
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+CORE = ('quat', 'numpyx', 'qeskf', 'vekf', 'qint', 'tracker', 'calib', 'recording', 'meshes', 'history',
+        'sensorclock', 'wire', 'timing', 'synth')
+TOOLS = ('sources', 'headless', 'sweep', 'precision', 'shmpub')
+
+# Packages the core and the tools must not import at start-up.
+FORBIDDEN = ('scipy', 'pygame', 'OpenGL', 'serial', 'asyncio')
+
+# Seconds for a cold import of one module, NumPy included.
+BUDGET = 0.3
+
+_PROBE = """
+import sys, time
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(t)
+print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules) & set(%r))))
+"""
+
+def measure(module):
+    """Seconds taken by importing module in a fresh interpreter, and the
+    forbidden packages it loaded."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, '-c', _PROBE % (module, FORBIDDEN)],
+        cwd=directory, capture_output=True, text=True, check=True).stdout.splitlines()
+    return float(out[0]), out[1].split() if len(out) > 1 else []
+
+def check(modules=CORE + TOOLS, budget=BUDGET, repeat=3):
+    """(module, seconds, forbidden packages, ok) per module; the time is
+    the best of repeat imports, so that a cold disk cache does not count."""
+    results = []
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        seconds = min(t for t, _ in runs)
+        loaded = runs[0][1]
+        results.append((module, seconds, loaded, seconds <= budget and not loaded))
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=BUDGET, help="seconds per module")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module, seconds, loaded, ok in check(budget=args.budget):
+        note = "imports " + ", ".join(loaded) if loaded else ""
+        print("import %-20s %8.1f ms  %s %s" % (module, seconds * 1e3, "ok" if ok else "FAIL", note))
+        failed |= not ok
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
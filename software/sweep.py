@@ -0,0 +1,157 @@
+"""Tune the filter noise parameters on recordings.
+
+Runs a filter over the raw samples of one or more recordings for every
+combination of the given parameter values, and reports for each
+combination how consistent the filter's noise model is with the data:
+the normalized innovation squared (NIS) of a sample is chi-square
+distributed with 6 degrees of freedom if the model is right, so its mean
+per degree of freedom should be 1 and about 5% of the samples should
+exceed the 95% bound. Configurations are listed best first.
+
+    python sweep.py output/data1.rec output/data2.rec --gyro-noise 0.001 0.01 0.1 --mag-noise 0.5 1 2
+    python sweep.py output/data1.rec --filter vkf --r 0.5 1 2 --rot-noise 0.001 0.01 0.1
+
+The recordings are calibrated and timed once, and written to .npy files
+that the worker processes, one per core, map into memory: each recording
+is held in memory once, in the page cache, however many workers read it.
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from math import log
+
+import numpy as np
+
+from tracker import NAV_G, NAV_M
+from calib import load_calibration
+
+# 95% quantile of the chi-square distribution with 6 degrees of freedom.
+CHI2_95 = 12.592
+DOF = 6
+
+PARAMETERS = {
+    'qeskf': ('gyro_noise', 'acc_noise', 'acc_excess', 'acc_smoothing', 'mag_noise'),
+    'vkf': ('r', 'rot_noise'),
+}
+
+def prepare(paths, directory, calibration, chunk=1 << 20):
+    """Calibrate and time the samples of each recording and write them to
+    samples and time step .npy files in directory. Returns their paths."""
+    from recording import Recording
+    from sensorclock import sample_times
+    files = []
+    for i, path in enumerate(paths):
+        rec = Recording(path)
+        if len(rec) < 2:
+            raise ValueError("%s holds no samples" % path)
+        _, dts = sample_times(np.asarray(rec.stamp, dtype=np.float64), np.asarray(rec.time))
+        raw = rec.raw
+
+        samples_path = os.path.join(directory, "samples%d.npy" % i)
+        dts_path = os.path.join(directory, "dts%d.npy" % i)
+        out = np.lib.format.open_memmap(samples_path, 'w+', np.float64, (len(rec) - 1, 9))
+        for j in range(1, len(rec), chunk):
+            block = np.asarray(raw[j:j+chunk], dtype=np.float64)
+            if np.isnan(block).any():
+                raise ValueError("%s holds no raw samples" % path)
+            out[j-1:j-1+len(block)] = calibration.apply_batch(block)
+        out.flush()
+        del out
+        np.save(dts_path, dts[1:])
+        files.append((samples_path, dts_path))
+    return files
+
+# -----------------------------------------------------------------------------
+
+# The recordings mapped by a worker process.
+_datasets = []
+
+def _open(files):
+    _datasets[:] = [(np.load(s, mmap_mode='r'), np.load(d, mmap_mode='r')) for s, d in files]
+
+def _qeskf_nis(samples, dts, params):
+    from qeskf import QuaternionESKF
+    nis = np.empty(len(samples))
+    QuaternionESKF(NAV_G, NAV_M, **params).replay(dts, samples, nis=nis)
+    return nis
+
+def _vkf_nis(samples, dts, params):
+    from vekf import VectorEKF
+    filters = []
+    for s in (slice(0, 3), slice(3, 6)):
+        f = VectorEKF(params.get('r', 1.0), rot_noise=params.get('rot_noise', 0.01))
+        f.vector = samples[0, s, np.newaxis]
+        filters.append((f, s))
+
+    nis = np.zeros(len(samples))
+    for i, (dt, sample) in enumerate(zip(dts.tolist(), samples)):
+        rot = sample[6:9, np.newaxis]
+        for f, s in filters:
+            f.predict(dt, rot)
+            nis[i] += f.update(sample[s, np.newaxis])
+    return nis
+
+def evaluate(task):
+    """NIS statistics of one configuration on one recording: the sum, the
+    number of samples and the number above the 95% bound."""
+    name, params, dataset, settle = task
+    samples, dts = _datasets[dataset]
+    run = _qeskf_nis if name == 'qeskf' else _vkf_nis
+    nis = run(samples, dts, params)[settle:]
+    nis = nis[~np.isnan(nis)]
+    return float(nis.sum()), len(nis), int((nis > CHI2_95).sum())
+
+# -----------------------------------------------------------------------------
+
+def sweep(name, grid, files, settle=100, jobs=None):
+    """Evaluate every configuration of grid, a list of parameter dicts, on
+    the prepared recordings. Returns (params, NIS per degree of freedom,
+    fraction above the 95% bound) per configuration, best first."""
+    tasks = [(name, params, i, settle) for params in grid for i in range(len(files))]
+    with ProcessPoolExecutor(jobs or os.cpu_count(), initializer=_open, initargs=(files,)) as pool:
+        results = list(pool.map(evaluate, tasks))
+
+    rows = []
+    for k, params in enumerate(grid):
+        total, count, outside = (sum(x) for x in zip(*results[k*len(files):(k+1)*len(files)]))
+        if count == 0:
+            continue
+        rows.append((params, total / count / DOF, outside / count))
+    rows.sort(key=lambda row: abs(log(row[1])) if row[1] > 0 else float('inf'))
+    return rows
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recordings', nargs='+')
+    parser.add_argument('--filter', choices=sorted(PARAMETERS), default='qeskf')
+    for param in sorted(set(itertools.chain(*PARAMETERS.values()))):
+        parser.add_argument('--' + param.replace('_', '-'), type=float, nargs='+', metavar='VALUE')
+    parser.add_argument('--board', help="board ID whose stored calibration to use")
+    parser.add_argument('--settle', type=int, default=100, help="samples to skip while the filter converges")
+    parser.add_argument('--jobs', type=int, help="worker processes; one per core if not given")
+    parser.add_argument('--workdir', help="directory for the prepared samples; a temporary one if not given")
+    args = parser.parse_args(argv)
+
+    names = [p for p in PARAMETERS[args.filter] if getattr(args, p) is not None]
+    for p in set(itertools.chain(*PARAMETERS.values())) - set(PARAMETERS[args.filter]):
+        if getattr(args, p) is not None:
+            parser.error("--%s does not apply to %s" % (p.replace('_', '-'), args.filter))
+    grid = [dict(zip(names, values)) for values in itertools.product(*(getattr(args, p) for p in names))]
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as directory:
+        files = prepare(args.recordings, directory, load_calibration(args.board))
+        rows = sweep(args.filter, grid, files, args.settle, args.jobs)
+
+    texts = [" ".join("%s=%g" % item for item in params.items()) or "(defaults)" for params, _, _ in rows]
+    width = max([len(text) for text in texts] + [10])
+    print("%-*s %10s %10s" % (width, "parameters", "NIS/dof", ">95%"))
+    for text, (_, nis, outside) in zip(texts, rows):
+        print("%-*s %10.3f %9.1f%%" % (width, text, nis, 100 * outside))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,230 @@
+"""Synthetic sensor data with known true orientation.
+
+An angular velocity profile, an (N, 3) array in rad/s in the sensor
+frame, is built from the profile functions below, which can be added and
+concatenated like any arrays. integrate() turns it into the true
+orientation quaternions, and generate() into the readings of a board
+following them: gravity and the earth field (NAV_G and NAV_M) seen in the
+sensor frame, with sensor noise, a drifting gyroscope bias, bursts of
+linear acceleration and of magnetic disturbance, and a hard-iron offset.
+The readings are mapped back through a calibration and rounded to the
+int16 raw values the board sends, so they go through calib.py like real
+samples, and can be written as a recording for bench.py, sweep.py or a
+replay:
+
+    python synth.py output/synth.rec --duration 3600 --evaluate
+
+Everything is computed with array operations, in chunks, so hours of
+samples take seconds.
+"""
+
+import argparse
+import sys
+from math import pi
+from numpy import (asarray, zeros, empty, ones, arange, concatenate, convolve, hanning, cumsum, sqrt, einsum,
+    clip, sin, float64, int16, rint, arctan2, abs as npabs)
+from numpy.linalg import solve
+from numpy.random import default_rng
+
+from quat import qmuln, qexpn, qrmatn, qnormalizen
+from calib import DEFAULT
+from tracker import NAV_G, NAV_M
+
+# -----------------------------------------------------------------------------
+# Angular velocity profiles
+
+def rest(n):
+    """n samples of no rotation."""
+    return zeros((n, 3))
+
+def constant(n, rot):
+    """n samples of a constant angular velocity rot."""
+    return zeros((n, 3)) + asarray(rot, dtype=float64)
+
+def sinusoid(n, dt, amplitude, frequency, phase=0.0):
+    """Oscillation about a fixed axis; amplitude is a 3-vector in rad/s."""
+    t = arange(n) * dt
+    return sin(2 * pi * frequency * t + phase)[:, None] * asarray(amplitude, dtype=float64)
+
+def smooth_noise(n, dt, sigma, correlation_time, rng):
+    """Gaussian noise of standard deviation sigma (per axis), smoothed over
+    correlation_time seconds."""
+    w = max(int(round(correlation_time / dt)), 1)
+    window = hanning(w + 2)[1:-1]
+    window /= sqrt((window * window).sum())
+    e = rng.normal(0.0, sigma, (n + w - 1, 3))
+    return concatenate([convolve(e[:, i], window, 'valid')[:, None] for i in range(3)], axis=1)
+
+def random_motion(n, dt, sigma=1.0, correlation_time=0.5, seed=0):
+    """Random turning with angular velocities of standard deviation sigma."""
+    return smooth_noise(n, dt, sigma, correlation_time, default_rng(seed))
+
+def bursts(n, dt, rate, amplitude, duration, rng):
+    """Bumps of random direction and size (standard deviation amplitude)
+    lasting duration seconds, starting rate times per second on average."""
+    w = max(int(round(duration / dt)), 1)
+    window = hanning(w + 2)[1:-1]
+    starts = rng.random(n) < rate * dt
+    impulses = zeros((n + w - 1, 3))
+    impulses[w - 1:][starts] = rng.normal(0.0, amplitude, (int(starts.sum()), 3))
+    return concatenate([convolve(impulses[:, i], window, 'valid')[:, None] for i in range(3)], axis=1)
+
+# -----------------------------------------------------------------------------
+
+def integrate(rot, dt, q0=(1.0, 0.0, 0.0, 0.0), chunk=1 << 16):
+    """True orientations of a board turning at the angular velocities rot
+    over time steps dt (a scalar or an (N,) array), as an (N, 4) array.
+
+    Sample k is the orientation after turning by rot[k] for dt[k], as in
+    QuaternionESKF.predict(). The products are formed by a parallel prefix
+    scan within chunks, and the chunks chained by their last quaternion.
+    """
+    rot = asarray(rot, dtype=float64)
+    n = len(rot)
+    dt = zeros(n) + dt
+    out = empty((n, 4))
+    q = asarray(q0, dtype=float64)[None]
+    for i in range(0, n, chunk):
+        d = qexpn(dt[i:i+chunk, None] * rot[i:i+chunk])
+        s = 1
+        while s < len(d):
+            d[s:] = qmuln(d[:-s], d[s:])
+            s *= 2
+        qmuln(q.repeat(len(d), axis=0), d, out=out[i:i+chunk])
+        qnormalizen(out[i:i+chunk], out=out[i:i+chunk])
+        q = out[i+len(d)-1:i+len(d)]
+    return out
+
+def angle_error(q, truth):
+    """Angle in radians between two (N, 4) arrays of orientations, which
+    need not be normalized. Accurate down to the smallest angles, unlike
+    the arccos of their dot product."""
+    d = qmuln(q, truth * [1.0, -1.0, -1.0, -1.0])
+    return 2 * arctan2(sqrt(einsum('ij,ij->i', d[:, 1:4], d[:, 1:4])), npabs(d[:, 0]))
+
+class Synthetic:
+    """Samples of a board following a known trajectory.
+
+    Attributes, one row per sample: times (host seconds), stamps (board
+    microseconds), dts (true time steps), quaternions (true orientation),
+    calibrated (acc, mag, rot readings in calibrated units), raw (int16
+    raw values), and bias (the true gyroscope bias).
+    """
+    def __init__(self, times, stamps, dts, quaternions, calibrated, raw, bias):
+        self.times = times
+        self.stamps = stamps
+        self.dts = dts
+        self.quaternions = quaternions
+        self.calibrated = calibrated
+        self.raw = raw
+        self.bias = bias
+
+    def __len__(self):
+        return len(self.times)
+
+    def write(self, path):
+        """Write the samples as a recording, with the true orientation as
+        the qeskf matrices."""
+        from recording import RecordingWriter, RECORD_DTYPES, VERSION
+        from numpy import nan
+        records = zeros(len(self), RECORD_DTYPES[VERSION])
+        records['time'] = self.times
+        records['stamp'] = self.stamps
+        records['raw'] = self.raw
+        records['qeskf'] = qrmatn(self.quaternions)
+        for name in ('accmag', 'gyro', 'vkf'):
+            records[name] = nan
+        with RecordingWriter(path) as writer:
+            writer.write_records(records)
+
+def generate(rot, dt=0.02, calibration=DEFAULT, seed=0, q0=(1.0, 0.0, 0.0, 0.0),
+             acc_noise=0.01, mag_noise=0.01, rot_noise=0.005,
+             rot_bias=(0.0, 0.0, 0.0), bias_walk=0.0,
+             acc_bursts=0.0, acc_amplitude=0.2, acc_duration=0.5,
+             mag_bursts=0.0, mag_amplitude=0.3, mag_duration=2.0, hard_iron=(0.0, 0.0, 0.0),
+             drift=0.0, jitter=0.0, start=0.0):
+    """Readings of a board turning at the angular velocities rot.
+
+    Noise is given as standard deviations in calibrated units (g, earth
+    field and rad/s). The gyroscope bias starts at rot_bias and drifts as
+    a random walk of bias_walk rad/s per square root second. Linear
+    acceleration (in g) and magnetic disturbance (in earth fields, in the
+    navigation frame) come as bursts, acc_bursts and mag_bursts per second
+    on average; hard_iron is a constant field in the sensor frame. The
+    board's clock runs drift (a fraction) fast, and host times have a
+    jitter of that standard deviation in seconds.
+    """
+    rng = default_rng(seed)
+    rot = asarray(rot, dtype=float64)
+    n = len(rot)
+    q = integrate(rot, dt, q0)
+    Rt = qrmatn(q).transpose(0, 2, 1)
+
+    lin = bursts(n, dt, acc_bursts, acc_amplitude, acc_duration, rng) if acc_bursts > 0 else zeros((n, 3))
+    dist = bursts(n, dt, mag_bursts, mag_amplitude, mag_duration, rng) if mag_bursts > 0 else zeros((n, 3))
+
+    bias = zeros((n, 3)) + asarray(rot_bias, dtype=float64)
+    if bias_walk > 0:
+        bias += cumsum(rng.normal(0.0, bias_walk * sqrt(dt), (n, 3)), axis=0)
+
+    calibrated = empty((n, 9))
+    calibrated[:, 0:3] = einsum('nij,nj->ni', Rt, lin - NAV_G[:, 0])
+    calibrated[:, 3:6] = einsum('nij,nj->ni', Rt, dist + NAV_M[:, 0]) + asarray(hard_iron, dtype=float64)
+    calibrated[:, 6:9] = rot + bias
+    calibrated += rng.normal(0.0, 1.0, (n, 9)) * concatenate(
+        (ones(3) * acc_noise, ones(3) * mag_noise, ones(3) * rot_noise))
+
+    raw = solve(calibration.matrix, (calibrated - calibration.offset).T).T
+    raw = clip(rint(raw), -32768, 32767).astype(int16)
+
+    t = start + arange(n) * dt
+    stamps = rint(t * (1.0 + drift) * 1e6) % (1 << 32)
+    times = t + (rng.normal(0.0, jitter, n) if jitter > 0 else 0.0)
+    return Synthetic(times, stamps, zeros(n) + dt, q, calibration.apply_batch(raw), raw, bias)
+
+# -----------------------------------------------------------------------------
+
+PROFILES = ('random', 'rest', 'spin', 'sway')
+
+def profile(name, n, dt, seed=0):
+    """A named angular velocity profile of n samples."""
+    if name == 'random':
+        return random_motion(n, dt, seed=seed)
+    if name == 'rest':
+        return rest(n)
+    if name == 'spin':
+        return constant(n, (0.3, 0.2, 0.5))
+    if name == 'sway':
+        return sinusoid(n, dt, (0.5, 1.0, 0.2), 0.25)
+    raise ValueError("unknown profile %r" % name)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?', help="recording to write")
+    parser.add_argument('--duration', type=float, default=600.0, help="seconds of samples")
+    parser.add_argument('--rate', type=float, default=50.0, help="samples per second")
+    parser.add_argument('--profile', choices=PROFILES, default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bias-walk', type=float, default=0.0, help="gyroscope bias random walk, rad/s/sqrt(s)")
+    parser.add_argument('--acc-bursts', type=float, default=0.0, help="linear acceleration bursts per second")
+    parser.add_argument('--mag-bursts', type=float, default=0.0, help="magnetic disturbances per second")
+    parser.add_argument('--evaluate', action='store_true', help="report the QuaternionESKF error against the truth")
+    args = parser.parse_args(argv)
+
+    dt = 1.0 / args.rate
+    n = int(args.duration * args.rate)
+    data = generate(profile(args.profile, n, dt, args.seed), dt, seed=args.seed, bias_walk=args.bias_walk,
+        acc_bursts=args.acc_bursts, mag_bursts=args.mag_bursts)
+    if args.output:
+        data.write(args.output)
+        print("Wrote %d samples to %s" % (len(data), args.output))
+
+    if args.evaluate:
+        from qeskf import QuaternionESKF
+        qs, _ = QuaternionESKF(NAV_G, NAV_M).replay(data.dts, data.calibrated)
+        err = angle_error(qs, data.quaternions)[n // 10:] * 180 / pi
+        print("QuaternionESKF error: rms %.3f deg, max %.3f deg" % (sqrt((err * err).mean()), err.max()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,163 @@
+"""Named timing spans with fixed-size latency histograms.
+
+A span times every pass through a block of code:
+
+    DRAW = timing.span('draw')
+    ...
+    with DRAW:
+        draw(g)
+
+and adds its duration to the span's histogram, which has four buckets per
+octave of nanoseconds (about 19% wide) and never grows, so recording a
+pass costs two clock reads and a few integer operations. Spans are meant
+for the main thread; report() summarizes them and dump() writes them to
+a file.
+
+Timing is on unless the environment variable IMU_TIMING is 0 or Python
+runs with -O. Then span() returns a shared span that does nothing: no
+clock is read and nothing is recorded.
+"""
+
+import os
+import time
+from time import perf_counter_ns
+
+ENABLED = __debug__ and os.environ.get('IMU_TIMING', '1') != '0'
+
+# Buckets per octave, as a power of two, and the number of buckets.
+SUB_BITS = 2
+BUCKETS = 64 << SUB_BITS
+
+def bucket(ns):
+    """Histogram bucket of a duration in nanoseconds."""
+    b = ns.bit_length()
+    if b <= SUB_BITS:
+        return ns
+    return (b << SUB_BITS) | ((ns >> (b - SUB_BITS - 1)) & ((1 << SUB_BITS) - 1))
+
+def bucket_bounds(i):
+    """Lowest and one past the highest duration of a bucket."""
+    b = i >> SUB_BITS
+    if b <= SUB_BITS:
+        return i, i + 1
+    m = (1 << SUB_BITS) | (i & ((1 << SUB_BITS) - 1))
+    return m << (b - SUB_BITS - 1), (m + 1) << (b - SUB_BITS - 1)
+
+class Histogram:
+    """Counts of durations by bucket, with their sum and maximum."""
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.counts[bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in ns."""
+        if not self.count:
+            return 0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(bucket_bounds(i)[1], self.max)
+        return self.max
+
+class Span:
+    """Context manager that adds the time spent in it to a histogram."""
+    __slots__ = ('name', 'histogram', '_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.histogram = Histogram()
+        self._start = 0
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        # Histogram.add(), inlined.
+        ns = perf_counter_ns() - self._start
+        h = self.histogram
+        b = ns.bit_length()
+        h.counts[ns if b <= SUB_BITS else (b << SUB_BITS) | ((ns >> (b - SUB_BITS - 1)) & ((1 << SUB_BITS) - 1))] += 1
+        h.count += 1
+        h.total += ns
+        if ns > h.max:
+            h.max = ns
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL = _NullSpan()
+_spans = {}
+_since = time.perf_counter()
+
+def span(name):
+    """The span of the given name, created on first use."""
+    if not ENABLED:
+        return _NULL
+    s = _spans.get(name)
+    if s is None:
+        s = _spans[name] = Span(name)
+    return s
+
+def spans():
+    """All spans, in the order they were created."""
+    return list(_spans.values())
+
+def reset():
+    """Clear every histogram."""
+    global _since
+    for s in _spans.values():
+        s.histogram.clear()
+    _since = time.perf_counter()
+
+def report():
+    """One line per span: passes, mean, median, 99th percentile and
+    maximum in microseconds, and the share of the time since the last
+    reset spent in it."""
+    if not ENABLED:
+        return ["timing disabled"]
+    elapsed = max(time.perf_counter() - _since, 1e-9)
+    lines = ["%-16s %8s %8s %8s %8s %8s %6s" % ("span", "passes", "mean", "p50", "p99", "max", "%")]
+    for s in _spans.values():
+        h = s.histogram
+        lines.append("%-16s %8d %8.1f %8.1f %8.1f %8.1f %6.1f" % (
+            s.name, h.count, h.mean() / 1e3, h.percentile(50) / 1e3, h.percentile(99) / 1e3,
+            h.max / 1e3, 100 * h.total / 1e9 / elapsed))
+    return lines
+
+def dump(path):
+    """Write the report and the non-empty buckets of every histogram."""
+    with open(path, 'w') as f:
+        for line in report():
+            f.write(line + "\n")
+        for s in _spans.values():
+            f.write("\n# %s: bucket_low_ns bucket_high_ns count\n" % s.name)
+            for i, n in enumerate(s.histogram.counts):
+                if n:
+                    lo, hi = bucket_bounds(i)
+                    f.write("%d %d %d\n" % (lo, hi, n))
@@ -0,0 +1,175 @@
+from math import sin, cos, radians
+from numpy import array, block, eye, float64
+from numpyx import vec3, vec4, xmat, mat3to4, check_dtype
+from calib import DEFAULT, OnlineEllipsoidFit
+import timing
+
+from qeskf import QuaternionESKF
+from vekf import VectorEKF
+from qint import QuaternionIntegrator
+
+# -----------------------------------------------------------------------------
+
+NAV_G = vec3(0.0, 0.0, -1.0)
+NAV_M = vec3(0.0, sin(radians(17)), -cos(radians(17)))
+
+# Timing spans of the estimator stages (see timing.py).
+CALIBRATE_SPAN = timing.span('calibrate')
+QESKF_PREDICT_SPAN = timing.span('qeskf.predict')
+QESKF_UPDATE_SPAN = timing.span('qeskf.update')
+VKF_PREDICT_SPAN = timing.span('vkf.predict')
+VKF_UPDATE_SPAN = timing.span('vkf.update')
+GYRO_SPAN = timing.span('gyro.step')
+ACCMAG_SPAN = timing.span('accmag')
+
+# -----------------------------------------------------------------------------
+
+def calibrate(values, calibration=DEFAULT):
+    """Apply the sensor calibration to nine raw values, giving acc, mag and rot."""
+    return calibration.apply(values)
+
+def orthonormalize(g, m):
+    """Create right-handed orthonormal frame out of g and m."""
+    ez = -g / (g.T @ g)**0.5
+    ex = xmat(m) @ ez
+    ex /= (ex.T @ ex)**0.5
+    ey = xmat(ez) @ ex
+    return mat3to4(block([[ ex, ey, ez ]]).T)
+
+# -----------------------------------------------------------------------------
+
+class Tracker:
+    """The four orientation estimators, run side by side on the same samples.
+
+    * qeskf: the quaternion error-state Kalman filter,
+    * vkf: a pair of vector Kalman filters for gravity and magnetic field,
+    * accmag: the frame given by the latest acc/mag measurement alone,
+    * gyro: integrated gyroscope measurements alone.
+
+    Every estimator runs in dtype, float64 or float32; in float32 the
+    matrices come out ready for the renderer.
+    """
+    def __init__(self, dtype=float64):
+        self.dtype = dtype = check_dtype(dtype)
+        self.qeskf = QuaternionESKF(gn = NAV_G, mn = NAV_M, dtype=dtype)
+        self.qint = QuaternionIntegrator(dtype)
+        self.mag_vekf = VectorEKF(1.0, dtype=dtype)
+        self.acc_vekf = VectorEKF(1.0, dtype=dtype)
+        self.accmag_matrix = mat3to4(eye(3, dtype=dtype))
+        self._acc = None
+        self._mag = None
+
+    def update(self, dt, acc, mag, rot):
+        """Run every estimator on one calibrated sample."""
+        self.predict(dt, rot)
+        self.correct(acc, mag)
+
+    def predict(self, dt, rot):
+        """Propagate every estimator by dt with a gyroscope measurement."""
+        with QESKF_PREDICT_SPAN:
+            self.qeskf.predict(dt, rot)
+        with VKF_PREDICT_SPAN:
+            self.acc_vekf.predict(dt, rot)
+            self.mag_vekf.predict(dt, rot)
+        with GYRO_SPAN:
+            self.qint.step(dt, rot)
+
+    def correct(self, acc=None, mag=None):
+        """Apply new accelerometer and/or magnetometer measurements."""
+        if acc is None and mag is None:
+            return
+        with QESKF_UPDATE_SPAN:
+            self.qeskf.update(acc, mag)
+        with VKF_UPDATE_SPAN:
+            if acc is not None:
+                self.acc_vekf.update(acc)
+                self._acc = acc
+            if mag is not None:
+                self.mag_vekf.update(mag)
+                self._mag = mag
+        if self._acc is not None and self._mag is not None:
+            with ACCMAG_SPAN:
+                self.accmag_matrix = orthonormalize(-self._acc, self._mag)
+
+    def matrices(self):
+        """Current 4x4 rotation matrix of each estimator, by name."""
+        return {
+            'qeskf': self.qeskf.matrix,
+            'vkf': orthonormalize(-self.acc_vekf.vector, self.mag_vekf.vector),
+            'accmag': self.accmag_matrix,
+            'gyro': self.qint.matrix,
+        }
+
+    def seed(self, acc, mag):
+        """Start the vector filters from a first pair of measurements, so
+        the vkf orientation is defined before any update."""
+        self.acc_vekf.vector = acc
+        self.mag_vekf.vector = mag
+
+    def reset(self):
+        """Reset the filters to the reference orientation."""
+        self.qeskf._q = vec4(1.0, 0.0, 0.0, 0.0, self.dtype)
+        self.mag_vekf.vector = NAV_M
+        self.acc_vekf.vector = -NAV_G
+
+    def sync_gyro(self):
+        """Restart gyroscope integration from the QuaternionESKF estimate."""
+        self.qint._q = self.qeskf._q.copy()
+
+class UpdateScheduler:
+    """Runs the tracker at the rate of each sensor.
+
+    The gyroscope propagates the estimators on every sample. The board
+    repeats the last reading of a sensor that has no new data, so an
+    accelerometer or magnetometer reading is applied only when its raw
+    values changed, and no sooner than acc_period or mag_period seconds
+    after the previous update from that sensor. Raw values are calibrated
+    with calibration (see calib.py); with online=True every new
+    magnetometer reading also refines its magnetometer block.
+    """
+    def __init__(self, tracker, acc_period=0.0, mag_period=0.0, calibration=None, online=False):
+        self.tracker = tracker
+        self.acc_period = acc_period
+        self.mag_period = mag_period
+        self.calibration = calibration or DEFAULT.copy()
+        self.refiner = OnlineEllipsoidFit(self.calibration, 'mag') if online else None
+        self._raw = None
+        self._acc_time = None
+        self._mag_time = None
+        self.predictions = 0
+        self.acc_updates = 0
+        self.mag_updates = 0
+
+    def _due(self, t, last, period):
+        return last is None or t - last >= period
+
+    def run(self, t, dt, values):
+        """Process one raw sample taken at time t, dt after the previous
+        one. Returns the calibrated acc, mag and rot. dt is None for the
+        first sample, which has nothing to propagate from and only seeds
+        the vector filters."""
+        with CALIBRATE_SPAN:
+            acc, mag, rot = self.calibration.apply(values, self.tracker.dtype)
+        raw, self._raw = self._raw, values
+        if dt is None:
+            self.tracker.seed(acc, mag)
+            return acc, mag, rot
+        acc_new = raw is None or (raw[0:3] != values[0:3]).any()
+        mag_new = raw is None or (raw[3:6] != values[3:6]).any()
+
+        self.tracker.predict(dt, rot)
+        self.predictions += 1
+
+        acc_due = acc_new and self._due(t, self._acc_time, self.acc_period)
+        mag_due = mag_new and self._due(t, self._mag_time, self.mag_period)
+        if acc_due:
+            self._acc_time = t
+            self.acc_updates += 1
+        if mag_due:
+            self._mag_time = t
+            self.mag_updates += 1
+        if mag_new and self.refiner:
+            self.refiner.update(values)
+        self.tracker.correct(acc if acc_due else None, mag if mag_due else None)
+
+        return acc, mag, rot
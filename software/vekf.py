@@ -1,18 +1,34 @@
-from numpy import array, block, eye
-from numpy.linalg import inv
-from scipy.linalg import expm
-from numpyx import vec3, vec4, xmat
+from numpy import array, block, eye, zeros, empty, tile, asarray, broadcast_to, einsum, newaxis, float64, flatnonzero
+from numpy.linalg import inv, solve
+from numpyx import vec3, vec4, xmat, rexp, rexpn, rexp_expm, check_dtype
+from quat import skewn
 from math import sin, cos, radians
 
 class VectorEKF:
-    def __init__(self, r):
+    """Kalman filter of a reference vector (gravity or the magnetic field)
+    in the sensor frame, with measurement variance r and process noise
+    rot_noise per second from the gyroscope. The state is held in dtype;
+    in float32 the covariance is made symmetric after every step. The
+    vector starts at x (1, 0, 0) and can be set through vector."""
+    def __init__(self, r, use_expm=False, rot_noise=0.01, dtype=float64):
         self._r = r
+        self._rot_noise = rot_noise
 
-        self._x = vec3(1, 0, 0)
-        self._P = eye(3)
+        self._dtype = dtype = check_dtype(dtype)
+        self._stabilize = dtype is not float64
+        self._x = vec3(1, 0, 0, dtype)
+        self._P = eye(3, dtype=dtype)
         self._var = 1.0
+        self._B = empty((3, 4), dtype)
 
-        self._matrix = eye(3)
+        self._matrix = eye(3, dtype=dtype)
+
+        # The general matrix exponential is kept for comparison only.
+        self._rexp = rexp_expm if use_expm else rexp
+
+    @property
+    def dtype(self):
+        return self._dtype
 
     @property
     def covariance(self):
@@ -22,19 +38,123 @@ class VectorEKF:
     def vector(self):
         return self._x
 
-    def step(self, dt, vec, rot):
+    @vector.setter
+    def vector(self, x):
+        """Set the estimate, a 3x1 column, such as from a first measurement."""
+        self._x = array(x, dtype=self._dtype).reshape(3, 1)
+
+    def predict(self, dt, rot):
+        """Rotate the vector estimate by the gyroscope measurement rot over dt."""
+        rrot = self._rot_noise
+        if self._stabilize:
+            rot = asarray(rot, self._dtype)
+
+        # Prediction step
+        F = self._rexp(-dt * rot)
+        X = xmat(self._x)
+        self._x = F @ self._x
+        self._P = F @ self._P @ F.T - rrot * dt * X @ X
+        if self._stabilize:
+            self._P = 0.5 * (self._P + self._P.T)
+
+    def update(self, vec):
+        """Correct the prediction with a measurement of the vector. Returns
+        the normalized innovation squared, which averages 3 for a
+        consistent noise model."""
 #        self._var = 0.9 * self._var + 0.1 * (self._r + 4.0 * abs(1.0 - vec.T @ vec) ** 2)
         self._var = self._r
 
-        R = eye(3) * self._var
-        rrot = 0.01
+        R = eye(3, dtype=self._dtype) * self._var
+        if self._stabilize:
+            vec = asarray(vec, self._dtype)
+
+        # Update step. One solve gives both the gain and the innovation
+        # test.
+        xp, Pp = self._x, self._P
+        d = vec - xp
+        B = self._B
+        B[:, 0:3] = Pp
+        B[:, 3:4] = d
+        X = solve(Pp + R, B)
+        Kt = X[:, 0:3]
+        self._x = xp + Kt.T @ d
+        self._P = Pp - Kt.T @ Pp
+        if self._stabilize:
+            self._P = 0.5 * (self._P + self._P.T)
+        return float(d[:, 0] @ X[:, 3])
+
+    def step(self, dt, vec, rot):
+        """Predict by dt and correct with vec."""
+        self.predict(dt, rot)
+        self.update(vec)
+
+class VectorEKFBank:
+    """A bank of k independent VectorEKF filters stepped together.
+
+    The filter states are held in stacked (k, 3) and (k, 3, 3) arrays and
+    every step() advances all of them with batched array operations, in
+    the dtype of VectorEKF.
+    """
+    def __init__(self, r, k, rot_noise=0.01, dtype=float64):
+        self._r = r
+        self._rot_noise = rot_noise
+
+        self._dtype = dtype = check_dtype(dtype)
+        self._stabilize = dtype is not float64
+        self._x = zeros((k, 3), dtype)
+        self._x[:, 0] = 1.0
+        self._P = tile(eye(3, dtype=dtype), (k, 1, 1))
+
+    def __len__(self):
+        return len(self._x)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def covariances(self):
+        return self._P
+
+    @property
+    def vectors(self):
+        return self._x
+
+    def step(self, dt, vec, rot, mask=None):
+        """Step every filter; vec and rot are (k, 3) arrays and dt a scalar
+        or a (k,) array. Filters whose entry in the optional boolean mask
+        is false have no new sample and are left untouched.
+        """
+        k = len(self._x)
+        dt = broadcast_to(asarray(dt, dtype=self._dtype), (k,))
+        if self._stabilize:
+            vec, rot = asarray(vec, self._dtype), asarray(rot, self._dtype)
+        if mask is not None:
+            idx = flatnonzero(mask)
+            if len(idx) == 0:
+                return
+            dt, vec, rot = dt[idx], vec[idx], rot[idx]
+            x, P = self._x[idx], self._P[idx]
+        else:
+            x, P = self._x, self._P
+
+        R = eye(3, dtype=self._dtype) * self._r
+        rrot = self._rot_noise
 
         # Prediction step
-        F = expm(-dt * xmat(rot))
-        xp = F @ self._x
-        Pp = F @ self._P @ F.T - rrot * dt * xmat(self._x) @ xmat(self._x)
+        F = rexpn(-dt[:, newaxis] * rot)
+        xp = einsum('nij,nj->ni', F, x)
+        X = skewn(x)
+        Pp = F @ P @ F.transpose(0, 2, 1) - (rrot * dt)[:, newaxis, newaxis] * (X @ X)
 
         # Update step
-        y = vec
-        self._x = xp + Pp @ inv(Pp + R) @ (y - xp)
-        self._P = Pp - Pp @ inv(Pp + R) @ Pp
+        Kt = solve(Pp + R, Pp)
+        x = xp + einsum('ni,nij->nj', vec - xp, Kt)
+        P = Pp - Kt.transpose(0, 2, 1) @ Pp
+        if self._stabilize:
+            P = 0.5 * (P + P.transpose(0, 2, 1))
+
+        if mask is not None:
+            self._x[idx], self._P[idx] = x, P
+        else:
+            self._x, self._P = x, P
@@ -0,0 +1,119 @@
+"""Binary sample packets sent by the firmware (see firmware/mpu9250.c).
+
+Each packet is 28 bytes, little-endian: the sync word A5 5A, a 16-bit
+sequence number, the 32-bit microsecond time of the sample on the board,
+nine int16 sensor values (acc, mag, rot) and a CRC-16/CCITT-FALSE over
+everything after the sync word.
+"""
+
+from numpy import array, arange, zeros, frombuffer, concatenate, flatnonzero, uint8, uint16, float64
+
+SYNC = b'\xa5\x5a'
+PACKET_SIZE = 28
+
+def _crc_table():
+    table = zeros(256, dtype=uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+_CRC_TABLE = _crc_table()
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE of each row of an (n, m) uint8 array."""
+    crc = zeros(len(data), dtype=uint16) + 0xFFFF
+    for j in range(data.shape[1]):
+        crc = (crc << 8) ^ _CRC_TABLE[(crc >> 8) ^ data[:, j]]
+    return crc
+
+def encode(seq, stamps, samples):
+    """Encode (n,) sequence numbers, (n,) microsecond stamps and (n, 9)
+    integer samples as packets."""
+    n = len(samples)
+    packets = zeros((n, PACKET_SIZE), dtype=uint8)
+    packets[:, 0:2] = frombuffer(SYNC, dtype=uint8)
+    packets[:, 2:4] = array(seq, dtype='<u2').reshape(n, 1).view(uint8)
+    packets[:, 4:8] = array(stamps, dtype='<u4').reshape(n, 1).view(uint8)
+    packets[:, 8:26] = array(samples, dtype='<i2').reshape(n, 9).view(uint8)
+    packets[:, 26:28] = crc16(packets[:, 2:26]).astype('<u2').reshape(n, 1).view(uint8)
+    return packets.tobytes()
+
+def _unpack(packets):
+    """Sequence numbers, stamps and sensor values of an (n, PACKET_SIZE)
+    array of packets."""
+    seq = packets[:, 2:4].copy().view('<u2')[:, 0]
+    stamps = packets[:, 4:8].copy().view('<u4')[:, 0].astype(float64)
+    samples = packets[:, 8:26].copy().view('<i2').astype(float64)
+    return seq, stamps, samples
+
+def decode(data):
+    """Decode back-to-back packets, as sent in datagrams.
+
+    Returns a (n,) boolean array telling which of the n = len(data) //
+    PACKET_SIZE slots hold a valid packet, and the sequence numbers,
+    stamps and sensor values of all slots.
+    """
+    n = len(data) // PACKET_SIZE
+    packets = frombuffer(data, dtype=uint8, count=n * PACKET_SIZE).reshape(n, PACKET_SIZE)
+    crc = packets[:, 26].astype(uint16) | (packets[:, 27].astype(uint16) << 8)
+    valid = (packets[:, 0] == SYNC[0]) & (packets[:, 1] == SYNC[1]) & (crc16(packets[:, 2:26]) == crc)
+    return (valid,) + _unpack(packets)
+
+class PacketDecoder:
+    """Incremental decoder for a byte stream of packets.
+
+    Bytes are fed in arbitrary chunks. Packets are located by searching
+    for the sync word and accepted only if their CRC matches, so the
+    decoder resynchronizes by itself after corrupted or dropped bytes.
+    Gaps in the sequence numbers are counted in lost, and bytes that were
+    not part of any valid packet in skipped.
+    """
+    def __init__(self):
+        self._buffer = zeros(0, dtype=uint8)
+        self._seq = None
+        self.packets = 0
+        self.lost = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        """Decode the packets completed by data.
+
+        Returns a (n,) array of sequence numbers, a (n,) array of sample
+        stamps in microseconds and an (n, 9) array of sensor values.
+        """
+        buf = concatenate((self._buffer, frombuffer(data, dtype=uint8)))
+
+        # Candidate packet starts: a sync word with a full packet after it.
+        starts = flatnonzero((buf[:-1] == SYNC[0]) & (buf[1:] == SYNC[1]))
+        starts = starts[starts + PACKET_SIZE <= len(buf)]
+
+        packets = buf[starts[:, None] + arange(PACKET_SIZE)]
+        crc = packets[:, 26].astype(uint16) | (packets[:, 27].astype(uint16) << 8)
+        valid = crc16(packets[:, 2:26]) == crc
+        starts, packets = starts[valid], packets[valid]
+
+        # A sync word inside a packet that passes the CRC by chance
+        # would overlap the packet before it.
+        if len(starts) > 1:
+            keep = concatenate(([True], starts[1:] - starts[:-1] >= PACKET_SIZE))
+            starts, packets = starts[keep], packets[keep]
+
+        # Keep the tail that may still hold the start of a packet.
+        end = starts[-1] + PACKET_SIZE if len(starts) else 0
+        tail = max(end, len(buf) - (PACKET_SIZE - 1))
+        self.skipped += tail - len(starts) * PACKET_SIZE
+        self._buffer = buf[tail:].copy()
+
+        seq, stamps, samples = _unpack(packets)
+
+        if len(seq):
+            prev = int(seq[0]) - 1 if self._seq is None else self._seq
+            steps = (seq.astype(int) - concatenate(([prev], seq[:-1])).astype(int)) % 65536
+            self.lost += int((steps[steps > 0] - 1).sum())
+            self._seq = int(seq[-1])
+            self.packets += len(seq)
+
+        return seq, stamps, samples